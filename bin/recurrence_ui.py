@@ -57,27 +57,18 @@ def get_icon_path(icon_name):
     return icon_name
 
 
-def _cmp_occurrence_by_date(a, b):
-  """Sorting function for EventOccurrence objects, by date, then by
-  description."""
-  if a.get_date() < b.get_date():
-    return -1
-  if a.get_date() > b.get_date():
-    return 1
-  return cmp(a.get_definition().get_description(),
-             b.get_definition().get_description())
-
-
 class RecurrenceEventListCtrl(wx.ListCtrl):
   """Subclass wxListCtrl widget responsible for displaying and
-  interacting with Recurrence events."""
+  interacting with Recurrence events.  The rows themselves live in a
+  recurrence_lib.listmodel.EventListModel; refreshes touch only the
+  rows which changed.  Both virtual (wxLC_VIRTUAL) and ordinary list
+  controls are supported."""
   
   def __init__(self):
     pre = wx.PreListCtrl()
     self.PostCreate(pre)
     self.Bind(wx.EVT_WINDOW_CREATE, self.OnCreate)
-    self.num_past_events = 0
-    self.num_future_events = 0
+    self.model = recurrence_lib.listmodel.EventListModel()
 
   def OnCreate(self, event):
     """Event handler for window creation event."""
@@ -86,37 +77,47 @@ class RecurrenceEventListCtrl(wx.ListCtrl):
     self.Unbind(wx.EVT_WINDOW_CREATE)
 
     # Let's get some columns in place, shall we?
-    self.InsertColumn(0, "Date")
-    self.InsertColumn(1, "Description")
-    self.InsertColumn(2, "Occurs")
-
-  def RegisterDatafile(self, datafile):
-    """Register DATAFILE with the application as the source of event
-    information. """
-    self.definitions, self.occurrences = \
-        recurrence_lib.storage.read_data_file(datafile)
+    for i in range(len(recurrence_lib.listmodel.COLUMN_TITLES)):
+      self.InsertColumn(i, recurrence_lib.listmodel.COLUMN_TITLES[i])
+    self.past_attr = wx.ListItemAttr()
+    self.past_attr.SetTextColour(wx.Colour(255, 0, 0))
+
+  def RegisterDatafiles(self, datafiles):
+    """Register the list of DATAFILES with the application as the
+    sources of event information, and load them.  Return a dictionary
+    mapping the data files which couldn't be read to the exceptions
+    which prevented it."""
+    self.stores = recurrence_lib.multifile.MultiFileStore(datafiles)
+    errors = self.ReloadDatafiles()
     self.RefreshEventList(time.time())
+    return errors
+
+  def ReloadDatafiles(self, datafiles=None):
+    """Reload event information from the registered data files in
+    DATAFILES (by default, all of them), without refreshing the event
+    listing.  Data files which can't be read keep the information last
+    read from them.  Return a dictionary mapping those data files to
+    the exceptions which prevented reading them."""
+    return self.stores.load(datafiles)
 
   def RefreshEventList(self, now_time):
-    """Refresh the event listing, in full, using NOW_TIME to dilineate
-    past and future events."""
+    """Refresh the event listing using NOW_TIME to dilineate past and
+    future events."""
 
     now_date = datetime.date.fromtimestamp(now_time)
-    self.DeleteAllItems()
-    occs = recurrence_lib.events._get_past_occurrences(self.definitions,
-                                                       self.occurrences,
-                                                       now_date)
-    self.num_past_events = len(occs)
-    occs.sort(_cmp_occurrence_by_date)
-    for occ in occs:
-      self._AppendEventToList(occ, True)
-    occs = recurrence_lib.events._get_future_occurrences(self.definitions,
-                                                         self.occurrences,
-                                                         now_date, 60)
-    self.num_future_events = len(occs)
-    occs.sort(_cmp_occurrence_by_date)
-    for occ in occs:
-      self._AppendEventToList(occ, False)
+    past_occs = self.stores.get_past_occurrences(now_date)
+    future_occs = self.stores.get_future_occurrences(now_date, 60)
+    changes = self.model.set_occurrences(past_occs, future_occs)
+    if not changes:
+      return
+    if self.IsVirtual():
+      # Rows after the first change may all have moved.
+      self.SetItemCount(len(self.model))
+      if len(self.model):
+        self.RefreshItems(min(changes[0][1], len(self.model) - 1),
+                          len(self.model) - 1)
+    else:
+      self._ApplyChanges(changes)
     self.SetColumnWidth(0, wx.LIST_AUTOSIZE)
     self.SetColumnWidth(1, wx.LIST_AUTOSIZE)
     self.SetColumnWidth(2, wx.LIST_AUTOSIZE)
@@ -124,28 +125,35 @@ class RecurrenceEventListCtrl(wx.ListCtrl):
   def GetEventCounts(self):
     """Return a 2-tuple containing the number of past and future
     events shown."""
-    return self.num_past_events, self.num_future_events
-
-  def _AppendEventToList(self, occurrence, past=False):
-    """Append EventOccurrence OCCURRENCE to the end of the list."""
-
-    def unparse_date(date):
-      if date is None:
-        return ''
+    return self.model.get_counts()
+
+  def OnGetItemText(self, item, column):
+    """Virtual list control callback:  return the text of COLUMN of
+    row ITEM."""
+    return self.model.get_item_text(item, column)
+
+  def OnGetItemAttr(self, item):
+    """Virtual list control callback:  return the attributes of row
+    ITEM."""
+    if self.model.is_past(item):
+      return self.past_attr
+    return None
+
+  def _ApplyChanges(self, changes):
+    """Apply the model changes CHANGES to a non-virtual list control."""
+    listmodel = recurrence_lib.listmodel
+    for op, idx, row in changes:
+      if op == listmodel.CHANGE_DELETE:
+        self.DeleteItem(idx)
+        continue
+      if op == listmodel.CHANGE_INSERT:
+        self.InsertStringItem(idx, row[1][0])
       else:
-        return "%d-%02d-%02d" % (date.year, date.month, date.day)
-    
-    datestr = unparse_date(occurrence.get_date())
-    desc = occurrence.get_definition().get_description()
-    rec = occurrence.get_definition().get_recurrence()
-    if rec:
-      rec = recurrence_lib.events.period_to_string(rec.get_period())
-    else:
-      rec = 'once'
-    idx = self.InsertStringItem(self.GetItemCount(), datestr)
-    self.SetStringItem(idx, 1, desc)
-    self.SetStringItem(idx, 2, rec)
-    self.SetItemTextColour(idx, wx.Colour(past and 255 or 0, 0, 0))
+        self.SetStringItem(idx, 0, row[1][0])
+      self.SetStringItem(idx, 1, row[1][1])
+      self.SetStringItem(idx, 2, row[1][2])
+      past = row[0][0] == listmodel.SECTION_PAST
+      self.SetItemTextColour(idx, wx.Colour(past and 255 or 0, 0, 0))
 
 
 class RecurrenceTaskBarIcon(wx.TaskBarIcon):
@@ -244,25 +252,35 @@ class RecurrenceMainFrame(wx.Frame):
                          name='StatusBar')
     self.SetStatusWidths([300, -1])
 
-    # Create a timer to use for automatic updates, and register an
-    # event listener for it.
+    # Create a timer to use for polling for changes to the data file
+    # and the date, and register an event listener for it.
+    self.refresher = None
+    self.schedulers = {}
     self.timer = wx.Timer(self)
-    self.timer.Start(60 * 60 * 1000, wx.TIMER_CONTINUOUS)
+    self.timer.Start(recurrence_lib.watch.POLL_INTERVAL * 1000,
+                     wx.TIMER_CONTINUOUS)
     self.Bind(wx.EVT_TIMER, self._TimerNotification)
 
-  def RegisterDatafile(self, datafile):
-    """Register DATAFILE as the Recurrence data file to consult and use."""
+  def RegisterDatafiles(self, datafiles):
+    """Register the list of DATAFILES as the Recurrence data files to
+    consult and use."""
     entrylist = self._GetWindow('EventList')
-    try:
-      entrylist.RegisterDatafile(datafile)
-    except Exception, e:
+    # Start watching before loading, so that changes made while we
+    # load are noticed.
+    self.refresher = recurrence_lib.watch.RefreshController(datafiles)
+    errors = entrylist.RegisterDatafiles(datafiles)
+    if errors:
+      datafile = sorted(errors)[0]
       dlg = wx.MessageDialog(self,
                              "Error reading data file '%s': %s"
-                             % (datafile, str(e)),
+                             % (datafile, str(errors[datafile])),
                              "Data File Error",
                              wx.OK | wx.ICON_ERROR)
       dlg.ShowModal()
       self.Close()
+      return
+    for datafile in datafiles:
+      self._LoadScheduler(datafile)
     self.UpdateEventList()
 
   def Close(self):
@@ -282,6 +300,50 @@ class RecurrenceMainFrame(wx.Frame):
                        0)
     self.SetStatusText("%d past, %d future" % (past_count, future_count), 1)
 
+  def CheckForChanges(self, force=False):
+    """Reload the data files which have changed on disk, and update the
+    event list if any did or the date has changed (or if FORCE is
+    set)."""
+    if self.refresher is None:
+      return
+    changed_datafiles, date_changed = self.refresher.check()
+    errors = {}
+    if changed_datafiles:
+      # Only the changed data files are reloaded.
+      entrylist = self._GetWindow('EventList')
+      errors = entrylist.ReloadDatafiles(changed_datafiles)
+      for datafile in changed_datafiles:
+        if datafile not in errors:
+          self._LoadScheduler(datafile)
+    for scheduler in self.schedulers.values():
+      scheduler.run_pending()
+    if force or changed_datafiles or date_changed:
+      self.UpdateEventList()
+    if errors:
+      # Probably caught mid-edit; keep showing what we had, and retry
+      # when the file next changes.
+      datafile = sorted(errors)[0]
+      self.SetStatusText("Error reading data file '%s': %s"
+                         % (datafile, str(errors[datafile])), 0)
+
+  def _LoadScheduler(self, datafile):
+    """(Re)load the reminder scheduler for DATAFILE with the event
+    information last read from it."""
+    store = self._GetWindow('EventList').stores.get_store(datafile)
+    scheduler = self.schedulers.get(datafile)
+    if scheduler is None:
+      self.schedulers[datafile] = recurrence_lib.scheduler.ReminderScheduler(
+        store.get_definitions(), store.get_occurrences(), [self._Remind],
+        store.get_clearance_index())
+    else:
+      scheduler.load(store.get_definitions(), store.get_occurrences(),
+                     store.get_clearance_index())
+
+  def _Remind(self, occurrence):
+    """Reminder callback:  flag the taskbar icon when OCCURRENCE falls
+    due."""
+    self.tbicon._SetAlert(True)
+
   def _GetWindowId(self, window_name):
     """Return the ID of the Window named WINDOW_NAME."""
     return self.window_ids.get(window_name)
@@ -328,9 +390,9 @@ class RecurrenceMainFrame(wx.Frame):
     return True
 
   def _UpdateButtonActivated(self, event):
-    self.UpdateEventList()
+    self.CheckForChanges(True)
     return True
 
   def _TimerNotification(self, event):
-    self.UpdateEventList()
+    self.CheckForChanges()
     return True
@@ -14,6 +14,32 @@
 
 """This package contains Recurrence support modules."""
 
-import events
-import storage
-__all__ = ['events', 'storage']
+### Submodules are imported lazily, on first access as attributes of
+### this package, so that programs pay only for what they use.  (This
+### is done by replacing this module in sys.modules with an instance of
+### a module subclass that imports submodules on demand.)
+
+import sys
+import types
+__all__ = ['events', 'storage', 'batch', 'cache', 'watch',
+           'listmodel', 'store', 'window', 'parallel', 'scheduler',
+           'stats', 'multifile', 'table']
+
+
+class _LazyPackage(types.ModuleType):
+  """Module type for this package, which imports the submodules named
+  in __all__ on first attribute access."""
+
+  def __getattr__(self, name):
+    if name not in self.__all__:
+      raise AttributeError("'module' object has no attribute '%s'" % (name))
+    module_name = self.__name__ + '.' + name
+    __import__(module_name)
+    return sys.modules[module_name]
+
+
+_package = _LazyPackage(__name__, __doc__)
+_package.__dict__.update(globals())
+# Keep the original module object alive, lest its globals be cleared.
+_package._original_module = sys.modules[__name__]
+sys.modules[__name__] = _package
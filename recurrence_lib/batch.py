@@ -0,0 +1,198 @@
+# ====================================================================
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ====================================================================
+
+"""batch.py:  Recurrence batch (columnar) occurrence expansion."""
+
+### Definitions are flattened into parallel columns of start date
+### ordinals, period codes and until date ordinals, and expanded over
+### a date window in one pass into parallel columns of definition
+### indices and occurrence date ordinals.  NumPy's datetime64
+### arithmetic is used when available; otherwise, we fall back to the
+### pure-Python recurrence logic in events.py, with identical results.
+
+import array
+import datetime
+import events
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+
+# Ordinal of numpy's datetime64 epoch (1970-01-01).
+_EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+
+def definition_columns(definitions):
+  """Flatten DEFINITIONS into three parallel integer columns -- start
+  date ordinals, period codes, and until date ordinals (0 where there
+  is no until date) -- returned as a 3-tuple of arrays."""
+  starts = array.array('l')
+  periods = array.array('l')
+  untils = array.array('l')
+  for definition in definitions:
+    starts.append(definition.get_start_date().toordinal())
+    recurrence = definition.get_recurrence()
+    if recurrence:
+      periods.append(events.period_to_code(recurrence.get_period()))
+      until_date = recurrence.get_until_date()
+      untils.append(until_date and until_date.toordinal() or 0)
+    else:
+      periods.append(events.PERIOD_CODE_NONE)
+      untils.append(0)
+  return starts, periods, untils
+
+
+def _expand_columns_python(starts, periods, untils, start_date, end_date):
+  rows = []
+  for i in range(len(starts)):
+    start = datetime.date.fromordinal(starts[i])
+    if periods[i] == events.PERIOD_CODE_NONE:
+      if start_date <= start <= end_date:
+        rows.append((starts[i], i))
+      continue
+    until_date = untils[i] and datetime.date.fromordinal(untils[i]) or None
+    period = events.period_from_code(periods[i])
+    recurrence = events.intern_recurrence(period, until_date)
+    for date in recurrence.iter_dates(start, start_date, end_date):
+      rows.append((date.toordinal(), i))
+  rows.sort()
+  indices = array.array('l', [row[1] for row in rows])
+  ordinals = array.array('l', [row[0] for row in rows])
+  return indices, ordinals
+
+
+def _split_ordinals(ordinals):
+  # Return (month index, day of month) arrays for the dates with
+  # ORDINALS, where a month index counts months since 1970-01.
+  days = (ordinals - _EPOCH_ORDINAL).astype('datetime64[D]')
+  months = days.astype('datetime64[M]')
+  day_of_month = (days - months.astype('datetime64[D]')).astype(numpy.int64)
+  return months.astype(numpy.int64), day_of_month + 1
+
+
+def _expand_columns_numpy(starts, periods, untils, start_date, end_date):
+  starts = numpy.asarray(starts, dtype=numpy.int64)
+  periods = numpy.asarray(periods, dtype=numpy.int64)
+  untils = numpy.asarray(untils, dtype=numpy.int64)
+  first = numpy.int64(start_date.toordinal())
+  last = numpy.int64(end_date.toordinal())
+  weekly = periods == events.PERIOD_CODE_WEEKLY
+  yearly = periods == events.PERIOD_CODE_YEARLY
+  by_month = (periods == events.PERIOD_CODE_MONTHLY) | yearly
+
+  # Express every date as a "position" relative to the definition's
+  # start date, in units such that the k-th occurrence sits at
+  # position k * unit:  days for weekly recurrences (unit 7), and
+  # month-and-day offsets for monthly and yearly ones (32 per month,
+  # which keeps day offsets from spilling into the next month).
+  start_months, start_days = _split_ordinals(starts)
+  def positions(ordinals):
+    months, days = _split_ordinals(ordinals)
+    by_month_pos = (months - start_months) * 32 + (days - start_days)
+    return numpy.where(by_month, by_month_pos, ordinals - starts)
+  units = numpy.where(weekly, 7, numpy.where(yearly, 12 * 32, 32))
+
+  first_pos = positions(numpy.zeros_like(starts) + first)
+  last_pos = positions(numpy.zeros_like(starts) + last)
+  until_pos = positions(numpy.where(untils > 0, untils, starts))
+  k_min = numpy.maximum(0, -((-first_pos) // units))
+  k_max = numpy.minimum(last_pos // units,
+                        numpy.where(untils > 0,
+                                    numpy.maximum(0, until_pos // units),
+                                    numpy.iinfo(numpy.int64).max))
+
+  # Non-recurring definitions have one occurrence, on the start date.
+  once = periods == events.PERIOD_CODE_NONE
+  k_min = numpy.where(once, numpy.where(starts < first, 1, 0), k_min)
+  k_max = numpy.where(once, numpy.where(starts > last, -1, 0), k_max)
+
+  counts = numpy.maximum(0, k_max - k_min + 1)
+  indices = numpy.repeat(numpy.arange(len(starts), dtype=numpy.int64), counts)
+  offsets = numpy.arange(counts.sum(), dtype=numpy.int64) \
+            - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+  ks = numpy.repeat(k_min, counts) + offsets
+
+  ordinals = starts[indices] + numpy.where(weekly[indices], 7 * ks, 0)
+  month_rows = by_month[indices]
+  if month_rows.any():
+    steps = numpy.where(yearly[indices], 12, 1)
+    months = start_months[indices] + ks * steps
+    month_ordinals = months.astype('datetime64[M]').astype('datetime64[D]') \
+                     .astype(numpy.int64) + start_days[indices] - 1 \
+                     + _EPOCH_ORDINAL
+    if (_split_ordinals(month_ordinals)[0] != months)[month_rows].any():
+      raise ValueError("day is out of range for month")
+    ordinals = numpy.where(month_rows, month_ordinals, ordinals)
+
+  order = numpy.lexsort((indices, ordinals))
+  return indices[order], ordinals[order]
+
+
+def expand_columns(starts, periods, untils, start_date, end_date,
+                   use_numpy=None):
+  """Expand the definitions described by the parallel columns STARTS,
+  PERIODS and UNTILS (see definition_columns()) over the window from
+  START_DATE to END_DATE, inclusive.  Return a 2-tuple of parallel
+  columns -- definition indices and occurrence date ordinals -- ordered
+  by date, then by definition index.  USE_NUMPY forces (True) or
+  forbids (False) the NumPy engine; by default, it's used if
+  available."""
+  if use_numpy is None:
+    use_numpy = numpy is not None
+  if use_numpy and len(starts):
+    return _expand_columns_numpy(starts, periods, untils,
+                                 start_date, end_date)
+  return _expand_columns_python(starts, periods, untils,
+                                start_date, end_date)
+
+
+def expand_definitions(definitions, start_date, end_date, use_numpy=None):
+  """Expand DEFINITIONS over the window from START_DATE to END_DATE,
+  inclusive.  See expand_columns() for details."""
+  starts, periods, untils = definition_columns(definitions)
+  return expand_columns(starts, periods, untils, start_date, end_date,
+                        use_numpy)
+
+
+def get_future_occurrences(definitions, occurrences, now_time, num_days,
+                           clearance_index=None, use_numpy=None):
+  """Batch equivalent of events._get_future_occurrences(), returning
+  the uncleared occurrences in date order."""
+  if clearance_index is None:
+    clearance_index = events.ClearanceIndex(occurrences)
+  end_time = now_time + datetime.timedelta(num_days, 0, 0)
+  indices, ordinals = expand_definitions(definitions, now_time, end_time,
+                                         use_numpy)
+  return occurrences_from_columns(definitions, indices, ordinals,
+                                  clearance_index)
+
+
+def occurrences_from_columns(definitions, indices, ordinals,
+                             clearance_index):
+  """Return EventOccurrences for those rows of the parallel INDICES
+  (into DEFINITIONS) and date ORDINALS columns which CLEARANCE_INDEX
+  doesn't show as cleared, in column order."""
+  future_occurrences = []
+  dates = {}
+  for i in range(len(indices)):
+    definition = definitions[int(indices[i])]
+    ordinal = int(ordinals[i])
+    date = dates.get(ordinal)
+    if date is None:
+      date = dates[ordinal] = datetime.date.fromordinal(ordinal)
+    if not clearance_index.is_cleared(definition, date):
+      future_occurrences.append(events.EventOccurrence(definition, date))
+  return future_occurrences
@@ -0,0 +1,123 @@
+# ====================================================================
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ====================================================================
+
+"""cache.py:  Recurrence parsed-snapshot cache."""
+
+### Each cached snapshot is a stamp line describing the data file it
+### was made from (size, modification time, and SHA-1 content hash),
+### followed by the data in the binary (version 3) data file format.
+
+import hashlib
+import os
+import stats
+import storage
+
+
+def get_cache_dir():
+  """Return the directory in which snapshots are cached:
+  $RECURRENCE_CACHE_DIR if set, or else a 'recurrence' directory in
+  $XDG_CACHE_HOME (which defaults to ~/.cache)."""
+  cache_dir = os.environ.get('RECURRENCE_CACHE_DIR')
+  if cache_dir:
+    return cache_dir
+  cache_home = os.environ.get('XDG_CACHE_HOME') \
+               or os.path.join(os.path.expanduser('~'), '.cache')
+  return os.path.join(cache_home, 'recurrence')
+
+
+def get_snapshot_path(filepath, cache_dir=None):
+  """Return the path of the cached snapshot of the data file at
+  FILEPATH, in CACHE_DIR (by default, get_cache_dir())."""
+  if cache_dir is None:
+    cache_dir = get_cache_dir()
+  key = hashlib.sha1(os.path.abspath(filepath)).hexdigest()
+  return os.path.join(cache_dir, key + '.snapshot')
+
+
+def _hash_file(filepath):
+  sha1 = hashlib.sha1()
+  fp = open(filepath, 'rb')
+  try:
+    while 1:
+      chunk = fp.read(1024 * 1024)
+      if not chunk:
+        break
+      sha1.update(chunk)
+  finally:
+    fp.close()
+  return sha1.hexdigest()
+
+
+def _read_snapshot(snapshot_path, filepath):
+  # Return the (definitions, occurrences) held in the snapshot at
+  # SNAPSHOT_PATH if it is a current snapshot of FILEPATH, else None.
+  try:
+    fp = open(snapshot_path, 'rb')
+  except IOError:
+    return None
+  try:
+    try:
+      size, mtime, digest = fp.readline().rstrip('\n').split('\t')
+      st = os.stat(filepath)
+      # Compare the cheap stamps first, so that a changed data file
+      # needn't be hashed.
+      if int(size) != st.st_size or float(mtime) != st.st_mtime \
+         or digest != _hash_file(filepath):
+        return None
+      if storage.read_version(fp) != storage.BINARY_VERSION:
+        return None
+      data = storage.parse_data_file_v3(fp)
+      if stats.enabled:
+        storage._count_read(fp, data)
+      return data
+    except Exception:
+      # A damaged snapshot is just a cache miss.
+      return None
+  finally:
+    fp.close()
+
+
+def _write_snapshot(snapshot_path, stamp, definitions, occurrences):
+  def unparse_snapshot(temp_path):
+    fp = open(temp_path, 'wb')
+    fp.write(stamp + '\n')
+    fp.write('#version = %d\n' % (storage.BINARY_VERSION))
+    storage._unparse_records_v3(fp, definitions, occurrences)
+    fp.close()
+  cache_dir = os.path.dirname(snapshot_path)
+  if not os.path.isdir(cache_dir):
+    os.makedirs(cache_dir)
+  storage._replace_file(snapshot_path, unparse_snapshot)
+
+
+@stats.timed('load_data_file')
+def load_data_file(filepath, cache_dir=None):
+  """Like storage.read_data_file(), but consult (and maintain) a
+  snapshot cache in CACHE_DIR (by default, get_cache_dir()), so that
+  an unchanged data file needn't be parsed again.  Failure to write
+  the cache is not an error."""
+  snapshot_path = get_snapshot_path(filepath, cache_dir)
+  data = _read_snapshot(snapshot_path, filepath)
+  if data is not None:
+    return data
+  # Stamp the file before parsing it, so that changes made while we
+  # parse will invalidate the snapshot.
+  st = os.stat(filepath)
+  stamp = '%d\t%r\t%s' % (st.st_size, st.st_mtime, _hash_file(filepath))
+  definitions, occurrences = storage.read_data_file(filepath)
+  try:
+    _write_snapshot(snapshot_path, stamp, definitions, occurrences)
+  except (IOError, OSError):
+    pass
+  return definitions, occurrences
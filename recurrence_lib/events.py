@@ -15,6 +15,9 @@
 """events.py:  Recurrence data model objects."""
 
 import datetime
+import heapq
+import weakref
+import stats
 
 
 EVENT_PERIOD_WEEKLY = 'weekly'
@@ -23,6 +26,7 @@ EVENT_PERIOD_YEARLY = 'yearly'
 
 
 class InvalidEventRecurrencePeriod(Exception): pass
+class ImmutableEventRecurrence(Exception): pass
 class NotImplementedError(Exception): pass
 
 def period_to_string(s):
@@ -38,8 +42,44 @@ def period_to_string(s):
 period_from_string = period_to_string
 
 
-class EventRecurrence:
+# Compact integer codes for recurrence periods, used by the columnar
+# and binary representations of event definitions.
+PERIOD_CODE_NONE = 0
+PERIOD_CODE_WEEKLY = 1
+PERIOD_CODE_MONTHLY = 2
+PERIOD_CODE_YEARLY = 3
+
+_period_codes = {
+  None : PERIOD_CODE_NONE,
+  EVENT_PERIOD_WEEKLY : PERIOD_CODE_WEEKLY,
+  EVENT_PERIOD_MONTHLY : PERIOD_CODE_MONTHLY,
+  EVENT_PERIOD_YEARLY : PERIOD_CODE_YEARLY,
+  }
+_code_periods = {}
+for _period, _code in _period_codes.items():
+  _code_periods[_code] = _period
+
+def period_to_code(period):
+  """Return the integer code for recurrence period PERIOD."""
+  try:
+    return _period_codes[period]
+  except KeyError:
+    raise InvalidEventRecurrencePeriod("Unrecognized period value: %s"
+                                       % (str(period)))
+
+def period_from_code(code):
+  """Return the recurrence period represented by integer code CODE."""
+  try:
+    return _code_periods[code]
+  except KeyError:
+    raise InvalidEventRecurrencePeriod("Unrecognized period code: %s"
+                                       % (str(code)))
+
+
+class EventRecurrence(object):
   """Describes the recurrence pattern used by an EventDescription object."""
+
+  __slots__ = ('period', 'until_date', '__weakref__')
   
   def __init__(self, period=None, until_date=None):
     self.set_period(period)
@@ -64,20 +104,135 @@ class EventRecurrence:
     return self.until_date
 
   def __eq__(self, other):
+    if self is other:
+      return True
     return self.until_date == other.until_date and \
            self.period == other.period
 
+  def __ne__(self, other):
+    return not self.__eq__(other)
+
+  def __hash__(self):
+    return hash((self.period, self.until_date))
+
+  def get_next_date(self, date):
+    """Return the date of the occurrence which follows one on DATE
+    according to this pattern, or None if there is no such occurrence
+    on or before the until date."""
+    if self.period == EVENT_PERIOD_WEEKLY:
+      new_date = date + datetime.timedelta(7, 0, 0)
+    elif self.period == EVENT_PERIOD_MONTHLY:
+      new_month = date.month + 1
+      new_year = date.year
+      if new_month == 13:
+        new_month = 1
+        new_year = new_year + 1
+      new_date = datetime.date(new_year, new_month, date.day)
+    elif self.period == EVENT_PERIOD_YEARLY:
+      new_date = datetime.date(date.year + 1, date.month, date.day)
+    else:
+      return None
+    if (not self.until_date) or (new_date <= self.until_date):
+      return new_date
+    return None
+
+  def get_first_date_on_or_after(self, start_date, date):
+    """Return the first date on or after DATE on which an event that
+    starts on START_DATE and recurs according to this pattern occurs,
+    or None if there is no such date.  This is computed directly, so
+    its cost doesn't depend on how far DATE lies past START_DATE."""
+    if date <= start_date:
+      return start_date
+    if self.period == EVENT_PERIOD_WEEKLY:
+      num_weeks = ((date - start_date).days + 6) // 7
+      new_date = start_date + datetime.timedelta(num_weeks * 7, 0, 0)
+    elif self.period == EVENT_PERIOD_MONTHLY:
+      num_months = (date.year - start_date.year) * 12 \
+                   + (date.month - start_date.month)
+      if date.day > start_date.day:
+        num_months = num_months + 1
+      new_year, new_month = divmod(start_date.month - 1 + num_months, 12)
+      new_date = datetime.date(start_date.year + new_year,
+                               new_month + 1,
+                               start_date.day)
+    elif self.period == EVENT_PERIOD_YEARLY:
+      num_years = date.year - start_date.year
+      if (date.month, date.day) > (start_date.month, start_date.day):
+        num_years = num_years + 1
+      new_date = datetime.date(start_date.year + num_years,
+                               start_date.month,
+                               start_date.day)
+    else:
+      return None
+    if (not self.until_date) or (new_date <= self.until_date):
+      return new_date
+    return None
+
+  def iter_dates(self, start_date, start=None, end=None):
+    """Generate, in order, the dates between START and END (inclusive)
+    on which an event that starts on START_DATE and recurs according to
+    this pattern occurs.  See EventDefinition.iter_dates()."""
+    if start is None:
+      date = start_date
+    else:
+      date = self.get_first_date_on_or_after(start_date, start)
+    while date is not None and (end is None or date <= end):
+      yield date
+      date = self.get_next_date(date)
 
-class EventDefinition:
+
+class _InternedRecurrence(EventRecurrence):
+  """An EventRecurrence shared via intern_recurrence(), whose setters
+  refuse to modify it."""
+
+  __slots__ = ()
+
+  def __init__(self, period=None, until_date=None):
+    EventRecurrence.set_period(self, period)
+    EventRecurrence.set_until_date(self, until_date)
+
+  def set_period(self, period):
+    raise ImmutableEventRecurrence("Interned recurrences may not be "
+                                   "modified; use intern_recurrence().")
+
+  def set_until_date(self, until_date):
+    raise ImmutableEventRecurrence("Interned recurrences may not be "
+                                   "modified; use intern_recurrence().")
+
+
+# Interned EventRecurrence objects, keyed on (period, until_date).
+_interned_recurrences = weakref.WeakValueDictionary()
+
+def intern_recurrence(period=None, until_date=None):
+  """Return an EventRecurrence with PERIOD and UNTIL_DATE, sharing a
+  single instance among all callers asking for the same pattern.  The
+  returned object is shared, so it is immutable:  to change a
+  definition's recurrence, give it a new one, e.g. via
+  definition.set_recurrence(intern_recurrence(...))."""
+  key = (period, until_date)
+  recurrence = _interned_recurrences.get(key)
+  if recurrence is None:
+    recurrence = _InternedRecurrence(period, until_date)
+    _interned_recurrences[key] = recurrence
+  return recurrence
+
+
+class EventDefinition(object):
   """An event definition -- the template, of sorts, from which
-  individual event occurrences are created."""
+  individual event occurrences are created.  Every occurrence dated on
+  or before the definition's cleared-through date (if it has one)
+  counts as cleared, whether or not it is stored."""
+
+  __slots__ = ('uuid', 'description', 'start_date', 'recurrence',
+               'cleared_through')
   
   def __init__(self, uuid=None, description=None, start_date=None,
-               recurrence=None):
+               recurrence=None, cleared_through=None):
     self.set_uuid(uuid)
     self.set_description(description)
     self.set_start_date(start_date)
     self.set_recurrence(recurrence)
+    self.set_cleared_through(cleared_through)
 
   def set_uuid(self, uuid):
     self.uuid = uuid
@@ -106,18 +261,72 @@ class EventDefinition:
   def get_recurrence(self):
     return self.recurrence
 
+  def set_cleared_through(self, cleared_through):
+    assert cleared_through is None \
+           or type(cleared_through) == datetime.date
+    self.cleared_through = cleared_through
+
+  def get_cleared_through(self):
+    return self.cleared_through
+
   def __eq__(self, other):
+    if self is other:
+      return True
     return self.uuid == other.uuid and \
            self.description == other.description and \
            self.start_date == other.start_date and \
-           self.recurrence == other.recurrence
+           self.recurrence == other.recurrence and \
+           self.cleared_through == other.cleared_through
+
+  def __ne__(self, other):
+    return not self.__eq__(other)
+
+  def __hash__(self):
+    return hash(self.uuid)
 
   def get_first_occurrence(self):
     return EventOccurrence(self, self.start_date)
 
+  def get_first_date_on_or_after(self, date):
+    """Return the date of the first occurrence of this event on or
+    after DATE, or None if there is no such occurrence."""
+    if date <= self.start_date:
+      return self.start_date
+    if self.recurrence:
+      return self.recurrence.get_first_date_on_or_after(self.start_date, date)
+    return None
 
-class EventOccurrence:
+  def get_first_occurrence_on_or_after(self, date):
+    """Return an EventOccurrence for the first occurrence of this event
+    on or after DATE, or None if there is no such occurrence."""
+    first_date = self.get_first_date_on_or_after(date)
+    if first_date is None:
+      return None
+    return EventOccurrence(self, first_date)
+
+  def iter_dates(self, start=None, end=None):
+    """Generate, in order, the dates of the occurrences of this event
+    which fall between START and END (inclusive).  Omit START to begin
+    at the first occurrence; omit END to continue as long as the event
+    recurs."""
+    if self.recurrence:
+      return self.recurrence.iter_dates(self.start_date, start, end)
+    if (start is None or start <= self.start_date) \
+       and (end is None or self.start_date <= end):
+      return iter([self.start_date])
+    return iter([])
+
+  def iter_occurrences(self, start=None, end=None):
+    """Like iter_dates(), but generate EventOccurrence objects.  Each
+    object is built only as the caller asks for it."""
+    for date in self.iter_dates(start, end):
+      yield EventOccurrence(self, date)
+
+
+class EventOccurrence(object):
   """A single occurrence of an event."""
+
+  __slots__ = ('definition', 'date', 'cleared')
   
   def __init__(self, definition=None, date=None, cleared=False):
     self.set_definition(definition)
@@ -146,62 +355,213 @@ class EventOccurrence:
     return self.cleared
 
   def __eq__(self, other):
+    if self is other:
+      return True
     return self.definition == other.definition and \
            self.date == other.date and \
            self.cleared == other.cleared
 
+  def __ne__(self, other):
+    return not self.__eq__(other)
+
+  def __hash__(self):
+    return hash((self.definition and self.definition.get_uuid(), self.date))
+
   def next(self):
     recurrence = self.definition.get_recurrence()
     if recurrence:
-      period = recurrence.get_period()
-      until_date = recurrence.get_until_date()
-      if period == EVENT_PERIOD_WEEKLY:
-        new_date = self.date + datetime.timedelta(7, 0, 0)
-      elif period == EVENT_PERIOD_MONTHLY:
-        new_month = self.date.month + 1
-        new_year = self.date.year
-        if new_month == 13:
-          new_month = 1
-          new_year = new_year + 1
-        new_date = datetime.date(new_year,
-                                 new_month,
-                                 self.date.day)
-      elif period == EVENT_PERIOD_YEARLY:
-        new_date = datetime.date(self.date.year + 1,
-                                 self.date.month,
-                                 self.date.day)
-      if (not until_date) or (new_date <= until_date):
+      new_date = recurrence.get_next_date(self.date)
+      if new_date is not None:
+        if stats.enabled:
+          stats.count('occurrences_generated')
         return EventOccurrence(self.definition, new_date)
     # no recurrence, or no occurrences before until_date
     return None
 
 
+_new_occurrence = EventOccurrence.__new__
+
+def make_occurrence(definition, date, cleared=False):
+  """Return EventOccurrence(DEFINITION, DATE, CLEARED), made without
+  the setters' checks, for building occurrences in bulk from data
+  already known to be valid."""
+  occurrence = _new_occurrence(EventOccurrence)
+  occurrence.definition = definition
+  occurrence.date = date
+  occurrence.cleared = cleared
+  return occurrence
+
+
+class ClearanceIndex(object):
+  """An index of cleared EventOccurrences keyed on (definition uuid,
+  date), answering "has this occurrence been cleared?" in constant
+  time -- consulting the definition's cleared-through date first, so
+  occurrences covered by it needn't be indexed.  Build one per data
+  load, and route subsequent additions, removals and clearance changes
+  through it so it stays current."""
+
+  def __init__(self, occurrences=None):
+    self.cleared_counts = {}
+    for occurrence in occurrences or []:
+      self.add_occurrence(occurrence)
+
+  def _key(self, occurrence):
+    return occurrence.get_definition().get_uuid(), occurrence.get_date()
+
+  def add_occurrence(self, occurrence):
+    """Note the addition of OCCURRENCE to the stored occurrences."""
+    if occurrence.get_cleared():
+      self.add_cleared(occurrence.get_definition().get_uuid(),
+                       occurrence.get_date())
+
+  def add_cleared(self, uuid, date):
+    """Note the addition of a cleared occurrence, of the definition with
+    UUID on DATE, to the stored occurrences."""
+    key = (uuid, date)
+    self.cleared_counts[key] = self.cleared_counts.get(key, 0) + 1
+
+  def remove_occurrence(self, occurrence):
+    """Note the removal of OCCURRENCE from the stored occurrences."""
+    if occurrence.get_cleared():
+      key = self._key(occurrence)
+      count = self.cleared_counts.get(key, 0) - 1
+      if count > 0:
+        self.cleared_counts[key] = count
+      else:
+        self.cleared_counts.pop(key, None)
+
+  def set_cleared(self, occurrence, cleared):
+    """Set the clearance flag of stored OCCURRENCE to CLEARED, keeping
+    the index in sync."""
+    self.remove_occurrence(occurrence)
+    occurrence.set_cleared(cleared)
+    self.add_occurrence(occurrence)
+
+  def is_cleared(self, definition, date):
+    """Return True iff the occurrence of DEFINITION on DATE has been
+    cleared."""
+    cleared_through = definition.cleared_through
+    if cleared_through is not None and date <= cleared_through:
+      return True
+    return (definition.get_uuid(), date) in self.cleared_counts
+
+
+def clear_through(definitions, date, occurrences=None,
+                  clearance_index=None):
+  """Clear every occurrence of DEFINITIONS (a list of EventDefinitions,
+  or a single one) dated on or before DATE, by advancing each
+  definition's cleared-through date to DATE.  (A cleared-through date
+  already later than DATE is kept.)  The stored records which that
+  makes redundant -- those of DEFINITIONS dated on or before their new
+  cleared-through dates -- are removed from OCCURRENCES (a list, or a
+  table.OccurrenceTable) in a single pass, and from CLEARANCE_INDEX, if
+  provided.  Return the list of removed occurrences."""
+  if isinstance(definitions, EventDefinition):
+    definitions = [definitions]
+  watermarks = {}
+  for definition in definitions:
+    cleared_through = definition.get_cleared_through()
+    if cleared_through is None or cleared_through < date:
+      definition.set_cleared_through(date)
+    watermarks[definition.get_uuid()] = definition.get_cleared_through()
+  if not occurrences:
+    return []
+  remove_through = getattr(occurrences, 'remove_through', None)
+  if remove_through is not None:
+    # An occurrence table (see table.py) removes its own rows.
+    removed = remove_through(watermarks)
+    if clearance_index is not None:
+      for occurrence in removed:
+        clearance_index.remove_occurrence(occurrence)
+    return removed
+  kept = []
+  removed = []
+  for occurrence in occurrences:
+    watermark = watermarks.get(occurrence.get_definition().get_uuid())
+    if watermark is not None and occurrence.get_date() <= watermark:
+      removed.append(occurrence)
+      if clearance_index is not None:
+        clearance_index.remove_occurrence(occurrence)
+    else:
+      kept.append(occurrence)
+  occurrences[:] = kept
+  return removed
+
+
+def occurrence_sort_key(occurrence):
+  """Return the key by which EventOccurrence OCCURRENCE is ordered for
+  display:  its date, then its description."""
+  return occurrence.get_date(), occurrence.get_definition().get_description()
+
+
+def iter_future_occurrences(definitions, occurrences, now_time,
+                            end_time=None, max_count=None,
+                            clearance_index=None):
+  """Generate the uncleared occurrences of DEFINITIONS which fall on or
+  after NOW_TIME, in display order (see occurrence_sort_key()).  The
+  per-definition occurrence sequences are merged lazily via a heap, so
+  nothing past what the caller consumes is computed.  Stop after
+  END_TIME (inclusive) or after MAX_COUNT occurrences, if either is
+  provided; otherwise, recurring definitions without an until date
+  make for an endless stream."""
+  if clearance_index is None:
+    clearance_index = ClearanceIndex(occurrences)
+  heap = []
+  for i in range(len(definitions)):
+    dates = definitions[i].iter_dates(now_time, end_time)
+    try:
+      heap.append((dates.next(), definitions[i].get_description(), i, dates))
+    except StopIteration:
+      pass
+  heapq.heapify(heap)
+  counting = stats.enabled
+  count = 0
+  while heap:
+    if max_count is not None and count >= max_count:
+      break
+    date, description, i, dates = heap[0]
+    if counting:
+      stats.count('clearance_checks')
+    if not clearance_index.is_cleared(definitions[i], date):
+      if counting:
+        stats.count('occurrences_generated')
+      yield EventOccurrence(definitions[i], date)
+      count = count + 1
+    try:
+      heapq.heapreplace(heap, (dates.next(), description, i, dates))
+    except StopIteration:
+      heapq.heappop(heap)
+
+
+@stats.timed('past_query')
 def _get_past_occurrences(definitions, occurrences, now_time):
+  get_past_occurrences = getattr(occurrences, 'get_past_occurrences', None)
+  if get_past_occurrences is not None:
+    # An occurrence table (see table.py) answers by binary search.
+    return get_past_occurrences(now_time)
   past_occurrences = []
   for occurrence in occurrences:
     if (not occurrence.get_cleared()) and (occurrence.get_date() < now_time):
-      past_occurrences.append(occurrence)
+      cleared_through = occurrence.get_definition().cleared_through
+      if cleared_through is None or occurrence.get_date() > cleared_through:
+        past_occurrences.append(occurrence)
   return past_occurrences
 
 
-def _get_future_occurrences(definitions, occurrences, now_time, num_days):
+@stats.timed('future_query')
+def _get_future_occurrences(definitions, occurrences, now_time, num_days,
+                            clearance_index=None):
+  if clearance_index is None:
+    clearance_index = ClearanceIndex(occurrences)
   end_time = now_time + datetime.timedelta(num_days, 0, 0)
   future_occurrences = []
+  num_checks = 0
   for definition in definitions:
-    occ = definition.get_first_occurrence()
-    while 1:
-      if occ.get_date() >= now_time and occ.get_date() <= end_time:
-        future_occ = occ
-        for i in range(len(occurrences)):
-          if occurrences[i].get_definition() == future_occ.get_definition() \
-             and occurrences[i].get_date() == future_occ.get_date() \
-             and occurrences[i].get_cleared():
-            future_occ = None
-        if future_occ:
-          future_occurrences.append(future_occ)
-      occ = occ.next()
-      if occ is None:
-        break
-      if occ.get_date() > end_time:
-        break
+    for date in definition.iter_dates(now_time, end_time):
+      num_checks = num_checks + 1
+      if not clearance_index.is_cleared(definition, date):
+        future_occurrences.append(EventOccurrence(definition, date))
+  if stats.enabled:
+    stats.count('clearance_checks', num_checks)
+    stats.count('occurrences_generated', len(future_occurrences))
   return future_occurrences
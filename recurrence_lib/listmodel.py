@@ -0,0 +1,134 @@
+# ====================================================================
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ====================================================================
+
+"""listmodel.py:  Recurrence UI-independent event list model."""
+
+### The model holds the rows of an event listing -- uncleared past
+### occurrences, then upcoming ones -- each as a (key, columns) pair.
+### Rows are kept ordered by key, so the differences between two
+### listings can be found with a single merge walk over both.
+
+import events
+
+
+# Listing sections, in display order.
+SECTION_PAST = 0
+SECTION_FUTURE = 1
+
+# Change operations (see EventListModel.set_occurrences()).
+CHANGE_DELETE = 'delete'
+CHANGE_INSERT = 'insert'
+CHANGE_UPDATE = 'update'
+
+# Column titles, in display order.
+COLUMN_TITLES = ('Date', 'Description', 'Occurs')
+
+
+def _unparse_date(date):
+  if date is None:
+    return ''
+  else:
+    return "%d-%02d-%02d" % (date.year, date.month, date.day)
+
+
+def occurrence_to_row(occurrence, section, source=None):
+  """Return the (key, columns) row which displays OCCURRENCE, from data
+  file SOURCE (if known), in listing section SECTION."""
+  definition = occurrence.get_definition()
+  date = occurrence.get_date()
+  description = definition.get_description()
+  rec = definition.get_recurrence()
+  if rec:
+    rec = events.period_to_string(rec.get_period())
+  else:
+    rec = 'once'
+  key = (section, date, description, source, definition.get_uuid())
+  return key, (_unparse_date(date), description, rec)
+
+
+class EventListModel:
+  """An ordered listing of past and future event occurrences, with
+  enough smarts to tell its viewer exactly which rows changed between
+  refreshes.  Rows are addressed by index, as in a (virtual) list
+  control."""
+
+  def __init__(self):
+    self.rows = []
+    self.num_past = 0
+
+  def __len__(self):
+    return len(self.rows)
+
+  def get_row(self, index):
+    """Return the (key, columns) row at INDEX."""
+    return self.rows[index]
+
+  def get_item_text(self, index, column):
+    """Return the text of column COLUMN of the row at INDEX."""
+    return self.rows[index][1][column]
+
+  def is_past(self, index):
+    """Return True iff the row at INDEX is a past occurrence."""
+    return index < self.num_past
+
+  def get_counts(self):
+    """Return a 2-tuple containing the number of past and future rows."""
+    return self.num_past, len(self.rows) - self.num_past
+
+  def set_occurrences(self, past_occurrences, future_occurrences):
+    """Replace the listing with PAST_OCCURRENCES followed by
+    FUTURE_OCCURRENCES (each in any order, and each holding
+    EventOccurrences or (data file, EventOccurrence) pairs, as
+    multifile.MultiFileStore queries return), and return the list of
+    (operation, index, row) changes which transform the old listing
+    into the new one.  Operations are CHANGE_DELETE, CHANGE_INSERT and
+    CHANGE_UPDATE (the row's columns changed); indices assume the
+    changes are applied in order, and never decrease."""
+    rows = []
+    for section, occurrences in ((SECTION_PAST, past_occurrences),
+                                 (SECTION_FUTURE, future_occurrences)):
+      for occurrence in occurrences:
+        if isinstance(occurrence, tuple):
+          rows.append(occurrence_to_row(occurrence[1], section,
+                                        occurrence[0]))
+        else:
+          rows.append(occurrence_to_row(occurrence, section))
+      if section == SECTION_PAST:
+        num_past = len(rows)
+    rows.sort()
+    changes = self._diff(self.rows, rows)
+    self.rows = rows
+    self.num_past = num_past
+    return changes
+
+  def _diff(self, old_rows, new_rows):
+    changes = []
+    num_old = len(old_rows)
+    num_new = len(new_rows)
+    i = j = index = 0
+    while i < num_old or j < num_new:
+      if j == num_new or (i < num_old and old_rows[i][0] < new_rows[j][0]):
+        changes.append((CHANGE_DELETE, index, old_rows[i]))
+        i = i + 1
+      elif i == num_old or new_rows[j][0] < old_rows[i][0]:
+        changes.append((CHANGE_INSERT, index, new_rows[j]))
+        j = j + 1
+        index = index + 1
+      else:
+        if old_rows[i][1] != new_rows[j][1]:
+          changes.append((CHANGE_UPDATE, index, new_rows[j]))
+        i = i + 1
+        j = j + 1
+        index = index + 1
+    return changes
@@ -0,0 +1,199 @@
+# ====================================================================
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ====================================================================
+
+"""multifile.py:  Recurrence multiple data file loading and querying."""
+
+### Each data file is loaded into an EventStore of its own, so the
+### definitions of different files live in separate namespaces:  a
+### definition is identified by its (data file, uuid) pair, and two
+### files may hold the same uuid without one's clearances affecting
+### the other's occurrences.  Queries consult each file's store (whose
+### results are memoized) and merge the results in display order,
+### tagging each occurrence with its data file.  When only some files
+### change, only those are reloaded.
+###
+### Files are loaded concurrently by a pool of worker processes (the
+### work is parsing, which threads wouldn't spread across CPUs).  Each
+### worker sends its file's data back as a version 3 (binary) data
+### image, which is far cheaper to transfer and decode than pickled
+### objects.
+
+import cStringIO
+import heapq
+import multiprocessing
+import cache
+import events
+import stats
+import storage
+import store
+
+
+def _load_file(args):
+  # Load the data file at FILEPATH through the snapshot cache in
+  # CACHE_DIR, returning a 2-tuple of its (definitions, occurrences)
+  # and None, or of None and the exception which prevented loading it.
+  filepath, cache_dir = args
+  try:
+    return cache.load_data_file(filepath, cache_dir), None
+  except Exception, e:
+    return None, e
+
+
+def _load_file_packed(args):
+  # Worker entry point:  like _load_file(), but return the data as a
+  # version 3 data image (less the version line).
+  data, error = _load_file(args)
+  if error is not None:
+    return None, error
+  fp = cStringIO.StringIO()
+  storage._unparse_records_v3(fp, data[0], data[1])
+  return fp.getvalue(), None
+
+
+def load_data_files(filepaths, processes=None, pool=None,
+                    cache_dir=None):
+  """Load the data files at FILEPATHS (through the snapshot cache in
+  CACHE_DIR; see cache.load_data_file()), spread across PROCESSES
+  worker processes (by default, one per CPU) -- of POOL, a
+  multiprocessing.Pool, if provided -- when there's more than one file
+  to load.  Return a list with a 2-tuple for each file, in order:  its
+  (definitions, occurrences) and None, or None and the exception which
+  prevented loading it."""
+  if processes is None:
+    processes = multiprocessing.cpu_count()
+  jobs = [(filepath, cache_dir) for filepath in filepaths]
+  if len(jobs) < 2 or (processes < 2 and pool is None):
+    return map(_load_file, jobs)
+  if pool is None:
+    own_pool = multiprocessing.Pool(min(processes, len(jobs)))
+    try:
+      results = own_pool.map(_load_file_packed, jobs, 1)
+    finally:
+      own_pool.close()
+      own_pool.join()
+  else:
+    results = pool.map(_load_file_packed, jobs, 1)
+  loaded = []
+  for packed, error in results:
+    if error is not None:
+      loaded.append((None, error))
+    else:
+      loaded.append((storage.parse_data_file_v3(
+        cStringIO.StringIO(packed)), None))
+  return loaded
+
+
+class MultiFileStore:
+  """A set of Recurrence data files, loaded into a store.EventStore
+  apiece and queried as one.  Query results are lists of (data file,
+  EventOccurrence) pairs, in display order (see
+  events.occurrence_sort_key()), ties going to the file registered
+  first.  See load_data_files() for the meaning of PROCESSES, POOL and
+  CACHE_DIR."""
+
+  def __init__(self, filepaths=(), processes=None, pool=None,
+               cache_dir=None, cache_size=store.DEFAULT_CACHE_SIZE):
+    self.filepaths = []
+    self.stores = {}
+    self.processes = processes
+    self.pool = pool
+    self.cache_dir = cache_dir
+    self.cache_size = cache_size
+    for filepath in filepaths:
+      self.add_file(filepath)
+
+  def add_file(self, filepath):
+    """Register the data file at FILEPATH (without loading it; see
+    load())."""
+    if filepath not in self.filepaths:
+      self.filepaths.append(filepath)
+
+  def remove_file(self, filepath):
+    """Unregister the data file at FILEPATH, forgetting its data."""
+    self.filepaths.remove(filepath)
+    self.stores.pop(filepath, None)
+
+  def get_filepaths(self):
+    """Return a list of the registered data files' paths."""
+    return list(self.filepaths)
+
+  def get_store(self, filepath):
+    """Return the EventStore holding the data loaded from the data
+    file at FILEPATH, or None if it hasn't been loaded."""
+    return self.stores.get(filepath)
+
+  def get_definitions(self):
+    """Return a list of (data file, EventDefinition) pairs for the
+    loaded definitions."""
+    definitions = []
+    for filepath in self.filepaths:
+      if filepath in self.stores:
+        for definition in self.stores[filepath].get_definitions():
+          definitions.append((filepath, definition))
+    return definitions
+
+  @stats.timed('multifile_load')
+  def load(self, filepaths=None):
+    """(Re)load the registered data files at FILEPATHS (by default, all
+    of them) concurrently, registering any not yet registered.  A file
+    which can't be loaded keeps the data (if any) it last loaded.
+    Return a dictionary mapping the paths of such files to the
+    exceptions which prevented loading them."""
+    if filepaths is None:
+      filepaths = self.filepaths
+    filepaths = list(filepaths)
+    for filepath in filepaths:
+      self.add_file(filepath)
+    errors = {}
+    results = load_data_files(filepaths, self.processes, self.pool,
+                              self.cache_dir)
+    for filepath, (data, error) in zip(filepaths, results):
+      if error is not None:
+        errors[filepath] = error
+      else:
+        self.stores[filepath] = store.EventStore(data[0], data[1],
+                                                 self.cache_size)
+    return errors
+
+  def get_past_occurrences(self, now_date):
+    """Return the uncleared stored occurrences dated before NOW_DATE, as
+    (data file, EventOccurrence) pairs in display order."""
+    return self._merge(lambda es: es.get_past_occurrences(now_date))
+
+  def get_future_occurrences(self, now_date, num_days):
+    """Return the uncleared occurrences of the loaded definitions dated
+    from NOW_DATE through NUM_DAYS days later, as (data file,
+    EventOccurrence) pairs in display order."""
+    return self._merge(lambda es: es.get_future_occurrences(now_date,
+                                                            num_days))
+
+  def _merge(self, query):
+    # Merge the (display-ordered) results of QUERY, a function of an
+    # EventStore, over the loaded files' stores.
+    streams = []
+    for index in range(len(self.filepaths)):
+      filepath = self.filepaths[index]
+      if filepath in self.stores:
+        streams.append(self._tag(filepath, index,
+                                 query(self.stores[filepath])))
+    return [(source, occurrence)
+            for key, source, occurrence in heapq.merge(*streams)]
+
+  def _tag(self, filepath, index, occurrences):
+    # Generate OCCURRENCES, from the INDEX'th registered file FILEPATH,
+    # as (merge key, FILEPATH, occurrence) triples.
+    for i in range(len(occurrences)):
+      occurrence = occurrences[i]
+      yield ((events.occurrence_sort_key(occurrence), index, i),
+             filepath, occurrence)
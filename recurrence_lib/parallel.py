@@ -0,0 +1,116 @@
+# ====================================================================
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ====================================================================
+
+"""parallel.py:  Recurrence process-pool occurrence expansion."""
+
+### Definitions are flattened into columns (see batch.py) and split
+### into contiguous shards, which worker processes expand.  Shards
+### travel to and from the workers as packed integer strings rather
+### than pickled objects.  Each shard's results come back ordered by
+### (date, definition index), and since shards cover ascending ranges
+### of definitions, merging them yields exactly the single-process
+### ordering.
+
+import array
+import datetime
+import heapq
+import itertools
+import multiprocessing
+import batch
+import events
+
+
+# Definition count below which expansion stays in-process, where pool
+# startup and data transfer would cost more than they save.
+PARALLEL_THRESHOLD = 5000
+
+
+def _expand_shard(args):
+  # Worker entry point:  expand one shard of packed definition columns,
+  # returning packed (index, ordinal) columns.
+  starts, periods, untils, first, last, use_numpy = args
+  columns = []
+  for packed in (starts, periods, untils):
+    column = array.array('l')
+    column.fromstring(packed)
+    columns.append(column)
+  indices, ordinals = batch.expand_columns(columns[0], columns[1],
+                                           columns[2],
+                                           datetime.date.fromordinal(first),
+                                           datetime.date.fromordinal(last),
+                                           use_numpy)
+  return (array.array('l', map(int, indices)).tostring(),
+          array.array('l', map(int, ordinals)).tostring())
+
+
+def expand_definitions(definitions, start_date, end_date, processes=None,
+                       threshold=PARALLEL_THRESHOLD, pool=None,
+                       use_numpy=None):
+  """Like batch.expand_definitions(), but spread the work across
+  PROCESSES worker processes (by default, one per CPU) -- of POOL, a
+  multiprocessing.Pool, if provided -- when there are at least
+  THRESHOLD definitions.  The results are identical either way."""
+  if processes is None:
+    processes = multiprocessing.cpu_count()
+  if len(definitions) < max(threshold, 2) or processes < 2:
+    return batch.expand_definitions(definitions, start_date, end_date,
+                                    use_numpy)
+  starts, periods, untils = batch.definition_columns(definitions)
+  shard_size = -(-len(definitions) // processes)
+  offsets = range(0, len(definitions), shard_size)
+  shards = []
+  for offset in offsets:
+    shards.append((starts[offset:offset + shard_size].tostring(),
+                   periods[offset:offset + shard_size].tostring(),
+                   untils[offset:offset + shard_size].tostring(),
+                   start_date.toordinal(), end_date.toordinal(), use_numpy))
+  if pool is None:
+    own_pool = multiprocessing.Pool(processes)
+    try:
+      results = own_pool.map(_expand_shard, shards)
+    finally:
+      own_pool.close()
+      own_pool.join()
+  else:
+    results = pool.map(_expand_shard, shards)
+
+  streams = []
+  for offset, (packed_indices, packed_ordinals) in zip(offsets, results):
+    indices = array.array('l')
+    indices.fromstring(packed_indices)
+    ordinals = array.array('l')
+    ordinals.fromstring(packed_ordinals)
+    streams.append(itertools.izip(ordinals,
+                                  [index + offset for index in indices]))
+  indices = array.array('l')
+  ordinals = array.array('l')
+  for ordinal, index in heapq.merge(*streams):
+    indices.append(index)
+    ordinals.append(ordinal)
+  return indices, ordinals
+
+
+def get_future_occurrences(definitions, occurrences, now_time, num_days,
+                           clearance_index=None, processes=None,
+                           threshold=PARALLEL_THRESHOLD, pool=None):
+  """Parallel equivalent of batch.get_future_occurrences(); see
+  expand_definitions() for the meaning of PROCESSES, THRESHOLD and
+  POOL."""
+  if clearance_index is None:
+    clearance_index = events.ClearanceIndex(occurrences)
+  end_time = now_time + datetime.timedelta(num_days, 0, 0)
+  indices, ordinals = expand_definitions(definitions, now_time, end_time,
+                                         processes, threshold, pool)
+  return batch.occurrences_from_columns(definitions, indices, ordinals,
+                                        clearance_index)
@@ -0,0 +1,167 @@
+# ====================================================================
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ====================================================================
+
+"""scheduler.py:  Recurrence reminder scheduler."""
+
+### The scheduler keeps a min-heap holding each definition's next
+### occurrence date not yet reminded of.  When an occurrence falls due
+### (on its date, local time) the scheduler fires its callbacks --
+### unless the occurrence has been cleared -- and replaces the heap
+### entry with the definition's following date, in O(log n) time.
+### Between due dates there's nothing to do, so the scheduler can
+### sleep until local midnight of the next due date.
+
+import datetime
+import heapq
+import os
+import subprocess
+import sys
+import time
+import events
+
+
+# Default upper bound, in seconds, on a single sleep in
+# ReminderScheduler.run(), so that clock changes and (via the wakeup
+# hook) data file changes are noticed in reasonable time.
+MAX_SLEEP = 60
+
+
+def _get_midnight_time(date):
+  # Return the time (in seconds since the epoch) of local midnight at
+  # the start of DATE.
+  return time.mktime(date.timetuple())
+
+
+def stream_callback(stream=None):
+  """Return a reminder callback which writes a line describing each
+  due occurrence to STREAM (by default, sys.stdout)."""
+  def _callback(occurrence):
+    date = occurrence.get_date()
+    (stream or sys.stdout).write("%d-%02d-%02d | %s\n"
+                                 % (date.year, date.month, date.day,
+                                    occurrence.get_definition()
+                                    .get_description()))
+    (stream or sys.stdout).flush()
+  return _callback
+
+
+def command_callback(command):
+  """Return a reminder callback which runs shell command COMMAND for
+  each due occurrence, with the occurrence described by the
+  RECURRENCE_DATE, RECURRENCE_DESCRIPTION and RECURRENCE_UUID
+  environment variables."""
+  def _callback(occurrence):
+    definition = occurrence.get_definition()
+    env = os.environ.copy()
+    env['RECURRENCE_DATE'] = occurrence.get_date().isoformat()
+    env['RECURRENCE_DESCRIPTION'] = definition.get_description()
+    env['RECURRENCE_UUID'] = str(definition.get_uuid())
+    subprocess.call(command, shell=True, env=env)
+  return _callback
+
+
+class ReminderScheduler:
+  """Fires reminder callbacks for the uncleared occurrences of a set
+  of definitions as they fall due.  Each callback is called with the
+  due EventOccurrence.  Occurrences dated before the day the scheduler
+  starts aren't reminded of."""
+
+  def __init__(self, definitions, occurrences, callbacks=(),
+               clearance_index=None, today=None):
+    self.callbacks = list(callbacks)
+    self.reminded_through = None
+    self.load(definitions, occurrences, clearance_index, today)
+
+  def load(self, definitions, occurrences, clearance_index=None,
+           today=None):
+    """(Re)load the DEFINITIONS and OCCURRENCES to remind of, starting
+    from TODAY (by default, the current local date) or the day after
+    the last reminders fired, whichever is later.  CLEARANCE_INDEX, if
+    provided, is the events.ClearanceIndex of OCCURRENCES; keep it
+    current as occurrences are cleared."""
+    if clearance_index is None:
+      clearance_index = events.ClearanceIndex(occurrences)
+    if today is None:
+      today = datetime.date.today()
+    if self.reminded_through is not None:
+      today = max(today, self.reminded_through + datetime.timedelta(1))
+    self.definitions = definitions
+    self.clearance_index = clearance_index
+    self.heap = []
+    for i in range(len(definitions)):
+      dates = definitions[i].iter_dates(today)
+      try:
+        self.heap.append((dates.next(), i, dates))
+      except StopIteration:
+        pass
+    heapq.heapify(self.heap)
+
+  def add_callback(self, callback):
+    """Add CALLBACK to the callbacks fired for due occurrences."""
+    self.callbacks.append(callback)
+
+  def get_next_due_date(self):
+    """Return the date of the next occurrence to remind of, or None if
+    there are no more."""
+    if self.heap:
+      return self.heap[0][0]
+    return None
+
+  def run_pending(self, today=None):
+    """Fire the callbacks for each uncleared occurrence due by TODAY
+    (by default, the current local date) and not yet reminded of.
+    Return the list of occurrences reminded of."""
+    if today is None:
+      today = datetime.date.today()
+    reminded = []
+    heap = self.heap
+    while heap and heap[0][0] <= today:
+      date, i, dates = heap[0]
+      definition = self.definitions[i]
+      if not self.clearance_index.is_cleared(definition, date):
+        occurrence = events.EventOccurrence(definition, date)
+        reminded.append(occurrence)
+        for callback in self.callbacks:
+          callback(occurrence)
+      try:
+        heapq.heapreplace(heap, (dates.next(), i, dates))
+      except StopIteration:
+        heapq.heappop(heap)
+    if self.reminded_through is None or today > self.reminded_through:
+      self.reminded_through = today
+    return reminded
+
+  def get_wakeup_delay(self, now_time=None):
+    """Return the number of seconds from NOW_TIME (by default, the
+    current time) until the next occurrence falls due:  local midnight
+    of its date, or of tomorrow if it's already due (or if there are
+    no more occurrences)."""
+    if now_time is None:
+      now_time = time.time()
+    wakeup_date = datetime.date.fromtimestamp(now_time) \
+                  + datetime.timedelta(1)
+    if self.heap and self.heap[0][0] > wakeup_date:
+      wakeup_date = self.heap[0][0]
+    return max(0, _get_midnight_time(wakeup_date) - now_time)
+
+  def run(self, max_sleep=MAX_SLEEP, wakeup_hook=None):
+    """Remind of occurrences as they fall due, forever, sleeping in
+    between -- for at most MAX_SLEEP seconds at a time.  WAKEUP_HOOK,
+    if provided, is called after each sleep (before any reminders
+    fire), and may load() new data."""
+    while 1:
+      self.run_pending()
+      time.sleep(min(self.get_wakeup_delay(), max_sleep))
+      if wakeup_hook is not None:
+        wakeup_hook()
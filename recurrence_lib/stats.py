@@ -0,0 +1,138 @@
+# ====================================================================
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ====================================================================
+
+"""stats.py:  Recurrence instrumentation counters and timings."""
+
+### Instrumentation is off unless enabled (by enable(), or by setting
+### the RECURRENCE_STATS environment variable, which also dumps the
+### statistics to stderr at exit).  Instrumented code tests the module
+### global 'enabled' before doing any work, and hot loops keep local
+### tallies which are added in once, so that disabled instrumentation
+### costs next to nothing.
+###
+### Counters in use:
+###
+###    occurrences_generated   EventOccurrences made by recurrence
+###    clearance_checks        Clearance lookups made by future queries
+###    records_parsed          Data file records read
+###    records_written         Data file records written
+###    bytes_read              Data file bytes read
+###    bytes_written           Data file bytes written
+
+import atexit
+import functools
+import os
+import sys
+import time
+
+
+# True iff statistics are being gathered.
+enabled = False
+
+# Counter name -> count.
+_counters = {}
+
+# Phase name -> [number of calls, total seconds].
+_timings = {}
+
+# Callable invoked with (PHASE, SECONDS) after each timed call.
+_timing_hook = None
+
+
+def enable(flag=True):
+  """Start (or, if FLAG is False, stop) gathering statistics."""
+  global enabled
+  enabled = flag
+
+
+def count(name, amount=1):
+  """Add AMOUNT to the counter NAME.  Callers should test 'enabled'
+  first."""
+  _counters[name] = _counters.get(name, 0) + amount
+
+
+def add_time(phase, seconds):
+  """Record a call to PHASE which took SECONDS seconds.  Callers
+  should test 'enabled' first."""
+  timing = _timings.get(phase)
+  if timing is None:
+    timing = _timings[phase] = [0, 0.0]
+  timing[0] = timing[0] + 1
+  timing[1] = timing[1] + seconds
+  if _timing_hook is not None:
+    _timing_hook(phase, seconds)
+
+
+def set_timing_hook(hook):
+  """Arrange for HOOK (or, if None, nothing) to be called with the
+  phase name and duration in seconds after each timed call while
+  statistics are enabled.  Return the previous hook."""
+  global _timing_hook
+  old_hook = _timing_hook
+  _timing_hook = hook
+  return old_hook
+
+
+def timed(phase):
+  """Return a decorator which records the time spent in each call to
+  the decorated function as phase PHASE."""
+  def decorator(func):
+    def wrapper(*args, **kwargs):
+      if not enabled:
+        return func(*args, **kwargs)
+      start = time.time()
+      try:
+        return func(*args, **kwargs)
+      finally:
+        add_time(phase, time.time() - start)
+    return functools.wraps(func)(wrapper)
+  return decorator
+
+
+def snapshot():
+  """Return a copy of the statistics gathered so far, as a dictionary
+  with 'counters' (mapping names to counts) and 'timings' (mapping
+  phase names to dictionaries of 'calls' and 'seconds')."""
+  timings = {}
+  for phase, (calls, seconds) in _timings.items():
+    timings[phase] = {'calls': calls, 'seconds': seconds}
+  return {'counters': dict(_counters), 'timings': timings}
+
+
+def reset():
+  """Discard the statistics gathered so far."""
+  _counters.clear()
+  _timings.clear()
+
+
+def dump(stream=None):
+  """Write the statistics gathered so far to STREAM (by default,
+  sys.stderr)."""
+  stream = stream or sys.stderr
+  for name in sorted(_counters):
+    stream.write("%-24s %d\n" % (name, _counters[name]))
+  for phase in sorted(_timings):
+    calls, seconds = _timings[phase]
+    stream.write("%-24s %d calls, %.3f seconds\n" % (phase, calls, seconds))
+
+
+def dump_at_exit(stream=None):
+  """Enable statistics, and dump them to STREAM (by default,
+  sys.stderr) when the program exits."""
+  enable()
+  atexit.register(lambda: dump(stream))
+
+
+if os.environ.get('RECURRENCE_STATS'):
+  dump_at_exit()
@@ -17,118 +17,1076 @@
 
 import events
 import datetime
+import mmap
+import os
+import re
+import stat
+import stats
+import struct
+import tempfile
+import threading
 
 
 LATEST_VERSION = 1
 
+# Version 1 EventDefinition records carry the definition's uuid,
+# description and start date, optionally followed by its recurrence
+# period and until date.
+
+# Version 2 data files hold a version 1-style snapshot of records,
+# followed by an append-only journal of mutation records:
+# EventDefinition and EventOccurrence records (additions, in the same
+# syntax as the snapshot's), SetCleared records (which share the
+# EventOccurrence syntax), and ClearedThrough records (a definition
+# uuid and a cleared-through date).  A fixed-width header line carries
+# the byte offset at which the journal begins.  Definitions'
+# cleared-through dates are always recorded as ClearedThrough records,
+# the snapshot's following its definition records.
+JOURNAL_VERSION = 2
+JOURNAL_COMPACT_THRESHOLD = 1024 * 1024
+_JOURNAL_OFFSET_PREFIX = '#journal-offset = '
+_JOURNAL_OFFSET_FORMAT = _JOURNAL_OFFSET_PREFIX + '%010d\n'
+
+# Version 3 data files are binary.  After the version line comes a
+# header, followed by a table of fixed-width definition records, a
+# table of fixed-width occurrence records, and a heap of the strings
+# (uuids and descriptions) which the definition records reference.
+# Dates are stored as ordinals (0 meaning "none"), periods as period
+# codes, and each occurrence names its definition by table index.  The
+# header carries the record sizes, so that later revisions may append
+# fields to the records without breaking older readers.  (The
+# definition records' cleared-through date was appended that way;
+# _binary_definition_base is the record as it was before.)
+BINARY_VERSION = 3
+_binary_header = struct.Struct('<IIIHH')
+_binary_definition_base = struct.Struct('<IIIIIBI')
+_binary_definition = struct.Struct('<IIIIIBII')
+_binary_occurrence = struct.Struct('<IIB')
+
+# Version 4 data files are version 1 files whose EventDefinition
+# records may also carry the definition's cleared-through date (in
+# which case the recurrence fields are present, if empty).  Version 1
+# readers know nothing of cleared-through dates, so a file asked for in
+# version 1 is written in version 4 instead if (and only if) one of its
+# definitions has one.
+WATERMARK_VERSION = 4
+
+# A version 1 (or 4) data file may have a sidecar index file, which
+# maps each definition's uuid to the byte offsets of its records.  The
+# index notes the size and modification time of the data file it
+# describes, and is rebuilt when those go stale.
+INDEX_SUFFIX = '.idx'
+_INDEX_VERSION_PREFIX = '#index = 1\t'
+
+# Records purged from a data file are moved to an archive file (in the
+# same format) alongside it.
+ARCHIVE_SUFFIX = '.archive'
+
+_unescape_re = re.compile(r'\\(.)')
+_unescapes = {'r' : '\r', 'n' : '\n', 't' : '\t', '\\' : '\\'}
+
+
+def _unescape_piece(piece):
+  """Reverse the escaping of a data file field, in a single pass."""
+  if '\\' not in piece:
+    return piece
+  return _unescape_re.sub(lambda m: _unescapes.get(m.group(1), m.group(0)),
+                          piece)
+
+
+def _parse_date(datestr, dates):
+  """Parse DATESTR (YYYY-MM-DD), returning a datetime.date or None.
+  DATES is a cache of previously parsed dates, so that equal dates
+  share a single (immutable) date object."""
+  if datestr == '':
+    return None
+  date = dates.get(datestr)
+  if date is None:
+    if len(datestr) == 10 and datestr[4] == '-' and datestr[7] == '-':
+      date = datetime.date(int(datestr[0:4]),
+                           int(datestr[5:7]),
+                           int(datestr[8:10]))
+    else:
+      # Hand-edited files might not zero-pad their months and days.
+      date_pieces = map(int, datestr.split('-'))
+      assert len(date_pieces) == 3
+      date = datetime.date(date_pieces[0], date_pieces[1], date_pieces[2])
+    dates[datestr] = date
+  return date
+
+
+def _parse_pieces_v1(pieces, definitions, dates):
+  """Parse PIECES, the fields of a record from a version 1 (or 4) data
+  file, returning the EventDefinition or EventOccurrence it describes.
+  DEFINITIONS maps the uuids of previously parsed definitions to the
+  definitions themselves; DATES is a cache as used by _parse_date()."""
+  if pieces[0] == 'EventDefinition':
+    er = None
+    if len(pieces) > 4 and pieces[4]:
+      er = events.intern_recurrence(events.period_from_string(pieces[4]),
+                                    _parse_date(pieces[5], dates))
+    cleared_through = None
+    if len(pieces) > 6:
+      cleared_through = _parse_date(pieces[6], dates)
+    return events.EventDefinition(_unescape_piece(pieces[1]),
+                                  _unescape_piece(pieces[2]),
+                                  _parse_date(pieces[3], dates), er,
+                                  cleared_through)
+  elif pieces[0] == 'EventOccurrence':
+    return events.EventOccurrence(definitions[_unescape_piece(pieces[1])],
+                                  _parse_date(pieces[2], dates),
+                                  pieces[3] == 'true')
+  else:
+    raise Exception("Unrecognized record type.")
+
+
+def iter_data_file_v1(fp):
+  """Generate the records of the version 1 (or 4) data file open as FP
+  (and positioned just past its version line) as EventDefinition and
+  EventOccurrence objects, in file order.  Only the definitions are
+  retained between records, so memory use stays bounded by the
+  definition count when the caller doesn't collect the results."""
+  definitions = {}
+  dates = {}
+  EventOccurrence = events.EventOccurrence
+  for line in fp:
+    pieces = line.rstrip('\n\r').split('\t')
+    if pieces[0] == 'EventOccurrence':
+      # Occurrences make up the bulk of most files, so they get a
+      # streamlined version of _parse_pieces_v1()'s handling.
+      date = dates.get(pieces[2]) or _parse_date(pieces[2], dates)
+      yield EventOccurrence(definitions[_unescape_piece(pieces[1])],
+                            date, pieces[3] == 'true')
+    else:
+      record = _parse_pieces_v1(pieces, definitions, dates)
+      definitions[record.get_uuid()] = record
+      yield record
+
+
+def _collect_records(records):
+  """Sort RECORDS into a 2-tuple containing a list of EventDefinitions
+  and a list of EventOccurrences."""
+  definitions = []
+  occurrences = []
+  for record in records:
+    if isinstance(record, events.EventDefinition):
+      definitions.append(record)
+    else:
+      occurrences.append(record)
+  return definitions, occurrences
+
 
 def parse_data_file_v1(fp):
+  return _collect_records(iter_data_file_v1(fp))
+
+
+def _read_journal_offset(fp):
+  """Read the journal offset line from the version 2 data file open as
+  FP (and positioned just past its version line), returning the byte
+  offset at which the file's journal begins."""
+  offset_line = fp.readline().rstrip('\n\r')
+  if not offset_line.startswith(_JOURNAL_OFFSET_PREFIX):
+    raise Exception("Missing journal offset in journaled data file.")
+  return int(offset_line[len(_JOURNAL_OFFSET_PREFIX):])
+
+
+def parse_data_file_v2(fp):
+  """Parse the version 2 data file open as FP (and positioned just past
+  its version line), replaying its journal over its snapshot.  Return
+  a 2-tuple containing a list of EventDefinitions and a list of
+  EventOccurrences."""
+  _read_journal_offset(fp)
   definitions = {}
+  definition_list = []
   occurrences = []
+  occurrences_by_key = {}
+  dates = {}
+  cleared_through_uuids = set()
+  for line in fp:
+    pieces = line.rstrip('\n\r').split('\t')
+    if pieces[0] == 'ClearedThrough':
+      # Drop the records this makes redundant once the journal has been
+      # replayed, so as to make a single pass over the occurrences.
+      events.clear_through(definitions[_unescape_piece(pieces[1])],
+                           _parse_date(pieces[2], dates))
+      cleared_through_uuids.add(_unescape_piece(pieces[1]))
+      continue
+    elif pieces[0] == 'SetCleared':
+      pieces[0] = 'EventOccurrence'
+      record = _parse_pieces_v1(pieces, definitions, dates)
+      key = (record.get_definition().get_uuid(), record.get_date())
+      matches = occurrences_by_key.get(key)
+      if matches:
+        for occurrence in matches:
+          occurrence.set_cleared(record.get_cleared())
+        continue
+    else:
+      record = _parse_pieces_v1(pieces, definitions, dates)
+    if isinstance(record, events.EventDefinition):
+      definitions[record.get_uuid()] = record
+      definition_list.append(record)
+    else:
+      key = (record.get_definition().get_uuid(), record.get_date())
+      occurrences_by_key.setdefault(key, []).append(record)
+      occurrences.append(record)
+  if cleared_through_uuids:
+    # (Clearing through the earliest date leaves the definitions'
+    # cleared-through dates as they are, but drops their records.)
+    events.clear_through([definitions[uuid]
+                          for uuid in cleared_through_uuids],
+                         datetime.date.min, occurrences)
+  return definition_list, occurrences
 
-  def unescape_piece(piece):
-    piece = piece.replace('\\r', '\r')
-    piece = piece.replace('\\n', '\n')
-    piece = piece.replace('\\t', '\t')
-    piece = piece.replace('\\\\', '\\')
-    return piece
 
-  def parse_date(datestr):
-    if datestr == '':
-      return None
-    date_pieces = map(lambda x: int(x), datestr.split('-'))
-    assert len(date_pieces) == 3
-    return datetime.date(date_pieces[0], date_pieces[1], date_pieces[2])
-  
-  while 1:
-    line = fp.readline()
-    if not line:
-      break
-    line = line.rstrip('\n\r')
-    pieces = map(lambda x: unescape_piece(x), line.split('\t'))
-    if pieces[0] == 'EventDefinition':
-      er = None
-      if len(pieces) > 4:
-        er = events.EventRecurrence(events.period_from_string(pieces[4]),
-                                    parse_date(pieces[5]))
-      ed = events.EventDefinition(pieces[1], pieces[2],
-                                  parse_date(pieces[3]), er)
-      definitions[ed.get_uuid()] = ed
-    elif pieces[0] == 'EventOccurrence':
-      eo = events.EventOccurrence(definitions[pieces[1]],
-                                  parse_date(pieces[2]),
-                                  pieces[3] == 'true' and True or False)
-      occurrences.append(eo)
+def ordinal_to_date(ordinal, dates):
+  """Return the date with ORDINAL, or None if ORDINAL is 0.  DATES is a
+  cache of previously converted ordinals, so that equal dates share a
+  single date object."""
+  date = dates.get(ordinal)
+  if date is None and ordinal not in dates:
+    date = dates[ordinal] = datetime.date.fromordinal(ordinal)
+  return date
+
+
+def parse_binary_definitions(data, dates):
+  """Parse the header and definition records of DATA, the contents of
+  a version 3 data file past its version line, converting ordinals via
+  the cache DATES (see ordinal_to_date()).  Return a 4-tuple of the
+  list of EventDefinitions, the offset and size of the occurrence
+  records, and their number (see parse_binary_occurrences())."""
+  num_definitions, num_occurrences, heap_size, definition_size, \
+    occurrence_size = _binary_header.unpack_from(data, 0)
+  pos = _binary_header.size
+  heap_pos = pos + num_definitions * definition_size \
+             + num_occurrences * occurrence_size
+  if len(data) != heap_pos + heap_size:
+    raise Exception("Truncated or corrupt binary data file.")
+  to_date = lambda ordinal: ordinal_to_date(ordinal, dates)
+  definitions = []
+  if definition_size >= _binary_definition.size:
+    unpack_definition = _binary_definition.unpack_from
+  else:
+    # Written before definitions had cleared-through dates.
+    unpack_base = _binary_definition_base.unpack_from
+    unpack_definition = lambda data, pos: unpack_base(data, pos) + (0,)
+  for i in xrange(num_definitions):
+    uuid_pos, uuid_len, desc_pos, desc_len, start, period_code, until, \
+      cleared_through = unpack_definition(data, pos)
+    pos = pos + definition_size
+    uuid_pos = heap_pos + uuid_pos
+    desc_pos = heap_pos + desc_pos
+    er = None
+    if period_code != events.PERIOD_CODE_NONE:
+      er = events.intern_recurrence(events.period_from_code(period_code),
+                                    to_date(until))
+    definitions.append(
+      events.EventDefinition(data[uuid_pos:uuid_pos + uuid_len],
+                             data[desc_pos:desc_pos + desc_len],
+                             to_date(start), er,
+                             to_date(cleared_through)))
+  return definitions, pos, occurrence_size, num_occurrences
+
+
+def parse_binary_occurrences(data, pos, occurrence_size, num_occurrences):
+  """Parse the NUM_OCCURRENCES occurrence records, each OCCURRENCE_SIZE
+  bytes long, found at offset POS of DATA, the contents of a version 3
+  data file past its version line (see parse_binary_definitions()).
+  Return a 3-tuple of parallel sequences of the records' definition
+  indices, date ordinals and cleared flags (0 or 1), without making
+  an EventOccurrence apiece."""
+  if occurrence_size == _binary_occurrence.size:
+    # Unpack all the records in one go.
+    fields = struct.unpack_from('<' + 'IIB' * num_occurrences, data, pos)
+    return fields[0::3], fields[1::3], fields[2::3]
+  indices = []
+  ordinals = []
+  cleared = []
+  unpack_occurrence = _binary_occurrence.unpack_from
+  for i in xrange(num_occurrences):
+    index, ordinal, flag = unpack_occurrence(data, pos)
+    pos = pos + occurrence_size
+    indices.append(index)
+    ordinals.append(ordinal)
+    cleared.append(flag)
+  return indices, ordinals, cleared
+
+
+def parse_data_file_v3(fp):
+  """Parse the version 3 (binary) data file open as FP (and positioned
+  just past its version line).  Return a 2-tuple containing a list of
+  EventDefinitions and a list of EventOccurrences."""
+  data = fp.read()
+  dates = {0 : None}
+  definitions, pos, occurrence_size, num_occurrences = \
+    parse_binary_definitions(data, dates)
+  occurrences = []
+  unpack_occurrence = _binary_occurrence.unpack_from
+  EventOccurrence = events.EventOccurrence
+  for i in xrange(num_occurrences):
+    index, date, cleared = unpack_occurrence(data, pos)
+    pos = pos + occurrence_size
+    occurrences.append(EventOccurrence(definitions[index],
+                                       dates.get(date)
+                                       or ordinal_to_date(date, dates),
+                                       cleared and True or False))
+  return definitions, occurrences
+
+
+def read_version(fp):
+  """Read the version line from the data file open as FP, returning
+  the file's format version (or None, if it has no version line)."""
+  version_line = fp.readline().rstrip('\n\r')
+  if version_line.startswith('#version = '):
+    return int(version_line[11:])
+  return None
+
+
+def iter_data_file(filepath):
+  """Generate the records of the Recurrence data file at FILEPATH as
+  EventDefinition and EventOccurrence objects, in file order.  (See
+  iter_data_file_v1().)  Version 2 files must be replayed in full
+  before their records are known, and version 3 files are read in
+  one go, so both are parsed up front and their records generated
+  definitions first."""
+  fp = open(filepath, 'rb')
+  try:
+    version = read_version(fp)
+    if version in (1, WATERMARK_VERSION):
+      for record in iter_data_file_v1(fp):
+        yield record
+    elif version in (JOURNAL_VERSION, BINARY_VERSION):
+      if version == JOURNAL_VERSION:
+        definitions, occurrences = parse_data_file_v2(fp)
+      else:
+        definitions, occurrences = parse_data_file_v3(fp)
+      for record in definitions + occurrences:
+        yield record
     else:
-      raise Exception("Unrecognized record type.")
-  return definitions.values(), occurrences
+      raise Exception("Unrecognized data file format for file '%s'."
+                      % (filepath))
+  finally:
+    fp.close()
+
+
+def _count_read(fp, data):
+  # Tally the bytes read from FP and the records parsed into DATA, a
+  # (definitions, occurrences) 2-tuple.
+  stats.count('bytes_read', fp.tell())
+  stats.count('records_parsed', len(data[0]) + len(data[1]))
+
 
-      
+@stats.timed('read_data_file')
 def read_data_file(filepath):
-  """Parse a Recurrence data file, returning"""
-  version = None
-  fp = open(filepath, 'r')
+  """Parse a Recurrence data file, returning a 2-tuple containing a
+  list of EventDefinitions and a list of EventOccurrences."""
+  fp = open(filepath, 'rb')
   try:
-    version_line = fp.readline().rstrip('\n\r')
-    if version_line.startswith('#version = '):
-      version = int(version_line[11:])
-    if version == 1:
-      return parse_data_file_v1(fp)
+    version = read_version(fp)
+    if version in (1, WATERMARK_VERSION):
+      data = parse_data_file_v1(fp)
+    elif version == JOURNAL_VERSION:
+      data = parse_data_file_v2(fp)
+    elif version == BINARY_VERSION:
+      data = parse_data_file_v3(fp)
     else:
       raise Exception("Unrecognized data file format for file '%s'."
                       % (filepath))
-  except:
-    raise
+    if stats.enabled:
+      _count_read(fp, data)
+    return data
+  finally:
+    fp.close()
   
 
-def unparse_date_file_v1(filepath, definitions, occurrences):
+def _escape_piece(piece):
+  piece = str(piece)
+  piece = piece.replace('\\', '\\\\')
+  piece = piece.replace('\t', '\\t')
+  piece = piece.replace('\n', '\\n')
+  piece = piece.replace('\r', '\\r')
+  return piece
 
-  def escape_piece(piece):
-    piece = str(piece)
-    piece = piece.replace('\\', '\\\\')
-    piece = piece.replace('\t', '\\t')
-    piece = piece.replace('\n', '\\n')
-    piece = piece.replace('\r', '\\r')
-    return piece
 
-  def unparse_date(date):
-    if date is None:
-      return ''
-    else:
-      return "%d-%02d-%02d" % (date.year, date.month, date.day)
-  
-  def unparse_pieces(pieces):
-    return '\t'.join(map(lambda x: escape_piece(x), pieces)) + '\n'
-
-  def definition_to_pieces(definition):
-    pieces = ['EventDefinition',
-              definition.get_uuid(),
-              definition.get_description(),
-              unparse_date(definition.get_start_date()),
-              ]
-    recurrence = definition.get_recurrence()
-    if recurrence:
-      pieces.extend([events.period_to_string(recurrence.get_period()),
-                     unparse_date(recurrence.get_until_date()),
-                     ])
-    return pieces
-
-  def occurrence_to_pieces(occurrence):
-    return ['EventOccurrence',
-            occurrence.get_definition().get_uuid(),
-            unparse_date(occurrence.get_date()),
-            occurrence.get_cleared() and 'true' or 'false',
+def _unparse_date(date):
+  if date is None:
+    return ''
+  else:
+    return "%d-%02d-%02d" % (date.year, date.month, date.day)
+
+
+def _unparse_pieces(pieces):
+  return '\t'.join(map(lambda x: _escape_piece(x), pieces)) + '\n'
+
+
+def _definition_to_pieces(definition, with_cleared_through=True):
+  # Return the fields of DEFINITION's record, including its
+  # cleared-through date, if it has one, and WITH_CLEARED_THROUGH is
+  # set.  (Version 1 and 2 records can't include it.)
+  pieces = ['EventDefinition',
+            definition.get_uuid(),
+            definition.get_description(),
+            _unparse_date(definition.get_start_date()),
             ]
-    
+  recurrence = definition.get_recurrence()
+  if recurrence:
+    pieces.extend([events.period_to_string(recurrence.get_period()),
+                   _unparse_date(recurrence.get_until_date()),
+                   ])
+  cleared_through = definition.get_cleared_through()
+  if cleared_through is not None and with_cleared_through:
+    if not recurrence:
+      pieces.extend(['', ''])
+    pieces.append(_unparse_date(cleared_through))
+  return pieces
+
+
+def _cleared_through_to_pieces(definition):
+  return ['ClearedThrough',
+          definition.get_uuid(),
+          _unparse_date(definition.get_cleared_through()),
+          ]
+
+
+def _has_cleared_through(definitions):
+  for definition in definitions:
+    if definition.get_cleared_through() is not None:
+      return True
+  return False
+
+
+def _occurrence_to_pieces(occurrence):
+  return ['EventOccurrence',
+          occurrence.get_definition().get_uuid(),
+          _unparse_date(occurrence.get_date()),
+          occurrence.get_cleared() and 'true' or 'false',
+          ]
+
+
+def _unparse_records_v1(fp, definitions, occurrences,
+                        with_cleared_through=True):
+  for definition in definitions:
+    fp.write(_unparse_pieces(_definition_to_pieces(definition,
+                                                   with_cleared_through)))
+  for occurrence in occurrences:
+    fp.write(_unparse_pieces(_occurrence_to_pieces(occurrence)))
+
+
+def unparse_date_file_v1(filepath, definitions, occurrences):
+  assert not _has_cleared_through(definitions)
   fp = open(filepath, 'w')
   fp.write('#version = 1\n')
+  _unparse_records_v1(fp, definitions, occurrences)
+  fp.close()
+
+
+def unparse_data_file_v2(filepath, definitions, occurrences):
+  """Write DEFINITIONS and OCCURRENCES to FILEPATH as a version 2
+  (journaled) data file with an empty journal."""
+  fp = open(filepath, 'w')
+  fp.write('#version = 2\n')
+  offset_pos = fp.tell()
+  fp.write(_JOURNAL_OFFSET_FORMAT % (0))
+  _unparse_records_v1(fp, definitions, occurrences, False)
+  for definition in definitions:
+    if definition.get_cleared_through() is not None:
+      fp.write(_unparse_pieces(_cleared_through_to_pieces(definition)))
+  journal_offset = fp.tell()
+  fp.seek(offset_pos)
+  fp.write(_JOURNAL_OFFSET_FORMAT % (journal_offset))
+  fp.close()
+
+
+def _unparse_records_v3(fp, definitions, occurrences):
+  """Write DEFINITIONS and OCCURRENCES to the file open as FP in the
+  version 3 (binary) format, less the version line."""
+  heap = []
+  heap_offsets = {}
+  heap_size = [0]
+  def heap_add(string):
+    offset = heap_offsets.get(string)
+    if offset is None:
+      offset = heap_offsets[string] = heap_size[0]
+      heap.append(string)
+      heap_size[0] = heap_size[0] + len(string)
+    return offset, len(string)
+  def date_to_ordinal(date):
+    return date and date.toordinal() or 0
+
+  records = []
+  indices = {}
+  pack_definition = _binary_definition.pack
   for definition in definitions:
-    fp.write(unparse_pieces(definition_to_pieces(definition)))
+    uuid = str(definition.get_uuid())
+    indices[uuid] = len(indices)
+    uuid_pos, uuid_len = heap_add(uuid)
+    desc_pos, desc_len = heap_add(definition.get_description())
+    recurrence = definition.get_recurrence()
+    if recurrence:
+      period_code = events.period_to_code(recurrence.get_period())
+      until = date_to_ordinal(recurrence.get_until_date())
+    else:
+      period_code = events.PERIOD_CODE_NONE
+      until = 0
+    records.append(pack_definition(uuid_pos, uuid_len, desc_pos, desc_len,
+                                   date_to_ordinal(definition.get_start_date()),
+                                   period_code, until,
+                                   date_to_ordinal(
+                                     definition.get_cleared_through())))
+  pack_occurrence = _binary_occurrence.pack
   for occurrence in occurrences:
-    fp.write(unparse_pieces(occurrence_to_pieces(occurrence)))
+    uuid = str(occurrence.get_definition().get_uuid())
+    try:
+      index = indices[uuid]
+    except KeyError:
+      raise Exception("Occurrence of unknown event definition '%s'."
+                      % (uuid))
+    records.append(pack_occurrence(index,
+                                   date_to_ordinal(occurrence.get_date()),
+                                   occurrence.get_cleared() and 1 or 0))
+
+  fp.write(_binary_header.pack(len(definitions), len(occurrences),
+                               heap_size[0], _binary_definition.size,
+                               _binary_occurrence.size))
+  fp.write(''.join(records))
+  fp.write(''.join(heap))
+
+
+def unparse_data_file_v4(filepath, definitions, occurrences):
+  """Write DEFINITIONS and OCCURRENCES to FILEPATH as a version 4 data
+  file (a version 1 file with cleared-through dates)."""
+  fp = open(filepath, 'w')
+  fp.write('#version = 4\n')
+  _unparse_records_v1(fp, definitions, occurrences)
   fp.close()
 
 
+def unparse_data_file_v3(filepath, definitions, occurrences):
+  """Write DEFINITIONS and OCCURRENCES to FILEPATH as a version 3
+  (binary) data file."""
+  fp = open(filepath, 'wb')
+  fp.write('#version = 3\n')
+  _unparse_records_v3(fp, definitions, occurrences)
+  fp.close()
+
+
+def _replace_file(filepath, unparse_func, args=(), fsync=False):
+  """Atomically replace the file at FILEPATH with one written by
+  UNPARSE_FUNC, which is called with a temporary file path followed by
+  the items of ARGS.  If FSYNC is set, flush the new file to disk
+  before it replaces the old one.  The new file takes the old one's
+  permissions, and if FILEPATH is a symbolic link, the file it points
+  to is replaced (leaving the link be)."""
+  filepath = os.path.realpath(filepath)
+  dirname, basename = os.path.split(filepath)
+  fd, temp_filepath = tempfile.mkstemp(prefix='.' + basename + '.',
+                                       dir=dirname)
+  os.close(fd)
+  try:
+    unparse_func(temp_filepath, *args)
+    if os.path.exists(filepath):
+      # mkstemp() makes files readable only by their owner.
+      os.chmod(temp_filepath, stat.S_IMODE(os.stat(filepath).st_mode))
+    if fsync:
+      fd = os.open(temp_filepath, os.O_RDONLY)
+      try:
+        os.fsync(fd)
+      finally:
+        os.close(fd)
+    if os.name == 'nt' and os.path.exists(filepath):
+      # Windows won't rename over an existing file.
+      os.remove(filepath)
+    os.rename(temp_filepath, filepath)
+  except:
+    if os.path.exists(temp_filepath):
+      os.remove(temp_filepath)
+    raise
+
+
+@stats.timed('write_data_file')
 def write_data_file(filepath, definitions, occurrences, version=LATEST_VERSION):
-  assert(version == LATEST_VERSION)
-  unparse_date_file_v1(filepath, definitions, occurrences)
+  assert(version in (1, JOURNAL_VERSION, BINARY_VERSION, WATERMARK_VERSION))
+  if version == JOURNAL_VERSION:
+    unparse_data_file_v2(filepath, definitions, occurrences)
+  elif version == BINARY_VERSION:
+    unparse_data_file_v3(filepath, definitions, occurrences)
+  elif version == WATERMARK_VERSION or _has_cleared_through(definitions):
+    unparse_data_file_v4(filepath, definitions, occurrences)
+  else:
+    unparse_date_file_v1(filepath, definitions, occurrences)
+  if stats.enabled:
+    stats.count('bytes_written', os.path.getsize(filepath))
+    stats.count('records_written', len(definitions) + len(occurrences))
+
+
+def convert_data_file(src_filepath, dst_filepath, version):
+  """Losslessly convert the data file at SRC_FILEPATH, of any supported
+  version, to a version VERSION data file at DST_FILEPATH."""
+  definitions, occurrences = read_data_file(src_filepath)
+  write_data_file(dst_filepath, definitions, occurrences, version)
+
+
+class DataFileWriter:
+  """Group-commit writer for a Recurrence data file.  Mutations made
+  through the writer are applied to its definitions and occurrences
+  immediately, but written out together:  when BATCH_SIZE of them are
+  pending, when DELAY seconds have passed since the first pending one,
+  or when flush() or close() is called (as when leaving a 'with'
+  block).  Each flush atomically replaces the data file, syncing it to
+  disk first if FSYNC is set."""
+
+  def __init__(self, filepath, definitions, occurrences, delay=None,
+               batch_size=None, fsync=False, version=LATEST_VERSION):
+    self.filepath = filepath
+    self.definitions = definitions
+    self.occurrences = occurrences
+    self.delay = delay
+    self.batch_size = batch_size
+    self.fsync = fsync
+    self.version = version
+    self.num_pending = 0
+    self.timer = None
+    self.lock = threading.RLock()
+    self.occurrences_by_key = {}
+    for occurrence in occurrences:
+      self.occurrences_by_key.setdefault(self._key(occurrence),
+                                         []).append(occurrence)
+
+  def _key(self, occurrence):
+    return occurrence.get_definition().get_uuid(), occurrence.get_date()
+
+  def _mutated(self):
+    # Note a new pending mutation, flushing or arming the timer as
+    # warranted.  Called with the lock held.
+    self.num_pending = self.num_pending + 1
+    if self.batch_size is not None and self.num_pending >= self.batch_size:
+      self.flush()
+    elif self.delay is not None and self.timer is None:
+      self.timer = threading.Timer(self.delay, self.flush)
+      self.timer.setDaemon(True)
+      self.timer.start()
+
+  def add_definition(self, definition):
+    """Add DEFINITION to the data."""
+    self.lock.acquire()
+    try:
+      self.definitions.append(definition)
+      self._mutated()
+    finally:
+      self.lock.release()
+
+  def add_occurrence(self, occurrence):
+    """Add OCCURRENCE to the data."""
+    self.lock.acquire()
+    try:
+      self.occurrences.append(occurrence)
+      self.occurrences_by_key.setdefault(self._key(occurrence),
+                                         []).append(occurrence)
+      self._mutated()
+    finally:
+      self.lock.release()
+
+  def set_cleared(self, occurrence, cleared=True):
+    """Set the clearance flag of OCCURRENCE, and of any stored
+    occurrences of the same event on the same date, to CLEARED.  If no
+    such occurrence is stored, add OCCURRENCE to the data."""
+    self.lock.acquire()
+    try:
+      occurrence.set_cleared(cleared)
+      matches = self.occurrences_by_key.get(self._key(occurrence))
+      if matches:
+        for match in matches:
+          match.set_cleared(cleared)
+        self._mutated()
+      else:
+        self.add_occurrence(occurrence)
+    finally:
+      self.lock.release()
+
+  def clear_through(self, definitions, date):
+    """Clear every occurrence of DEFINITIONS (a list of
+    EventDefinitions, or a single one) dated on or before DATE, and
+    drop the records that makes redundant.  See
+    events.clear_through()."""
+    self.lock.acquire()
+    try:
+      removed = events.clear_through(definitions, date, self.occurrences)
+      for occurrence in removed:
+        key = self._key(occurrence)
+        matches = self.occurrences_by_key[key]
+        matches.remove(occurrence)
+        if not matches:
+          del self.occurrences_by_key[key]
+      self._mutated()
+    finally:
+      self.lock.release()
+
+  def flush(self):
+    """Write out any pending mutations."""
+    self.lock.acquire()
+    try:
+      if self.timer is not None:
+        self.timer.cancel()
+        self.timer = None
+      if self.num_pending:
+        _replace_file(self.filepath, write_data_file,
+                      (self.definitions, self.occurrences, self.version),
+                      self.fsync)
+        self.num_pending = 0
+    finally:
+      self.lock.release()
+
+  def close(self):
+    """Write out any pending mutations."""
+    self.flush()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+    return False
+
+
+def compact_data_file(filepath):
+  """Fold the journal of the version 2 data file at FILEPATH back into
+  its snapshot, atomically rewriting the file with an empty journal."""
+  definitions, occurrences = read_data_file(filepath)
+  _replace_file(filepath, unparse_data_file_v2, (definitions, occurrences))
+
+
+def _append_to_journal(filepath, pieces_list, compact_threshold):
+  fp = open(filepath, 'r')
+  try:
+    version = read_version(fp)
+    if version != JOURNAL_VERSION:
+      raise Exception("Data file '%s' is not a journaled (version %d) "
+                      "data file." % (filepath, JOURNAL_VERSION))
+    journal_offset = _read_journal_offset(fp)
+  finally:
+    fp.close()
+  fp = open(filepath, 'a')
+  try:
+    for pieces in pieces_list:
+      line = _unparse_pieces(pieces)
+      fp.write(line)
+      if stats.enabled:
+        stats.count('bytes_written', len(line))
+        stats.count('records_written')
+  finally:
+    fp.close()
+  if compact_threshold is not None \
+     and os.path.getsize(filepath) - journal_offset > compact_threshold:
+    compact_data_file(filepath)
+
+
+def journal_add_definition(filepath, definition,
+                           compact_threshold=JOURNAL_COMPACT_THRESHOLD):
+  """Record the addition of DEFINITION in the journal of the version 2
+  data file at FILEPATH.  If the journal then holds more than
+  COMPACT_THRESHOLD bytes, compact the file (see compact_data_file()).
+  Pass None for COMPACT_THRESHOLD to suppress automatic compaction."""
+  pieces_list = [_definition_to_pieces(definition, False)]
+  if definition.get_cleared_through() is not None:
+    pieces_list.append(_cleared_through_to_pieces(definition))
+  _append_to_journal(filepath, pieces_list, compact_threshold)
+
+
+def journal_add_occurrence(filepath, occurrence,
+                           compact_threshold=JOURNAL_COMPACT_THRESHOLD):
+  """Record the addition of OCCURRENCE in the journal of the version 2
+  data file at FILEPATH.  See journal_add_definition()."""
+  _append_to_journal(filepath, [_occurrence_to_pieces(occurrence)],
+                     compact_threshold)
+
+
+def journal_set_cleared(filepath, occurrence,
+                        compact_threshold=JOURNAL_COMPACT_THRESHOLD):
+  """Record the current clearance flag of OCCURRENCE in the journal of
+  the version 2 data file at FILEPATH.  OCCURRENCE needn't have been
+  stored before; if it wasn't, replaying the journal will add it.  See
+  journal_add_definition()."""
+  pieces = _occurrence_to_pieces(occurrence)
+  pieces[0] = 'SetCleared'
+  _append_to_journal(filepath, [pieces], compact_threshold)
+
+
+def journal_clear_through(filepath, definition,
+                          compact_threshold=JOURNAL_COMPACT_THRESHOLD):
+  """Record the current cleared-through date of DEFINITION in the
+  journal of the version 2 data file at FILEPATH.  Replaying the
+  journal drops the occurrence records that date makes redundant, as
+  does compaction.  See journal_add_definition()."""
+  assert definition.get_cleared_through() is not None
+  _append_to_journal(filepath, [_cleared_through_to_pieces(definition)],
+                     compact_threshold)
+
+
+def get_archive_path(filepath):
+  """Return the path of the archive file for the data file at
+  FILEPATH."""
+  return filepath + ARCHIVE_SUFFIX
+
+
+def _split_dead_records(definitions, occurrences, before):
+  # Return a 4-tuple of the live and dead DEFINITIONS and the live and
+  # dead OCCURRENCES.  A definition is dead if it has no occurrences
+  # on or after BEFORE and no uncleared stored occurrences; an
+  # occurrence is dead if its definition is, or if it is cleared and
+  # dated before BEFORE.
+  def is_cleared(occurrence):
+    cleared_through = occurrence.get_definition().get_cleared_through()
+    return occurrence.get_cleared() or (cleared_through is not None and
+                                        occurrence.get_date()
+                                        <= cleared_through)
+  uncleared_uuids = set()
+  for occurrence in occurrences:
+    if not is_cleared(occurrence):
+      uncleared_uuids.add(occurrence.get_definition().get_uuid())
+  live_definitions = []
+  dead_definitions = []
+  for definition in definitions:
+    if definition.get_uuid() in uncleared_uuids \
+       or definition.get_first_date_on_or_after(before) is not None:
+      live_definitions.append(definition)
+    else:
+      dead_definitions.append(definition)
+  dead_uuids = set([definition.get_uuid() for definition in dead_definitions])
+  live_occurrences = []
+  dead_occurrences = []
+  for occurrence in occurrences:
+    if occurrence.get_definition().get_uuid() in dead_uuids \
+       or (occurrence.get_date() < before and is_cleared(occurrence)):
+      dead_occurrences.append(occurrence)
+    else:
+      live_occurrences.append(occurrence)
+  return live_definitions, dead_definitions, live_occurrences, \
+         dead_occurrences
+
+
+@stats.timed('purge_data_file')
+def purge_data_file(filepath, before=None, archive_filepath=None):
+  """Move the dead records of the data file at FILEPATH -- definitions
+  which recur no more on or after BEFORE (by default, and at latest,
+  today) and have no uncleared stored occurrences, their occurrences,
+  and cleared occurrences dated before BEFORE -- to the archive file at
+  ARCHIVE_FILEPATH (by default, get_archive_path(FILEPATH)), adding to
+  any records already archived there.  The archive is written in the
+  data file's format, and holds a copy of each live definition whose
+  occurrences it holds.  Both files are replaced atomically, the
+  archive first, so that no records are lost if we're interrupted.
+  Return a 3-tuple of the numbers of definitions and occurrences
+  purged and the number of bytes by which the data file shrank."""
+  if before is None:
+    before = datetime.date.today()
+  # Cleared future occurrences are the only record of their clearance,
+  # so only past records are ever purged.
+  before = min(before, datetime.date.today())
+  if archive_filepath is None:
+    archive_filepath = get_archive_path(filepath)
+  fp = open(filepath, 'rb')
+  try:
+    version = read_version(fp)
+  finally:
+    fp.close()
+  definitions, occurrences = read_data_file(filepath)
+  live_definitions, dead_definitions, live_occurrences, dead_occurrences = \
+    _split_dead_records(definitions, occurrences, before)
+  if not (dead_definitions or dead_occurrences):
+    return 0, 0, 0
+
+  if os.path.exists(archive_filepath):
+    archived_definitions, archived_occurrences = \
+      read_data_file(archive_filepath)
+  else:
+    archived_definitions, archived_occurrences = [], []
+  archived_uuids = {}
+  for definition in archived_definitions:
+    archived_uuids[definition.get_uuid()] = len(archived_uuids)
+  def archive_definition(definition):
+    # Archive DEFINITION, superseding any older copy of it.
+    index = archived_uuids.get(definition.get_uuid())
+    if index is None:
+      archived_uuids[definition.get_uuid()] = len(archived_definitions)
+      archived_definitions.append(definition)
+    else:
+      archived_definitions[index] = definition
+  for definition in dead_definitions:
+    archive_definition(definition)
+  for occurrence in dead_occurrences:
+    archive_definition(occurrence.get_definition())
+  # Point the previously archived occurrences at the current copies of
+  # their definitions.
+  for occurrence in archived_occurrences:
+    definition = occurrence.get_definition()
+    occurrence.set_definition(
+      archived_definitions[archived_uuids[definition.get_uuid()]])
+  archived_occurrences.extend(dead_occurrences)
+
+  old_size = os.path.getsize(filepath)
+  _replace_file(archive_filepath, write_data_file,
+                (archived_definitions, archived_occurrences, version))
+  _replace_file(filepath, write_data_file,
+                (live_definitions, live_occurrences, version))
+  return len(dead_definitions), len(dead_occurrences), \
+         old_size - os.path.getsize(filepath)
+
+
+def read_data_file_with_archive(filepath, archive_filepath=None):
+  """Like read_data_file(), but add the records archived from the data
+  file at FILEPATH (see purge_data_file()) to those still in it:  the
+  archived definitions not in the data file, and all archived
+  occurrences (which come first).  Archived occurrences of definitions
+  still in the data file refer to the data file's copies."""
+  definitions, occurrences = read_data_file(filepath)
+  if archive_filepath is None:
+    archive_filepath = get_archive_path(filepath)
+  if not os.path.exists(archive_filepath):
+    return definitions, occurrences
+  archived_definitions, archived_occurrences = \
+    read_data_file(archive_filepath)
+  live_definitions = {}
+  for definition in definitions:
+    live_definitions[definition.get_uuid()] = definition
+  for definition in archived_definitions:
+    if definition.get_uuid() not in live_definitions:
+      definitions.append(definition)
+  for occurrence in archived_occurrences:
+    definition = live_definitions.get(occurrence.get_definition().get_uuid())
+    if definition is not None:
+      occurrence.set_definition(definition)
+  return definitions, archived_occurrences + occurrences
+
+
+def get_index_path(filepath):
+  """Return the path of the sidecar index file for the data file at
+  FILEPATH."""
+  return filepath + INDEX_SUFFIX
+
+
+def _get_index_stamp(filepath):
+  st = os.stat(filepath)
+  return '%d\t%r' % (st.st_size, st.st_mtime)
+
+
+def build_data_file_index(filepath):
+  """Build (or rebuild) the sidecar index file for the version 1 (or 4)
+  data file at FILEPATH, and return the index:  a dictionary mapping each
+  definition uuid to a 2-tuple of the byte offset of its definition
+  record and a list of the byte offsets of its occurrence records."""
+  stamp = _get_index_stamp(filepath)
+  index = {}
+  fp = open(filepath, 'rb')
+  try:
+    if read_version(fp) not in (1, WATERMARK_VERSION):
+      raise Exception("Only version 1 and 4 data files may be indexed.")
+    offset = fp.tell()
+    for line in fp:
+      pieces = line.split('\t', 2)
+      uuid = _unescape_piece(pieces[1].rstrip('\n\r'))
+      if pieces[0] == 'EventDefinition':
+        index[uuid] = (offset, [])
+      elif pieces[0] == 'EventOccurrence':
+        index[uuid][1].append(offset)
+      else:
+        raise Exception("Unrecognized record type.")
+      offset = offset + len(line)
+  finally:
+    fp.close()
+  def unparse_index(index_filepath):
+    fp = open(index_filepath, 'wb')
+    fp.write(_INDEX_VERSION_PREFIX + stamp + '\n')
+    for uuid, (definition_offset, occurrence_offsets) in index.items():
+      fp.write('%s\t%d\t%s\n'
+               % (_escape_piece(uuid), definition_offset,
+                  ','.join(map(str, occurrence_offsets))))
+    fp.close()
+  _replace_file(get_index_path(filepath), unparse_index)
+  return index
+
+
+def _parse_index_entry(line):
+  uuid, definition_offset, occurrence_offsets = \
+    line.rstrip('\n\r').split('\t')
+  if occurrence_offsets:
+    occurrence_offsets = map(int, occurrence_offsets.split(','))
+  else:
+    occurrence_offsets = []
+  return _unescape_piece(uuid), (int(definition_offset), occurrence_offsets)
+
+
+def _read_data_file_index(filepath, uuid=None):
+  # Return the index in the sidecar index file for FILEPATH, or None if
+  # there is no such file or it is stale.  If UUID is provided, parse
+  # only its entry, returning an index containing only that uuid (or
+  # nothing at all, if UUID isn't indexed).
+  try:
+    fp = open(get_index_path(filepath), 'rb')
+  except IOError:
+    return None
+  try:
+    if fp.readline() != _INDEX_VERSION_PREFIX \
+                        + _get_index_stamp(filepath) + '\n':
+      return None
+    index = {}
+    if uuid is None:
+      for line in fp:
+        key, entry = _parse_index_entry(line)
+        index[key] = entry
+    else:
+      prefix = _escape_piece(uuid) + '\t'
+      for line in fp:
+        if line.startswith(prefix):
+          key, entry = _parse_index_entry(line)
+          index[key] = entry
+          break
+    return index
+  finally:
+    fp.close()
+
+
+def get_data_file_index(filepath):
+  """Return the index for the version 1 (or 4) data file at FILEPATH
+  (see build_data_file_index()), from its sidecar index file if that is
+  current, or by rebuilding the sidecar index file otherwise."""
+  index = _read_data_file_index(filepath)
+  if index is None:
+    index = build_data_file_index(filepath)
+  return index
+
+
+def read_definition(filepath, uuid, index=None):
+  """Read from the version 1 (or 4) data file at FILEPATH only the
+  definition with UUID and its occurrences, returning a 2-tuple of the
+  EventDefinition and a list of EventOccurrences.  The records are
+  located via INDEX, if provided, or else via the file's sidecar index
+  (see get_data_file_index()), and read through a memory-mapped view
+  of the file without parsing any other records.  Raise KeyError if
+  there is no such definition."""
+  if index is None:
+    index = _read_data_file_index(filepath, uuid)
+    if index is None:
+      index = build_data_file_index(filepath)
+  definition_offset, occurrence_offsets = index[uuid]
+  fp = open(filepath, 'rb')
+  try:
+    view = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+  finally:
+    fp.close()
+  try:
+    def read_pieces(offset):
+      end = view.find('\n', offset)
+      if end == -1:
+        end = view.size()
+      return view[offset:end].rstrip('\r').split('\t')
+    definitions = {}
+    dates = {}
+    definition = _parse_pieces_v1(read_pieces(definition_offset),
+                                  definitions, dates)
+    definitions[definition.get_uuid()] = definition
+    occurrences = []
+    for offset in occurrence_offsets:
+      occurrences.append(_parse_pieces_v1(read_pieces(offset),
+                                          definitions, dates))
+  finally:
+    view.close()
+  return definition, occurrences
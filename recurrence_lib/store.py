@@ -0,0 +1,176 @@
+# ====================================================================
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ====================================================================
+
+"""store.py:  Recurrence event store and memoizing query engine."""
+
+### Query results are memoized per window -- ('past', NOW_DATE) or
+### ('future', NOW_DATE, END_DATE) -- in a small LRU cache.  Each
+### change to the store evicts just those windows whose results the
+### change could affect:  an occurrence on date D affects past windows
+### ending after D and future windows containing D; a definition
+### affects the future windows containing any of its dates.
+
+import collections
+import datetime
+import events
+import stats
+import table
+
+
+# Default number of memoized query results.
+DEFAULT_CACHE_SIZE = 32
+
+
+class EventStore:
+  """Owner of a set of EventDefinitions and EventOccurrences, answering
+  past and future window queries over them.  Query results are
+  memoized, so route all changes to the data through the store's
+  methods (or call invalidate() after changing it behind the store's
+  back).  If OCCURRENCES is a table.OccurrenceTable, the store keeps
+  its occurrences in it, rather than in a list, and past queries are
+  answered from its columns; the occurrences it returns are then
+  snapshots of the table's rows."""
+
+  def __init__(self, definitions=None, occurrences=None,
+               cache_size=DEFAULT_CACHE_SIZE):
+    self.definitions = list(definitions or [])
+    if isinstance(occurrences, table.OccurrenceTable):
+      self.occurrences = occurrences
+      self.clearance_index = occurrences.get_clearance_index()
+    else:
+      self.occurrences = list(occurrences or [])
+      self.clearance_index = events.ClearanceIndex(self.occurrences)
+    self.cache_size = cache_size
+    self.cache = collections.OrderedDict()
+    self.hits = 0
+    self.misses = 0
+
+  def get_definitions(self):
+    """Return a list of the stored EventDefinitions."""
+    return list(self.definitions)
+
+  def get_occurrences(self):
+    """Return a list of the stored EventOccurrences."""
+    return list(self.occurrences)
+
+  def get_clearance_index(self):
+    """Return the ClearanceIndex of the stored occurrences."""
+    return self.clearance_index
+
+  def add_definition(self, definition):
+    """Add DEFINITION to the store."""
+    self.definitions.append(definition)
+    if isinstance(self.occurrences, table.OccurrenceTable):
+      self.occurrences.add_definition(definition)
+    self._invalidate_definition(definition)
+
+  def remove_definition(self, definition):
+    """Remove DEFINITION, and any occurrences of it, from the store."""
+    self.definitions.remove(definition)
+    self._invalidate_definition(definition)
+    uuid = definition.get_uuid()
+    for occurrence in self.occurrences[:]:
+      if occurrence.get_definition().get_uuid() == uuid:
+        self.remove_occurrence(occurrence)
+
+  def add_occurrence(self, occurrence):
+    """Add OCCURRENCE to the store."""
+    self.occurrences.append(occurrence)
+    self.clearance_index.add_occurrence(occurrence)
+    self._invalidate_date(occurrence.get_date())
+
+  def remove_occurrence(self, occurrence):
+    """Remove OCCURRENCE from the store."""
+    self.occurrences.remove(occurrence)
+    self.clearance_index.remove_occurrence(occurrence)
+    self._invalidate_date(occurrence.get_date())
+
+  def set_cleared(self, occurrence, cleared=True):
+    """Set the clearance flag of stored OCCURRENCE to CLEARED."""
+    if occurrence.get_cleared() == cleared:
+      return
+    if isinstance(self.occurrences, table.OccurrenceTable):
+      self.occurrences.set_occurrence_cleared(occurrence, cleared)
+    self.clearance_index.set_cleared(occurrence, cleared)
+    self._invalidate_date(occurrence.get_date())
+
+  def clear_through(self, definitions, date):
+    """Clear every occurrence of DEFINITIONS (a list of stored
+    EventDefinitions, or a single one) dated on or before DATE, and
+    drop the stored occurrences that makes redundant.  See
+    events.clear_through()."""
+    if isinstance(definitions, events.EventDefinition):
+      definitions = [definitions]
+    removed = events.clear_through(definitions, date, self.occurrences,
+                                   self.clearance_index)
+    for definition in definitions:
+      self._invalidate_definition(definition)
+    for occurrence in removed:
+      if not occurrence.get_cleared():
+        self._invalidate_date(occurrence.get_date())
+
+  def invalidate(self):
+    """Forget all memoized query results."""
+    self.cache.clear()
+
+  def get_past_occurrences(self, now_date):
+    """Return the uncleared stored occurrences dated before NOW_DATE,
+    in display order (see events.occurrence_sort_key())."""
+    return self._query(('past', now_date))
+
+  def get_future_occurrences(self, now_date, num_days):
+    """Return the uncleared occurrences of the stored definitions dated
+    from NOW_DATE through NUM_DAYS days later, in display order."""
+    return self._query(('future', now_date,
+                        now_date + datetime.timedelta(num_days)))
+
+  @stats.timed('store_query')
+  def _query(self, key):
+    # Answer the query described by KEY, from the cache if possible.
+    # The caller gets a copy, so can't disturb the cached result.
+    result = self.cache.pop(key, None)
+    if result is None:
+      self.misses = self.misses + 1
+      if key[0] == 'past':
+        result = events._get_past_occurrences(self.definitions,
+                                              self.occurrences, key[1])
+        result.sort(key=events.occurrence_sort_key)
+      else:
+        result = list(events.iter_future_occurrences(
+          self.definitions, self.occurrences, key[1], key[2],
+          clearance_index=self.clearance_index))
+      while len(self.cache) >= self.cache_size:
+        self.cache.popitem(False)
+    else:
+      self.hits = self.hits + 1
+    self.cache[key] = result
+    return list(result)
+
+  def _invalidate_date(self, date):
+    # Forget the results affected by a change to an occurrence on DATE.
+    for key in self.cache.keys():
+      if key[0] == 'past':
+        if date < key[1]:
+          del self.cache[key]
+      elif key[1] <= date <= key[2]:
+        del self.cache[key]
+
+  def _invalidate_definition(self, definition):
+    # Forget the results affected by the addition or removal of
+    # DEFINITION.
+    for key in self.cache.keys():
+      if key[0] == 'future':
+        date = definition.get_first_date_on_or_after(key[1])
+        if date is not None and date <= key[2]:
+          del self.cache[key]
@@ -0,0 +1,269 @@
+# ====================================================================
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ====================================================================
+
+"""table.py:  Recurrence columnar occurrence table."""
+
+### Stored occurrences are held as three parallel columns -- date
+### ordinals, definition indices, and cleared flags (a byte per row) --
+### kept sorted by date (and, among rows of equal date, by insertion
+### order).  A window query is then a binary search of the ordinal
+### column plus a slice, and the past query skips over runs of cleared
+### rows via itertools.compress(), at C speed.  EventOccurrence
+### objects are made only for the rows a caller asks for.  They're
+### snapshots of their rows, so make changes through the table's
+### methods (or through a store.EventStore holding the table).
+
+import array
+import bisect
+import itertools
+import events
+import storage
+
+
+# A bytearray.translate() table mapping cleared flags to 1 for
+# uncleared rows and 0 for cleared ones.
+_UNCLEARED = str(bytearray([1] + [0] * 255))
+
+
+class OccurrenceTable(object):
+  """A date-ordered table of stored occurrences of the EventDefinitions
+  in DEFINITIONS, initially holding the EventOccurrences in
+  OCCURRENCES.  The table is also a read-only sequence of
+  EventOccurrences (made on demand), so it may be used wherever a list
+  of stored occurrences is expected."""
+
+  def __init__(self, definitions, occurrences=()):
+    self.definitions = []
+    self.definition_indices = {}
+    for definition in definitions:
+      self.add_definition(definition)
+    self.dates = {0 : None}
+    indices = array.array('l')
+    ordinals = array.array('l')
+    cleared = bytearray()
+    for occurrence in occurrences:
+      indices.append(self._get_index(occurrence.get_definition()))
+      ordinals.append(occurrence.get_date().toordinal())
+      cleared.append(occurrence.get_cleared() and 1 or 0)
+    self._set_columns(indices, ordinals, cleared)
+
+  def _set_columns(self, indices, ordinals, cleared):
+    # Fill the table with the rows of the parallel INDICES, ORDINALS and
+    # CLEARED columns, sorting them (stably) by date.
+    rows = range(len(ordinals))
+    if any(ordinals[i] > ordinals[i + 1] for i in xrange(len(ordinals) - 1)):
+      rows.sort(key=ordinals.__getitem__)
+      indices = array.array('l', [indices[row] for row in rows])
+      ordinals = array.array('l', [ordinals[row] for row in rows])
+      cleared = bytearray([cleared[row] for row in rows])
+    self.indices = indices
+    self.ordinals = ordinals
+    self.cleared = cleared
+
+  def _get_index(self, definition):
+    # Return the index of DEFINITION in the table's definitions.
+    try:
+      return self.definition_indices[definition.get_uuid()]
+    except KeyError:
+      raise Exception("Occurrence of unknown event definition '%s'."
+                      % (definition.get_uuid()))
+
+  def _get_date(self, ordinal):
+    return storage.ordinal_to_date(ordinal, self.dates)
+
+  def _make_occurrence(self, row):
+    return events.EventOccurrence(self.definitions[self.indices[row]],
+                                  self._get_date(self.ordinals[row]),
+                                  self.cleared[row] != 0)
+
+  def __len__(self):
+    return len(self.ordinals)
+
+  def __getitem__(self, row):
+    if isinstance(row, slice):
+      return [self._make_occurrence(i)
+              for i in xrange(*row.indices(len(self.ordinals)))]
+    if row < 0:
+      row = row + len(self.ordinals)
+    if not 0 <= row < len(self.ordinals):
+      raise IndexError("occurrence table index out of range")
+    return self._make_occurrence(row)
+
+  def __iter__(self):
+    for row in xrange(len(self.ordinals)):
+      yield self._make_occurrence(row)
+
+  def get_definitions(self):
+    """Return a list of the table's EventDefinitions."""
+    return list(self.definitions)
+
+  def add_definition(self, definition):
+    """Add DEFINITION to those whose occurrences the table may hold."""
+    self.definition_indices[definition.get_uuid()] = len(self.definitions)
+    self.definitions.append(definition)
+
+  def add_occurrence(self, occurrence):
+    """Add OCCURRENCE to the table, after any rows of the same date, and
+    return its row number."""
+    index = self._get_index(occurrence.get_definition())
+    ordinal = occurrence.get_date().toordinal()
+    row = bisect.bisect_right(self.ordinals, ordinal)
+    self.indices.insert(row, index)
+    self.ordinals.insert(row, ordinal)
+    self.cleared.insert(row, occurrence.get_cleared() and 1 or 0)
+    return row
+
+  def append(self, occurrence):
+    """Add OCCURRENCE to the table (in its place in date order, as for
+    add_occurrence())."""
+    self.add_occurrence(occurrence)
+
+  def remove_row(self, row):
+    """Remove the row numbered ROW from the table."""
+    del self.indices[row]
+    del self.ordinals[row]
+    del self.cleared[row]
+
+  def find_row(self, occurrence):
+    """Return the number of the first row holding OCCURRENCE (with its
+    clearance flag), or raise ValueError if there is none."""
+    flag = occurrence.get_cleared() and 1 or 0
+    for row in self.find_rows(occurrence.get_definition(),
+                              occurrence.get_date()):
+      if self.cleared[row] == flag:
+        return row
+    raise ValueError("occurrence not in table")
+
+  def remove(self, occurrence):
+    """Remove the first row holding OCCURRENCE, as list.remove() would,
+    raising ValueError if there is none."""
+    self.remove_row(self.find_row(occurrence))
+
+  def set_occurrence_cleared(self, occurrence, cleared=True):
+    """Set the clearance flag of the first row holding OCCURRENCE to
+    CLEARED (leaving OCCURRENCE itself be), raising ValueError if there
+    is no such row."""
+    self.cleared[self.find_row(occurrence)] = cleared and 1 or 0
+
+  def remove_through(self, watermarks):
+    """Remove, in a single pass, the rows of the definitions whose uuids
+    are keys of WATERMARKS dated on or before the corresponding dates.
+    Return a list of the removed occurrences.  (See
+    events.clear_through().)"""
+    limits = []
+    for definition in self.definitions:
+      watermark = watermarks.get(definition.get_uuid())
+      limits.append(watermark is not None and watermark.toordinal() or 0)
+    removed_rows = [row for row in xrange(len(self.ordinals))
+                    if self.ordinals[row] <= limits[self.indices[row]]]
+    if not removed_rows:
+      return []
+    removed = [self._make_occurrence(row) for row in removed_rows]
+    kept_rows = [row for row in xrange(len(self.ordinals))
+                 if self.ordinals[row] > limits[self.indices[row]]]
+    self.indices = array.array('l', [self.indices[row] for row in kept_rows])
+    self.ordinals = array.array('l',
+                                [self.ordinals[row] for row in kept_rows])
+    self.cleared = bytearray([self.cleared[row] for row in kept_rows])
+    return removed
+
+  def find_rows(self, definition, date):
+    """Return a list of the numbers of the rows holding occurrences of
+    DEFINITION on DATE."""
+    index = self._get_index(definition)
+    ordinal = date.toordinal()
+    return [row for row in xrange(bisect.bisect_left(self.ordinals, ordinal),
+                                  bisect.bisect_right(self.ordinals, ordinal))
+            if self.indices[row] == index]
+
+  def set_cleared(self, definition, date, cleared=True):
+    """Set the clearance flag of the stored occurrences of DEFINITION on
+    DATE to CLEARED, returning the number of rows changed."""
+    rows = self.find_rows(definition, date)
+    for row in rows:
+      self.cleared[row] = cleared and 1 or 0
+    return len(rows)
+
+  def get_past_occurrences(self, now_date):
+    """Return the uncleared stored occurrences dated before NOW_DATE (and
+    after their definitions' cleared-through dates), in date order."""
+    end = bisect.bisect_left(self.ordinals, now_date.toordinal())
+    uncleared = self.cleared[:end].translate(_UNCLEARED)
+    definitions = self.definitions
+    limits = []
+    for definition in definitions:
+      cleared_through = definition.get_cleared_through()
+      limits.append(cleared_through is not None
+                    and cleared_through.toordinal() or 0)
+    dates = self.dates
+    get_date = self._get_date
+    make_occurrence = events.make_occurrence
+    past_occurrences = []
+    append = past_occurrences.append
+    for ordinal, index in itertools.izip(
+      itertools.compress(self.ordinals, uncleared),
+      itertools.compress(self.indices, uncleared)):
+      if ordinal > limits[index]:
+        append(make_occurrence(definitions[index],
+                               dates.get(ordinal) or get_date(ordinal)))
+    return past_occurrences
+
+  def get_occurrences_between(self, start_date, end_date):
+    """Return the stored occurrences dated from START_DATE through
+    END_DATE, inclusive, in date order."""
+    start = bisect.bisect_left(self.ordinals, start_date.toordinal())
+    end = bisect.bisect_right(self.ordinals, end_date.toordinal())
+    return [self._make_occurrence(row) for row in xrange(start, end)]
+
+  def get_clearance_index(self):
+    """Return an events.ClearanceIndex of the table's cleared rows."""
+    clearance_index = events.ClearanceIndex()
+    uuids = [definition.get_uuid() for definition in self.definitions]
+    indices = self.indices
+    ordinals = self.ordinals
+    cleared = self.cleared
+    for row in xrange(len(ordinals)):
+      if cleared[row]:
+        clearance_index.add_cleared(uuids[indices[row]],
+                                    self._get_date(ordinals[row]))
+    return clearance_index
+
+
+def read_data_file(filepath):
+  """Like storage.read_data_file(), but return the occurrences as an
+  OccurrenceTable.  The occurrence records of version 3 (binary) data
+  files are read straight into the table's columns, without making an
+  EventOccurrence apiece."""
+  fp = open(filepath, 'rb')
+  try:
+    if storage.read_version(fp) == storage.BINARY_VERSION:
+      data = fp.read()
+      table = OccurrenceTable([])
+      definitions, pos, occurrence_size, num_occurrences = \
+        storage.parse_binary_definitions(data, table.dates)
+      for definition in definitions:
+        table.add_definition(definition)
+      indices, ordinals, cleared = storage.parse_binary_occurrences(
+        data, pos, occurrence_size, num_occurrences)
+      indices = array.array('l', indices)
+      ordinals = array.array('l', ordinals)
+      cleared = bytearray(cleared)
+      if indices and max(indices) >= len(definitions):
+        raise Exception("Truncated or corrupt binary data file.")
+      table._set_columns(indices, ordinals, cleared)
+      return definitions, table
+  finally:
+    fp.close()
+  definitions, occurrences = storage.read_data_file(filepath)
+  return definitions, OccurrenceTable(definitions, occurrences)
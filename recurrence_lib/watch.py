@@ -0,0 +1,77 @@
+# ====================================================================
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ====================================================================
+
+"""watch.py:  Recurrence data file and date change detection."""
+
+import datetime
+import os
+
+
+# Suggested interval, in seconds, between RefreshController checks.
+POLL_INTERVAL = 5
+
+
+def _get_file_stamp(filepath):
+  # Return a value which changes whenever the file at FILEPATH does
+  # (including being atomically replaced), or None if there's no file.
+  try:
+    st = os.stat(filepath)
+  except OSError:
+    return None
+  return st.st_size, st.st_mtime, st.st_ino
+
+
+class RefreshController:
+  """Tracks the two things which make a Recurrence event listing stale:
+  changes to the data files it was loaded from, and the local date
+  rolling over.  Call check() periodically (every POLL_INTERVAL
+  seconds, say); it costs one stat() per watched file, and reports
+  only what actually changed, so that callers can reload and recompute
+  no more than necessary.  TODAY_FUNC returns the current local date."""
+
+  def __init__(self, filepaths=(), today_func=datetime.date.today):
+    self.today_func = today_func
+    self.today = today_func()
+    self.stamps = {}
+    for filepath in filepaths:
+      self.watch(filepath)
+
+  def watch(self, filepath):
+    """Start watching the data file at FILEPATH, treating its current
+    state as already loaded.  (So call this before loading it.)"""
+    self.stamps[filepath] = _get_file_stamp(filepath)
+
+  def unwatch(self, filepath):
+    """Stop watching the data file at FILEPATH."""
+    self.stamps.pop(filepath, None)
+
+  def get_today(self):
+    """Return the local date as of the last check."""
+    return self.today
+
+  def check(self):
+    """Return a 2-tuple containing a list of the watched data files
+    which changed since the last check (or since they were watched),
+    and a flag indicating whether the local date has changed since the
+    last check."""
+    changed_filepaths = []
+    for filepath, stamp in self.stamps.items():
+      new_stamp = _get_file_stamp(filepath)
+      if new_stamp != stamp:
+        self.stamps[filepath] = new_stamp
+        changed_filepaths.append(filepath)
+    today = self.today_func()
+    date_changed = today != self.today
+    self.today = today
+    return changed_filepaths, date_changed
@@ -0,0 +1,158 @@
+# ====================================================================
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ====================================================================
+
+"""window.py:  Recurrence incrementally maintained look-ahead window."""
+
+### The window's future occurrences live in a deque, in display order.
+### Each definition's next date beyond the window's end sits in a heap
+### (as in events.iter_future_occurrences()), so sliding the window
+### forward pops occurrences off the front of the deque and pulls just
+### the newly covered dates off the heap onto its back.  Clearance is
+### checked when occurrences are read, so clearing an occurrence needs
+### no window maintenance at all.
+
+import collections
+import datetime
+import heapq
+import events
+
+
+class SlidingWindow:
+  """The uncleared past occurrences, and the uncleared occurrences in
+  a fixed look-ahead of NUM_DAYS days, of DEFINITIONS and OCCURRENCES
+  as of a given date.  Advancing the date costs time proportional to
+  the number of occurrences which leave and enter the window, rather
+  than to its size.  Occurrences which become overdue without having
+  been cleared move into the past set.  CLEARANCE_INDEX, if provided,
+  is the events.ClearanceIndex of OCCURRENCES (keep it current as
+  occurrences are cleared); if the definitions themselves change,
+  build a new window."""
+
+  def __init__(self, definitions, occurrences, now_date, num_days,
+               clearance_index=None):
+    if clearance_index is None:
+      clearance_index = events.ClearanceIndex(occurrences)
+    self.definitions = definitions
+    self.clearance_index = clearance_index
+    self.delta = datetime.timedelta(num_days)
+    self.now_date = now_date
+    self.past = events._get_past_occurrences(definitions, occurrences,
+                                             now_date)
+    # Stored occurrences which aren't yet overdue, waiting to join the
+    # past set.  (The keys of all stored occurrences are remembered so
+    # that generated occurrences don't duplicate them.)
+    pending = []
+    self.past_keys = set()
+    for occurrence in occurrences:
+      self.past_keys.add(self._key(occurrence))
+      if occurrence.get_date() >= now_date and not occurrence.get_cleared():
+        pending.append(occurrence)
+    pending.sort(key=events.occurrence_sort_key)
+    self.pending = collections.deque(pending)
+    self.future = collections.deque()
+    self.heap = []
+    for i in range(len(definitions)):
+      dates = definitions[i].iter_dates(now_date)
+      try:
+        self.heap.append((dates.next(), definitions[i].get_description(),
+                          i, dates))
+      except StopIteration:
+        pass
+    heapq.heapify(self.heap)
+    self._extend(now_date + self.delta)
+
+  def _key(self, occurrence):
+    return occurrence.get_definition().get_uuid(), occurrence.get_date()
+
+  def _is_cleared(self, occurrence):
+    return self.clearance_index.is_cleared(occurrence.get_definition(),
+                                           occurrence.get_date())
+
+  def _pop(self):
+    # Remove the earliest occurrence from the heap, returning it.
+    heap = self.heap
+    date, description, i, dates = heap[0]
+    try:
+      heapq.heapreplace(heap, (dates.next(), description, i, dates))
+    except StopIteration:
+      heapq.heappop(heap)
+    return events.EventOccurrence(self.definitions[i], date)
+
+  def _add_overdue(self, occurrence, overdue):
+    # Move OCCURRENCE, which has become overdue, into the past set (and
+    # onto the list OVERDUE) unless it's cleared or already stored.
+    if self._is_cleared(occurrence):
+      return
+    key = self._key(occurrence)
+    if key not in self.past_keys:
+      self.past_keys.add(key)
+      self.past.append(occurrence)
+      overdue.append(occurrence)
+
+  def _extend(self, end_date):
+    # Move the occurrences dated through END_DATE from the heap onto
+    # the back of the window, returning them.
+    entered = []
+    heap = self.heap
+    while heap and heap[0][0] <= end_date:
+      occurrence = self._pop()
+      self.future.append(occurrence)
+      entered.append(occurrence)
+    return entered
+
+  def get_now_date(self):
+    """Return the date as of which the window is current."""
+    return self.now_date
+
+  def advance(self, now_date):
+    """Slide the window forward so that it's current as of NOW_DATE.
+    Return a 3-tuple of lists of occurrences:  those which left the
+    window, those which moved into the past set (including any which
+    were passed over without ever entering the window, when advancing
+    by more than its length), and those which entered the window."""
+    if now_date < self.now_date:
+      raise ValueError("Sliding windows only move forward")
+    left = []
+    overdue = []
+    pending = self.pending
+    while pending and pending[0].get_date() < now_date:
+      self.past.append(pending.popleft())
+    future = self.future
+    while future and future[0].get_date() < now_date:
+      occurrence = future.popleft()
+      left.append(occurrence)
+      self._add_overdue(occurrence, overdue)
+    heap = self.heap
+    while heap and heap[0][0] < now_date:
+      self._add_overdue(self._pop(), overdue)
+    self.now_date = now_date
+    return left, overdue, self._extend(now_date + self.delta)
+
+  def get_past_occurrences(self):
+    """Return the uncleared past occurrences, in display order."""
+    past = []
+    for occurrence in self.past:
+      if not self._is_cleared(occurrence):
+        past.append(occurrence)
+    past.sort(key=events.occurrence_sort_key)
+    return past
+
+  def get_future_occurrences(self):
+    """Return the uncleared occurrences in the window, in display
+    order."""
+    future = []
+    for occurrence in self.future:
+      if not self._is_cleared(occurrence):
+        future.append(occurrence)
+    return future
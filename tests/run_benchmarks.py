@@ -0,0 +1,584 @@
+#!/usr/bin/env python
+# ====================================================================
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ====================================================================
+
+"""run_benchmarks.py:  Recurrence performance measurements."""
+
+### Each benchmark returns a dictionary of named measurements (and
+### writes a human-readable summary of them).  Where os.fork() is
+### available, each runs in its own child process, so that its peak
+### memory use can be recorded alongside.  Use --json to save the
+### results, and --compare to compare them against saved ones.
+
+import sys
+import os
+import getopt
+import json
+import platform
+import random
+import shutil
+import time
+import datetime
+import traceback
+try:
+  import resource
+except ImportError:
+  resource = None
+sys.path.insert(0, os.path.abspath(os.path.join(sys.argv[0], "../..")))
+from recurrence_lib import events, storage, cache, listmodel, window
+from recurrence_lib import batch, parallel, table
+
+bench_temp_dir = os.path.abspath(os.path.join(sys.argv[0], "../__BENCH__"))
+
+# The date treated as "now" by generated calendars and the queries run
+# against them.
+REFERENCE_DATE = datetime.date(2010, 6, 1)
+
+# Words from which generated event descriptions are made.
+_DESCRIPTION_WORDS = ['Pay', 'Call', 'Renew', 'Water', 'Check', 'Backup',
+                      'rent', 'mom', 'license', 'plants', 'oil', 'server',
+                      'insurance', 'taxes', 'dentist', 'newsletter']
+
+
+def write_synthetic_data_file(filepath, num_definitions, num_occurrences):
+  """Write a data file to FILEPATH holding NUM_DEFINITIONS weekly
+  definitions and NUM_OCCURRENCES occurrences spread across them."""
+  start = datetime.date(2000, 1, 3)
+  definitions = []
+  for i in range(num_definitions):
+    er = events.EventRecurrence(events.EVENT_PERIOD_WEEKLY)
+    definitions.append(events.EventDefinition('def%08d' % (i),
+                                              'Synthetic event %d' % (i),
+                                              start, er))
+  occurrences = []
+  for i in range(num_occurrences):
+    definition = definitions[i % num_definitions]
+    date = start + datetime.timedelta(7 * (i // num_definitions))
+    occurrences.append(events.EventOccurrence(definition, date, i % 3 != 0))
+  storage.write_data_file(filepath, definitions, occurrences)
+
+
+def generate_calendar(num_definitions, num_occurrences, cleared_ratio=0.9,
+                      seed=0, now_date=REFERENCE_DATE):
+  """Return a (definitions, occurrences) 2-tuple describing a realistic
+  calendar, generated deterministically from SEED:  NUM_DEFINITIONS
+  definitions with a mix of periods (some with until dates) and start
+  dates spread across the years before NOW_DATE, and (up to)
+  NUM_OCCURRENCES distinct past occurrences of them, of which about
+  CLEARED_RATIO are cleared."""
+  rand = random.Random(seed)
+  periods = [None] + [events.EVENT_PERIOD_WEEKLY] * 4 \
+            + [events.EVENT_PERIOD_MONTHLY] * 3 \
+            + [events.EVENT_PERIOD_YEARLY] * 2
+  first_date = datetime.date(2000, 1, 1)
+  num_days = (now_date - first_date).days
+  definitions = []
+  for i in range(num_definitions):
+    start = first_date + datetime.timedelta(rand.randint(0, num_days + 90))
+    start = start.replace(day=min(start.day, 28))
+    period = rand.choice(periods)
+    recurrence = None
+    if period:
+      until_date = None
+      if rand.randint(0, 3) == 0:
+        until_date = start + datetime.timedelta(rand.randint(30, 3650))
+      recurrence = events.EventRecurrence(period, until_date)
+    description = '%s %s %d' % (rand.choice(_DESCRIPTION_WORDS[:6]),
+                                rand.choice(_DESCRIPTION_WORDS[6:]), i)
+    definitions.append(events.EventDefinition('%032x'
+                                              % (rand.getrandbits(128)),
+                                              description, start,
+                                              recurrence))
+  occurrences = []
+  seen = set()
+  for attempt in range(num_occurrences * 2):
+    if len(occurrences) >= num_occurrences:
+      break
+    definition = rand.choice(definitions)
+    span = (now_date - definition.get_start_date()).days
+    if span <= 0:
+      continue
+    date = definition.get_first_date_on_or_after(
+      definition.get_start_date() + datetime.timedelta(rand.randint(0, span)))
+    if date is None or date >= now_date:
+      date = definition.get_start_date()
+    key = (definition.get_uuid(), date)
+    if key in seen:
+      continue
+    seen.add(key)
+    occurrences.append(events.EventOccurrence(definition, date,
+                                              rand.random() < cleared_ratio))
+  return definitions, occurrences
+
+
+def write_calendar_data_file(filepath, num_definitions, num_occurrences,
+                             cleared_ratio=0.9, seed=0):
+  """Write a data file generated by generate_calendar() to FILEPATH."""
+  definitions, occurrences = generate_calendar(num_definitions,
+                                               num_occurrences,
+                                               cleared_ratio, seed)
+  storage.write_data_file(filepath, definitions, occurrences)
+
+
+def _sizeof_model(definitions, occurrences):
+  """Return the number of bytes held by DEFINITIONS and OCCURRENCES,
+  counting each distinct object reachable through the model getters
+  (and any per-instance __dict__) exactly once."""
+  seen = {}
+  def _add(obj):
+    if obj is None or id(obj) in seen:
+      return 0
+    seen[id(obj)] = obj
+    size = sys.getsizeof(obj)
+    if hasattr(obj, '__dict__'):
+      size = size + sys.getsizeof(obj.__dict__)
+    return size
+  total = 0
+  for definition in definitions:
+    total = total + _add(definition)
+    total = total + _add(definition.get_uuid())
+    total = total + _add(definition.get_description())
+    total = total + _add(definition.get_start_date())
+    recurrence = definition.get_recurrence()
+    total = total + _add(recurrence)
+    if recurrence:
+      total = total + _add(recurrence.get_until_date())
+  for occurrence in occurrences:
+    total = total + _add(occurrence)
+    total = total + _add(occurrence.get_date())
+  return total
+
+
+def _get_peak_memory():
+  """Return the peak resident set size of this process, in kilobytes,
+  or None if it can't be determined."""
+  if resource is None:
+    return None
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  if sys.platform == 'darwin':
+    peak = peak // 1024
+  return peak
+
+
+### Calendar suite.  These run against the generated calendar data
+### file passed as CALENDAR_FILEPATH.
+
+def bench_calendar_read(calendar_filepath):
+  """Report the time taken to read the calendar data file."""
+  start = time.time()
+  definitions, occurrences = storage.read_data_file(calendar_filepath)
+  read_time = time.time() - start
+  num_records = len(definitions) + len(occurrences)
+  sys.stdout.write("calendar read: %d records, %.2f seconds\n"
+                   % (num_records, read_time))
+  return {'records': num_records, 'seconds': read_time}
+
+
+def bench_calendar_write(calendar_filepath):
+  """Report the time taken to write the calendar data file."""
+  definitions, occurrences = storage.read_data_file(calendar_filepath)
+  filepath = os.path.join(bench_temp_dir, 'calendar_write')
+  start = time.time()
+  storage.write_data_file(filepath, definitions, occurrences)
+  write_time = time.time() - start
+  num_records = len(definitions) + len(occurrences)
+  sys.stdout.write("calendar write: %d records, %.2f seconds\n"
+                   % (num_records, write_time))
+  return {'records': num_records, 'seconds': write_time}
+
+
+def bench_calendar_queries(calendar_filepath, num_days=60):
+  """Report the time taken by the past and future queries over the
+  calendar."""
+  definitions, occurrences = storage.read_data_file(calendar_filepath)
+  start = time.time()
+  past = events._get_past_occurrences(definitions, occurrences,
+                                      REFERENCE_DATE)
+  past_time = time.time() - start
+  start = time.time()
+  future = list(events.iter_future_occurrences(
+    definitions, occurrences, REFERENCE_DATE,
+    REFERENCE_DATE + datetime.timedelta(num_days)))
+  future_time = time.time() - start
+  sys.stdout.write("calendar queries: %d past in %.3f seconds, "
+                   "%d future in %.3f seconds\n"
+                   % (len(past), past_time, len(future), future_time))
+  return {'past_occurrences': len(past), 'past_seconds': past_time,
+          'future_occurrences': len(future), 'future_seconds': future_time}
+
+
+def bench_calendar_table(calendar_filepath, num_days=60):
+  """Report the time taken to read the calendar (as a binary data file)
+  into an occurrence table, and by the table's past and window
+  queries."""
+  filepath = os.path.join(bench_temp_dir, 'calendar_table')
+  storage.convert_data_file(calendar_filepath, filepath,
+                            storage.BINARY_VERSION)
+  start = time.time()
+  definitions, occurrences = table.read_data_file(filepath)
+  read_time = time.time() - start
+  start = time.time()
+  past = occurrences.get_past_occurrences(REFERENCE_DATE)
+  past_time = time.time() - start
+  start = time.time()
+  in_window = occurrences.get_occurrences_between(
+    REFERENCE_DATE - datetime.timedelta(num_days), REFERENCE_DATE)
+  window_time = time.time() - start
+  sys.stdout.write("calendar table: read %d rows in %.2f seconds, "
+                   "%d past in %.3f seconds, %d in window in %.3f seconds\n"
+                   % (len(occurrences), read_time, len(past), past_time,
+                      len(in_window), window_time))
+  return {'rows': len(occurrences), 'read_seconds': read_time,
+          'past_occurrences': len(past), 'past_seconds': past_time,
+          'window_occurrences': len(in_window),
+          'window_seconds': window_time}
+
+
+def bench_calendar_ui(calendar_filepath, num_days=60):
+  """Report the time taken by the GUI's listing path over the
+  calendar:  sorting the past occurrences, and building the list
+  model."""
+  definitions, occurrences = storage.read_data_file(calendar_filepath)
+  past = events._get_past_occurrences(definitions, occurrences,
+                                      REFERENCE_DATE)
+  future = list(events.iter_future_occurrences(
+    definitions, occurrences, REFERENCE_DATE,
+    REFERENCE_DATE + datetime.timedelta(num_days)))
+  start = time.time()
+  past.sort(key=events.occurrence_sort_key)
+  sort_time = time.time() - start
+  model = listmodel.EventListModel()
+  start = time.time()
+  model.set_occurrences(past, future)
+  model_time = time.time() - start
+  sys.stdout.write("calendar ui: %d rows, %.3f seconds sorted, "
+                   "%.3f seconds modeled\n"
+                   % (len(model), sort_time, model_time))
+  return {'rows': len(model), 'sort_seconds': sort_time,
+          'model_seconds': model_time}
+
+
+### Targeted benchmarks.
+
+def bench_memory(num_definitions=1000, num_occurrences=100000):
+  """Report the bytes per loaded record of a synthetic data file."""
+  filepath = os.path.join(bench_temp_dir, 'memory')
+  write_synthetic_data_file(filepath, num_definitions, num_occurrences)
+  definitions, occurrences = storage.read_data_file(filepath)
+  size = _sizeof_model(definitions, occurrences)
+  num_records = len(definitions) + len(occurrences)
+  sys.stdout.write("memory: %d records, %d bytes, %.1f bytes/record\n"
+                   % (num_records, size, float(size) / num_records))
+  return {'records': num_records, 'bytes': size}
+
+
+def bench_read(num_definitions=1000, num_occurrences=1000000):
+  """Report the time taken to read, and to stream without collecting,
+  a synthetic data file."""
+  filepath = os.path.join(bench_temp_dir, 'read')
+  write_synthetic_data_file(filepath, num_definitions, num_occurrences)
+  start = time.time()
+  storage.read_data_file(filepath)
+  read_time = time.time() - start
+  start = time.time()
+  for record in storage.iter_data_file(filepath):
+    pass
+  stream_time = time.time() - start
+  binary_filepath = os.path.join(bench_temp_dir, 'read_binary')
+  storage.convert_data_file(filepath, binary_filepath,
+                            storage.BINARY_VERSION)
+  start = time.time()
+  storage.read_data_file(binary_filepath)
+  binary_time = time.time() - start
+  sys.stdout.write("read: %d records, %.2f seconds (%.2f streamed, "
+                   "%.2f binary)\n"
+                   % (num_definitions + num_occurrences,
+                      read_time, stream_time, binary_time))
+  return {'seconds': read_time, 'stream_seconds': stream_time,
+          'binary_seconds': binary_time}
+
+
+def bench_clear(num_definitions=1000, num_occurrences=10000, num_clears=100):
+  """Report the time taken to clear NUM_CLEARS occurrences one full
+  write at a time, and through a group-commit writer."""
+  filepath = os.path.join(bench_temp_dir, 'clear')
+  write_synthetic_data_file(filepath, num_definitions, num_occurrences)
+  definitions, occurrences = storage.read_data_file(filepath)
+  start = time.time()
+  for occurrence in occurrences[:num_clears]:
+    occurrence.set_cleared(True)
+    storage.write_data_file(filepath, definitions, occurrences)
+  single_time = time.time() - start
+  start = time.time()
+  writer = storage.DataFileWriter(filepath, definitions, occurrences)
+  with writer:
+    for occurrence in occurrences[num_clears:2 * num_clears]:
+      writer.set_cleared(occurrence)
+  group_time = time.time() - start
+  sys.stdout.write("clear: %d clears, %.2f seconds (%.2f grouped)\n"
+                   % (num_clears, single_time, group_time))
+  return {'seconds': single_time, 'grouped_seconds': group_time}
+
+
+def bench_startup(num_definitions=1000, num_occurrences=200000):
+  """Report the time taken to load a synthetic data file by parsing it
+  (a snapshot cache miss) and from the snapshot cache."""
+  filepath = os.path.join(bench_temp_dir, 'startup')
+  cache_dir = os.path.join(bench_temp_dir, 'cache')
+  write_synthetic_data_file(filepath, num_definitions, num_occurrences)
+  start = time.time()
+  cache.load_data_file(filepath, cache_dir)
+  cold_time = time.time() - start
+  start = time.time()
+  cache.load_data_file(filepath, cache_dir)
+  hit_time = time.time() - start
+  sys.stdout.write("startup: %d records, %.2f seconds cold, "
+                   "%.2f seconds cached\n"
+                   % (num_definitions + num_occurrences, cold_time, hit_time))
+  return {'cold_seconds': cold_time, 'cached_seconds': hit_time}
+
+
+def bench_list_model(num_definitions=2000, num_days=365):
+  """Report the time taken to build an event list model, and to
+  refresh it after one definition changes."""
+  filepath = os.path.join(bench_temp_dir, 'list_model')
+  write_synthetic_data_file(filepath, num_definitions, 0)
+  definitions, occurrences = storage.read_data_file(filepath)
+  now = datetime.date(2008, 1, 1)
+  model = listmodel.EventListModel()
+  start = time.time()
+  model.set_occurrences([], events.iter_future_occurrences(
+    definitions, occurrences, now, now + datetime.timedelta(num_days)))
+  build_time = time.time() - start
+  definitions[0].set_recurrence(None)
+  start = time.time()
+  changes = model.set_occurrences([], events.iter_future_occurrences(
+    definitions, occurrences, now, now + datetime.timedelta(num_days)))
+  refresh_time = time.time() - start
+  sys.stdout.write("list model: %d rows, %.2f seconds built, %.2f seconds "
+                   "refreshed (%d changes)\n"
+                   % (len(model), build_time, refresh_time, len(changes)))
+  return {'build_seconds': build_time, 'refresh_seconds': refresh_time}
+
+
+def bench_window(num_definitions=2000, num_days=60, num_ticks=30):
+  """Report the time taken to move a look-ahead window forward a day
+  at a time by recomputing it, and by sliding it."""
+  filepath = os.path.join(bench_temp_dir, 'window')
+  write_synthetic_data_file(filepath, num_definitions, 0)
+  definitions, occurrences = storage.read_data_file(filepath)
+  now = datetime.date(2008, 1, 1)
+  start = time.time()
+  for i in range(num_ticks):
+    date = now + datetime.timedelta(i)
+    list(events.iter_future_occurrences(definitions, occurrences, date,
+                                        date + datetime.timedelta(num_days)))
+  recompute_time = time.time() - start
+  sw = window.SlidingWindow(definitions, occurrences, now, num_days)
+  start = time.time()
+  for i in range(num_ticks):
+    sw.advance(now + datetime.timedelta(i))
+  slide_time = time.time() - start
+  sys.stdout.write("window: %d ticks, %.3f seconds recomputed, "
+                   "%.3f seconds slid\n"
+                   % (num_ticks, recompute_time, slide_time))
+  return {'recompute_seconds': recompute_time, 'slide_seconds': slide_time}
+
+
+def bench_parallel(num_definitions=20000, num_days=366):
+  """Report the time taken to expand a year of a large definition set
+  in-process, and across a process pool."""
+  filepath = os.path.join(bench_temp_dir, 'parallel')
+  write_synthetic_data_file(filepath, num_definitions, 0)
+  definitions, occurrences = storage.read_data_file(filepath)
+  now = datetime.date(2008, 1, 1)
+  end = now + datetime.timedelta(num_days)
+  start = time.time()
+  batch.expand_definitions(definitions, now, end, use_numpy=False)
+  single_time = time.time() - start
+  start = time.time()
+  parallel.expand_definitions(definitions, now, end, use_numpy=False)
+  parallel_time = time.time() - start
+  sys.stdout.write("parallel: %d definitions, %.2f seconds in-process, "
+                   "%.2f seconds pooled\n"
+                   % (num_definitions, single_time, parallel_time))
+  return {'seconds': single_time, 'pooled_seconds': parallel_time}
+
+
+# (name, function, takes the calendar data file path?), in run order.
+BENCHMARKS = [
+  ('calendar_read', bench_calendar_read, True),
+  ('calendar_write', bench_calendar_write, True),
+  ('calendar_queries', bench_calendar_queries, True),
+  ('calendar_table', bench_calendar_table, True),
+  ('calendar_ui', bench_calendar_ui, True),
+  ('memory', bench_memory, False),
+  ('read', bench_read, False),
+  ('clear', bench_clear, False),
+  ('startup', bench_startup, False),
+  ('list_model', bench_list_model, False),
+  ('window', bench_window, False),
+  ('parallel', bench_parallel, False),
+  ]
+
+
+def run_measured(func, args=()):
+  """Return the dictionary of measurements returned by FUNC(*ARGS),
+  with its wall time and peak memory (in kilobytes, or None if that
+  can't be determined) added as 'wall_seconds' and 'peak_memory_kb'.
+  FUNC is run in a child process where possible, so that the peak is
+  its own."""
+  if not hasattr(os, 'fork'):
+    start = time.time()
+    results = func(*args)
+    results['wall_seconds'] = time.time() - start
+    results['peak_memory_kb'] = _get_peak_memory()
+    return results
+  sys.stdout.flush()
+  read_fd, write_fd = os.pipe()
+  pid = os.fork()
+  if pid == 0:
+    status = 1
+    try:
+      try:
+        os.close(read_fd)
+        start = time.time()
+        results = func(*args)
+        results['wall_seconds'] = time.time() - start
+        results['peak_memory_kb'] = _get_peak_memory()
+        fp = os.fdopen(write_fd, 'w')
+        fp.write(json.dumps(results))
+        fp.close()
+        status = 0
+      except:
+        traceback.print_exc()
+    finally:
+      sys.stdout.flush()
+      sys.stderr.flush()
+      os._exit(status)
+  os.close(write_fd)
+  fp = os.fdopen(read_fd, 'r')
+  data = fp.read()
+  fp.close()
+  pid, status = os.waitpid(pid, 0)
+  if status:
+    raise RuntimeError("Benchmark %s failed" % (func.__name__))
+  return json.loads(data)
+
+
+def compare_results(baseline, results, stream=None):
+  """Write to STREAM (by default, sys.stdout) the ratio of each
+  measurement in RESULTS to the same measurement in BASELINE (both as
+  saved with --json)."""
+  stream = stream or sys.stdout
+  for name in sorted(results['results']):
+    old = baseline['results'].get(name)
+    if old is None:
+      continue
+    new = results['results'][name]
+    for key in sorted(new):
+      if key in old and old[key] and new[key] is not None:
+        stream.write("%s.%s: %s -> %s (x%.2f)\n"
+                     % (name, key, old[key], new[key],
+                        float(new[key]) / old[key]))
+
+
+def usage_and_exit(errmsg=None):
+  progname = os.path.basename(sys.argv[0])
+  stream = errmsg is None and sys.stdout or sys.stderr
+  stream.write("""\
+%s - Recurrence performance measurements
+
+Usage: %s [OPTIONS] [BENCHMARK...]
+
+   Run the named benchmarks (by default, all of them):
+   %s.
+
+Options:
+
+   --help (-h):        Show this usage message and exit.
+   --json FILE:        Save the results, as JSON, to FILE.
+   --compare FILE:     Compare the results to those saved in FILE.
+   --definitions N:    Generate N calendar definitions (default 2000).
+   --occurrences M:    Generate M calendar occurrences (default 100000).
+   --cleared-ratio R:  Clear generated occurrences at ratio R (default 0.9).
+   --seed S:           Generate the calendar from seed S (default 0).
+
+""" % (progname, progname, ', '.join([b[0] for b in BENCHMARKS])))
+  if errmsg is not None:
+    stream.write("ERROR: %s\n" % (errmsg))
+    sys.exit(1)
+  sys.exit(0)
+
+
+def main():
+  try:
+    opts, args = getopt.getopt(sys.argv[1:], 'h',
+                               ['help', 'json=', 'compare=', 'definitions=',
+                                'occurrences=', 'cleared-ratio=', 'seed='])
+  except getopt.GetoptError, e:
+    usage_and_exit(str(e))
+  json_filepath = compare_filepath = None
+  params = {'definitions': 2000, 'occurrences': 100000,
+            'cleared_ratio': 0.9, 'seed': 0}
+  for opt, value in opts:
+    try:
+      if opt in ('-h', '--help'):
+        usage_and_exit()
+      elif opt == '--json':
+        json_filepath = value
+      elif opt == '--compare':
+        compare_filepath = value
+      elif opt == '--cleared-ratio':
+        params['cleared_ratio'] = float(value)
+      else:
+        params[opt[2:]] = int(value)
+    except ValueError:
+      usage_and_exit("Invalid value for option '%s'" % (opt))
+  names = [b[0] for b in BENCHMARKS]
+  for name in args:
+    if name not in names:
+      usage_and_exit("Unknown benchmark '%s'" % (name))
+
+  results = {'python': platform.python_version(),
+             'platform': platform.platform(),
+             'time': time.time(),
+             'parameters': params,
+             'results': {}}
+  os.mkdir(bench_temp_dir)
+  try:
+    calendar_filepath = os.path.join(bench_temp_dir, 'calendar')
+    write_calendar_data_file(calendar_filepath, params['definitions'],
+                             params['occurrences'], params['cleared_ratio'],
+                             params['seed'])
+    for name, func, uses_calendar in BENCHMARKS:
+      if args and name not in args:
+        continue
+      func_args = uses_calendar and (calendar_filepath,) or ()
+      results['results'][name] = run_measured(func, func_args)
+  finally:
+    shutil.rmtree(bench_temp_dir)
+  if json_filepath:
+    fp = open(json_filepath, 'w')
+    json.dump(results, fp, indent=2, sort_keys=True)
+    fp.close()
+  if compare_filepath:
+    fp = open(compare_filepath)
+    baseline = json.load(fp)
+    fp.close()
+    compare_results(baseline, results)
+
+
+if __name__ == '__main__':
+  main()
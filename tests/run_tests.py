@@ -17,11 +17,15 @@ import sys
 import os
 import random
 import shutil
+import StringIO
+import subprocess
 import time
 import unittest
 import datetime
 sys.path.insert(0, os.path.abspath(os.path.join(sys.argv[0], "../..")))
-from recurrence_lib import events, storage
+from recurrence_lib import events, storage, batch, cache, watch, listmodel
+from recurrence_lib import store, window, parallel, scheduler, stats
+from recurrence_lib import multifile, table
 
 test_temp_dir = os.path.abspath(os.path.join(sys.argv[0], "../__TMP__"))
 test_data_dir = os.path.abspath(os.path.join(sys.argv[0], "../test_data"))
@@ -56,6 +60,396 @@ class TestRecurrenceStorage(unittest.TestCase):
     self.assertEqual(definitions, definitions2)
     self.assertEqual(occurrences, occurrences2)
 
+  def test_iter_data_file(self):
+    filepath = self._get_data_filename('basic_read')
+    records = list(storage.iter_data_file(filepath))
+    self.assertEqual(map(lambda x: x.__class__, records),
+                     [events.EventDefinition, events.EventDefinition,
+                      events.EventOccurrence, events.EventOccurrence,
+                      events.EventOccurrence])
+    self.assertEqual(records[0].get_description(),
+                     'My event\ncomplete with\ttabs, newlines, '
+                     'and \\slashes')
+    self.assertTrue(records[4].get_definition() is records[1])
+    self.assertEqual(records[4].get_date(), datetime.date(2011, 1, 1))
+    self.assertTrue(records[4].get_cleared())
+
+  def test_escape_round_trip(self):
+    write_filepath = self._get_temp_filename('escapes')
+    description = 'back\\n\\\\slash\\ttab\\r\t\n\r\\'
+    ed = events.EventDefinition('a\\tb', description,
+                                datetime.date(2011, 1, 1))
+    storage.write_data_file(write_filepath, [ed], [])
+    definitions, occurrences = storage.read_data_file(write_filepath)
+    self.assertEqual(definitions, [ed])
+
+  def test_journal(self):
+    read_filepath = self._get_data_filename('basic_read')
+    definitions, occurrences = storage.read_data_file(read_filepath)
+    write_filepath = self._get_temp_filename('journal')
+    storage.write_data_file(write_filepath, definitions, occurrences,
+                            storage.JOURNAL_VERSION)
+    snapshot_size = os.path.getsize(write_filepath)
+    ed = events.EventDefinition('ac', 'Yearly', datetime.date(2011, 1, 3),
+                                events.EventRecurrence('yearly'))
+    storage.journal_add_definition(write_filepath, ed)
+    eo = events.EventOccurrence(ed, datetime.date(2011, 1, 3))
+    storage.journal_add_occurrence(write_filepath, eo)
+    occurrences[0].set_cleared(True)
+    storage.journal_set_cleared(write_filepath, occurrences[0])
+    eo.set_cleared(True)
+    storage.journal_set_cleared(write_filepath, eo)
+    eo2 = events.EventOccurrence(ed, datetime.date(2012, 1, 3), True)
+    storage.journal_set_cleared(write_filepath, eo2)
+    definitions.append(ed)
+    occurrences.extend([eo, eo2])
+    definitions2, occurrences2 = storage.read_data_file(write_filepath)
+    self.assertEqual(definitions2, definitions)
+    self.assertEqual(occurrences2, occurrences)
+    self.assertTrue(os.path.getsize(write_filepath) > snapshot_size)
+
+    # Compaction folds the journal into the snapshot.
+    storage.compact_data_file(write_filepath)
+    self.assertEqual(storage.read_data_file(write_filepath),
+                     (definitions, occurrences))
+    fp = open(write_filepath, 'r')
+    fp.readline()
+    journal_offset = storage._read_journal_offset(fp)
+    fp.close()
+    self.assertEqual(journal_offset, os.path.getsize(write_filepath))
+
+    # As does exceeding the compaction threshold.
+    eo2.set_cleared(False)
+    storage.journal_set_cleared(write_filepath, eo2, compact_threshold=0)
+    self.assertEqual(storage.read_data_file(write_filepath),
+                     (definitions, occurrences))
+    self.assertEqual(os.listdir(test_temp_dir), ['journal'])
+
+  def test_journal_requires_version_2(self):
+    write_filepath = self._get_temp_filename('not_journal')
+    ed = events.EventDefinition('aa', 'Once', datetime.date(2011, 1, 1))
+    storage.write_data_file(write_filepath, [ed], [])
+    self.assertRaises(Exception, storage.journal_add_definition,
+                      write_filepath, ed)
+
+  def test_binary_round_trip(self):
+    read_filepath = self._get_data_filename('basic_read')
+    definitions, occurrences = storage.read_data_file(read_filepath)
+    binary_filepath = self._get_temp_filename('binary')
+    storage.convert_data_file(read_filepath, binary_filepath,
+                              storage.BINARY_VERSION)
+    self.assertEqual(storage.read_data_file(binary_filepath),
+                     (definitions, occurrences))
+    self.assertEqual(list(storage.iter_data_file(binary_filepath)),
+                     definitions + occurrences)
+    text_filepath = self._get_temp_filename('text')
+    storage.convert_data_file(binary_filepath, text_filepath, 1)
+    self.assertEqual(open(text_filepath, 'rb').read(),
+                     open(read_filepath, 'rb').read())
+
+  def test_cleared_through_round_trip(self):
+    er = events.EventRecurrence(events.EVENT_PERIOD_MONTHLY)
+    ed1 = events.EventDefinition('aa', 'Monthly', datetime.date(2011, 1, 1),
+                                 er, datetime.date(2011, 3, 1))
+    ed2 = events.EventDefinition('ab', 'Once', datetime.date(2011, 2, 1),
+                                 None, datetime.date(2011, 2, 1))
+    ed3 = events.EventDefinition('ac', 'Other', datetime.date(2011, 1, 1), er)
+    eo = events.EventOccurrence(ed3, datetime.date(2011, 2, 1), True)
+    for version in (1, storage.WATERMARK_VERSION, storage.JOURNAL_VERSION,
+                    storage.BINARY_VERSION):
+      write_filepath = self._get_temp_filename('cleared_through')
+      storage.write_data_file(write_filepath, [ed1, ed2, ed3], [eo], version)
+      self.assertEqual(storage.read_data_file(write_filepath),
+                       ([ed1, ed2, ed3], [eo]))
+
+    # Version 1 records have no room for cleared-through dates, so such
+    # files are written in version 4, and version 2 files journal them.
+    text_filepath = self._get_temp_filename('cleared_through_text')
+    storage.write_data_file(text_filepath, [ed1, ed2, ed3], [eo], 1)
+    self.assertEqual(open(text_filepath).readline(), '#version = 4\n')
+    storage.write_data_file(text_filepath, [ed3], [eo], 1)
+    self.assertEqual(open(text_filepath).readline(), '#version = 1\n')
+    storage.write_data_file(text_filepath, [ed1, ed2, ed3], [eo],
+                            storage.JOURNAL_VERSION)
+    lines = open(text_filepath).readlines()
+    for line in lines:
+      if line.startswith('EventDefinition'):
+        self.assertTrue(len(line.split('\t')) <= 6)
+    self.assertEqual(lines[-2:], ['ClearedThrough\taa\t2011-03-01\n',
+                                  'ClearedThrough\tab\t2011-02-01\n'])
+
+    # Binary files written before the cleared-through field still read.
+    fp = open(write_filepath, 'rb')
+    fp.readline()
+    header = storage._binary_header.unpack(
+      fp.read(storage._binary_header.size))
+    data = fp.read()
+    fp.close()
+    old_size = storage._binary_definition_base.size
+    records = data[:3 * storage._binary_definition.size]
+    fp = open(write_filepath, 'wb')
+    fp.write('#version = 3\n')
+    fp.write(storage._binary_header.pack(header[0], header[1], header[2],
+                                         old_size, header[4]))
+    for i in range(3):
+      offset = i * storage._binary_definition.size
+      fp.write(records[offset:offset + old_size])
+    fp.write(data[len(records):])
+    fp.close()
+    definitions, occurrences = storage.read_data_file(write_filepath)
+    self.assertEqual([ed.get_cleared_through() for ed in definitions],
+                     [None, None, None])
+    self.assertEqual(occurrences, [eo])
+
+  def test_journal_clear_through(self):
+    er = events.EventRecurrence(events.EVENT_PERIOD_WEEKLY)
+    ed = events.EventDefinition('aa', 'Weekly', datetime.date(2011, 1, 3), er)
+    occurrences = [events.EventOccurrence(ed, datetime.date(2011, 1, 3)),
+                   events.EventOccurrence(ed, datetime.date(2011, 1, 10),
+                                          True),
+                   events.EventOccurrence(ed, datetime.date(2011, 1, 24))]
+    write_filepath = self._get_temp_filename('journal')
+    storage.write_data_file(write_filepath, [ed], occurrences,
+                            storage.JOURNAL_VERSION)
+    events.clear_through(ed, datetime.date(2011, 1, 17), occurrences)
+    self.assertEqual(len(occurrences), 1)
+    storage.journal_clear_through(write_filepath, ed)
+    self.assertEqual(storage.read_data_file(write_filepath),
+                     ([ed], occurrences))
+    storage.compact_data_file(write_filepath)
+    self.assertEqual(storage.read_data_file(write_filepath),
+                     ([ed], occurrences))
+
+    # The group-commit writer drops the redundant records too.
+    writer = storage.DataFileWriter(write_filepath, [ed], occurrences)
+    writer.clear_through([ed], datetime.date(2011, 1, 31))
+    writer.close()
+    self.assertEqual(storage.read_data_file(write_filepath), ([ed], []))
+    self.assertEqual(writer.occurrences_by_key, {})
+
+  def test_purge_data_file(self):
+    weekly = events.EventRecurrence(events.EVENT_PERIOD_WEEKLY)
+    ended = events.EventRecurrence(events.EVENT_PERIOD_WEEKLY,
+                                   datetime.date(2011, 1, 10))
+    ed1 = events.EventDefinition('aa', 'Done', datetime.date(2011, 1, 3))
+    ed2 = events.EventDefinition('ab', 'Ended', datetime.date(2011, 1, 3),
+                                 ended)
+    ed3 = events.EventDefinition('ac', 'Unpaid', datetime.date(2011, 1, 3),
+                                 ended)
+    ed4 = events.EventDefinition('ad', 'Ongoing', datetime.date(2011, 1, 3),
+                                 weekly)
+    eo1 = events.EventOccurrence(ed1, datetime.date(2011, 1, 3), True)
+    eo2 = events.EventOccurrence(ed2, datetime.date(2011, 1, 10), True)
+    eo3 = events.EventOccurrence(ed3, datetime.date(2011, 1, 10))
+    eo4 = events.EventOccurrence(ed4, datetime.date(2011, 1, 3), True)
+    eo5 = events.EventOccurrence(ed4, datetime.date(2011, 1, 10))
+    eo6 = events.EventOccurrence(ed4, datetime.date(2011, 2, 7), True)
+    definitions = [ed1, ed2, ed3, ed4]
+    occurrences = [eo1, eo2, eo3, eo4, eo5, eo6]
+    for version in (1, storage.BINARY_VERSION):
+      write_filepath = self._get_temp_filename('purge_%d' % (version))
+      storage.write_data_file(write_filepath, definitions, occurrences,
+                              version)
+      size = os.path.getsize(write_filepath)
+      result = storage.purge_data_file(write_filepath,
+                                       datetime.date(2011, 2, 1))
+      self.assertEqual(result[:2], (2, 3))
+      self.assertEqual(result[2], size - os.path.getsize(write_filepath))
+      self.assertEqual(storage.read_data_file(write_filepath),
+                       ([ed3, ed4], [eo3, eo5, eo6]))
+      archive_filepath = storage.get_archive_path(write_filepath)
+      self.assertEqual(storage.read_data_file(archive_filepath),
+                       ([ed1, ed2, ed4], [eo1, eo2, eo4]))
+
+      # Nothing more to purge leaves the files be.
+      self.assertEqual(storage.purge_data_file(write_filepath,
+                                               datetime.date(2011, 2, 1)),
+                       (0, 0, 0))
+
+      # Later purges add to the archive.
+      eo3.set_cleared(True)
+      storage.write_data_file(write_filepath, [ed3, ed4], [eo3, eo5, eo6],
+                              version)
+      self.assertEqual(storage.purge_data_file(write_filepath,
+                                               datetime.date(2011, 2, 1))[:2],
+                       (1, 1))
+      eo3.set_cleared(False)
+      self.assertEqual(storage.read_data_file(archive_filepath)[0],
+                       [ed1, ed2, ed4, ed3])
+
+      # The archive can be read back alongside the data file.
+      definitions2, occurrences2 = \
+        storage.read_data_file_with_archive(write_filepath)
+      self.assertEqual(len(definitions2), 4)
+      self.assertEqual(len(occurrences2), 6)
+      self.assertTrue(occurrences2[2].get_definition() is definitions2[0])
+
+    # Cleared future occurrences stay put, whatever BEFORE says.
+    today = datetime.date.today()
+    ed5 = events.EventDefinition('ae', 'Future', today, weekly)
+    eo7 = events.EventOccurrence(ed5, today + datetime.timedelta(7), True)
+    write_filepath = self._get_temp_filename('purge_future')
+    storage.write_data_file(write_filepath, [ed5], [eo7])
+    self.assertEqual(storage.purge_data_file(
+      write_filepath, today + datetime.timedelta(30)), (0, 0, 0))
+    definitions2, occurrences2 = storage.read_data_file(write_filepath)
+    self.assertEqual(occurrences2, [eo7])
+    future = events._get_future_occurrences(definitions2, occurrences2,
+                                            today, 20)
+    self.assertEqual([occurrence.get_date() for occurrence in future],
+                     [today, today + datetime.timedelta(14)])
+
+  def test_binary_unknown_definition(self):
+    ed = events.EventDefinition('aa', 'Once', datetime.date(2011, 1, 1))
+    eo = events.EventOccurrence(ed, datetime.date(2011, 1, 1))
+    self.assertRaises(Exception, storage.write_data_file,
+                      self._get_temp_filename('binary'), [], [eo],
+                      storage.BINARY_VERSION)
+
+  def test_read_definition(self):
+    filepath = self._get_temp_filename('indexed')
+    shutil.copy(self._get_data_filename('basic_read'), filepath)
+    definitions, occurrences = storage.read_data_file(filepath)
+    definition, occurrences2 = storage.read_definition(filepath, 'ab')
+    self.assertEqual(definition, definitions[1])
+    self.assertEqual(occurrences2, occurrences)
+    self.assertTrue(os.path.exists(storage.get_index_path(filepath)))
+    definition, occurrences2 = storage.read_definition(filepath, 'aa')
+    self.assertEqual(definition, definitions[0])
+    self.assertEqual(occurrences2, [])
+    self.assertRaises(KeyError, storage.read_definition, filepath, 'ac')
+
+    # Changing the data file makes the index stale.
+    ed = events.EventDefinition('ac', 'Another event',
+                                datetime.date(2011, 1, 2))
+    eo = events.EventOccurrence(ed, datetime.date(2011, 1, 2))
+    storage.write_data_file(filepath, [ed] + definitions, occurrences + [eo])
+    self.assertEqual(storage.read_definition(filepath, 'ac'), (ed, [eo]))
+    self.assertEqual(storage.read_definition(filepath, 'ab'),
+                     (definitions[1], occurrences))
+
+  def test_snapshot_cache(self):
+    filepath = self._get_temp_filename('cached')
+    cache_dir = self._get_temp_filename('cache')
+    shutil.copy(self._get_data_filename('basic_read'), filepath)
+    definitions, occurrences = storage.read_data_file(filepath)
+    self.assertEqual(cache.load_data_file(filepath, cache_dir),
+                     (definitions, occurrences))
+    self.assertTrue(os.path.exists(cache.get_snapshot_path(filepath,
+                                                           cache_dir)))
+
+    # A cache hit doesn't parse the data file.
+    read_data_file = storage.read_data_file
+    def fail(filepath):
+      self.fail("Data file parsed despite a current snapshot.")
+    storage.read_data_file = fail
+    try:
+      self.assertEqual(cache.load_data_file(filepath, cache_dir),
+                       (definitions, occurrences))
+    finally:
+      storage.read_data_file = read_data_file
+
+    # Content changes invalidate the snapshot, even if the size and
+    # modification time are preserved.
+    st = os.stat(filepath)
+    contents = open(filepath, 'rb').read().replace('2011-01-15',
+                                                   '2011-01-22')
+    fp = open(filepath, 'wb')
+    fp.write(contents)
+    fp.close()
+    os.utime(filepath, (st.st_atime, st.st_mtime))
+    definitions, occurrences = cache.load_data_file(filepath, cache_dir)
+    self.assertEqual(occurrences[1].get_date(), datetime.date(2011, 1, 22))
+
+  def test_data_file_writer(self):
+    read_filepath = self._get_data_filename('basic_read')
+    write_filepath = self._get_temp_filename('writer')
+    shutil.copy(read_filepath, write_filepath)
+    definitions, occurrences = storage.read_data_file(write_filepath)
+    new_occurrence = events.EventOccurrence(definitions[1],
+                                            datetime.date(2011, 1, 22))
+    writer = storage.DataFileWriter(write_filepath, definitions, occurrences,
+                                    batch_size=3)
+    writer.set_cleared(occurrences[0])
+    writer.set_cleared(new_occurrence)
+    self.assertEqual(storage.read_data_file(write_filepath)[1][0].get_cleared(),
+                     False)
+    writer.set_cleared(occurrences[1])
+    self.assertEqual(storage.read_data_file(write_filepath),
+                     (definitions, occurrences))
+    self.assertEqual(len(occurrences), 4)
+    writer.set_cleared(occurrences[1], False)
+    self.assertEqual(storage.read_data_file(write_filepath)[1][1].get_cleared(),
+                     True)
+    writer.close()
+    self.assertEqual(storage.read_data_file(write_filepath),
+                     (definitions, occurrences))
+
+  def test_data_file_writer_context(self):
+    read_filepath = self._get_data_filename('basic_read')
+    write_filepath = self._get_temp_filename('writer')
+    definitions, occurrences = storage.read_data_file(read_filepath)
+    writer = storage.DataFileWriter(write_filepath, definitions, occurrences,
+                                    delay=3600, fsync=True)
+    with writer:
+      for occurrence in occurrences:
+        writer.set_cleared(occurrence)
+      self.assertFalse(os.path.exists(write_filepath))
+    self.assertEqual(writer.timer, None)
+    self.assertEqual(storage.read_data_file(write_filepath),
+                     (definitions, occurrences))
+
+  def test_replace_file_preserves_mode(self):
+    read_filepath = self._get_data_filename('basic_read')
+    write_filepath = self._get_temp_filename('writer')
+    link_filepath = self._get_temp_filename('writer_link')
+    shutil.copy(read_filepath, write_filepath)
+    os.chmod(write_filepath, 0644)
+    definitions, occurrences = storage.read_data_file(write_filepath)
+    writer = storage.DataFileWriter(write_filepath, definitions, occurrences)
+    writer.set_cleared(occurrences[0])
+    writer.close()
+    self.assertEqual(os.stat(write_filepath).st_mode & 0777, 0644)
+    if hasattr(os, 'symlink'):
+      os.symlink('writer', link_filepath)
+      self.assertEqual(storage.purge_data_file(link_filepath)[:2], (1, 2))
+      self.assertTrue(os.path.islink(link_filepath))
+      self.assertEqual(os.stat(write_filepath).st_mode & 0777, 0644)
+      self.assertEqual(storage.read_data_file(link_filepath),
+                       (definitions[1:], occurrences[1:2]))
+
+  def test_read_shares_recurrences(self):
+    write_filepath = self._get_temp_filename('shared_recurrences')
+    er = events.EventRecurrence(events.EVENT_PERIOD_MONTHLY)
+    definitions = [
+      events.EventDefinition('aa', 'One', datetime.date(2011, 1, 1), er),
+      events.EventDefinition('ab', 'Two', datetime.date(2011, 1, 2),
+                             events.EventRecurrence(er.get_period())),
+      ]
+    storage.write_data_file(write_filepath, definitions, [])
+    definitions2, occurrences2 = storage.read_data_file(write_filepath)
+    self.assertEqual(len(definitions2), 2)
+    self.assertTrue(definitions2[0].get_recurrence()
+                    is definitions2[1].get_recurrence())
+    self.assertTrue(events.intern_recurrence(events.EVENT_PERIOD_MONTHLY)
+                    is definitions2[0].get_recurrence())
+
+  def test_interned_recurrences_are_immutable(self):
+    until_date = datetime.date(2011, 6, 1)
+    er = events.intern_recurrence(events.EVENT_PERIOD_WEEKLY)
+    self.assertRaises(events.ImmutableEventRecurrence,
+                      er.set_until_date, until_date)
+    self.assertRaises(events.ImmutableEventRecurrence,
+                      er.set_period, events.EVENT_PERIOD_MONTHLY)
+    self.assertEqual(er.get_until_date(), None)
+    self.assertTrue(events.intern_recurrence(events.EVENT_PERIOD_WEEKLY)
+                    is er)
+    ed = events.EventDefinition('aa', 'One', datetime.date(2011, 1, 1), er)
+    ed.set_recurrence(events.intern_recurrence(events.EVENT_PERIOD_WEEKLY,
+                                               until_date))
+    self.assertEqual(ed.get_recurrence().get_until_date(), until_date)
+    self.assertEqual(er.get_until_date(), None)
+
   def test_create_and_store(self):
     now = datetime.date.today()
     later = now - datetime.timedelta(1)
@@ -76,5 +470,719 @@ class TestRecurrenceStorage(unittest.TestCase):
     self.assertEqual(occurrences, occurrences2)
     
 
+class TestRecurrenceEvents(unittest.TestCase):
+
+  def _step_to_first_date_on_or_after(self, definition, date):
+    occ = definition.get_first_occurrence()
+    while occ is not None and occ.get_date() < date:
+      occ = occ.next()
+    return occ and occ.get_date() or None
+
+  def test_first_date_on_or_after(self):
+    start = datetime.date(2001, 1, 15)
+    for period in (events.EVENT_PERIOD_WEEKLY,
+                   events.EVENT_PERIOD_MONTHLY,
+                   events.EVENT_PERIOD_YEARLY):
+      for until_date in (None, datetime.date(2009, 6, 30)):
+        er = events.EventRecurrence(period, until_date)
+        ed = events.EventDefinition('aa', 'Recurring', start, er)
+        date = datetime.date(2000, 12, 1)
+        while date < datetime.date(2011, 1, 1):
+          self.assertEqual(ed.get_first_date_on_or_after(date),
+                           self._step_to_first_date_on_or_after(ed, date))
+          date = date + datetime.timedelta(13)
+
+  def test_first_date_on_or_after_no_recurrence(self):
+    start = datetime.date(2011, 1, 1)
+    before = start - datetime.timedelta(1)
+    after = start + datetime.timedelta(1)
+    ed = events.EventDefinition('aa', 'Once', start)
+    self.assertEqual(ed.get_first_date_on_or_after(before), start)
+    self.assertEqual(ed.get_first_date_on_or_after(start), start)
+    self.assertEqual(ed.get_first_date_on_or_after(after), None)
+    self.assertEqual(ed.get_first_occurrence_on_or_after(after), None)
+
+  def test_future_occurrences(self):
+    er = events.EventRecurrence(events.EVENT_PERIOD_WEEKLY)
+    ed = events.EventDefinition('aa', 'Weekly', datetime.date(2001, 1, 1), er)
+    eo = events.EventOccurrence(ed, datetime.date(2011, 1, 17), True)
+    occs = events._get_future_occurrences([ed], [eo],
+                                          datetime.date(2011, 1, 5), 21)
+    self.assertEqual(map(lambda x: x.get_date(), occs),
+                     [datetime.date(2011, 1, 10), datetime.date(2011, 1, 24)])
+
+  def test_clearance_index(self):
+    ed = events.EventDefinition('aa', 'Once', datetime.date(2011, 1, 1))
+    ed2 = events.EventDefinition('aa', 'Once', datetime.date(2011, 1, 1))
+    eo = events.EventOccurrence(ed, datetime.date(2011, 1, 1))
+    index = events.ClearanceIndex([eo])
+    self.assertFalse(index.is_cleared(ed2, datetime.date(2011, 1, 1)))
+    index.set_cleared(eo, True)
+    self.assertTrue(eo.get_cleared())
+    self.assertTrue(index.is_cleared(ed2, datetime.date(2011, 1, 1)))
+    self.assertFalse(index.is_cleared(ed2, datetime.date(2011, 1, 2)))
+    index.remove_occurrence(eo)
+    self.assertFalse(index.is_cleared(ed2, datetime.date(2011, 1, 1)))
+
+  def test_clear_through(self):
+    er = events.EventRecurrence(events.EVENT_PERIOD_WEEKLY)
+    ed1 = events.EventDefinition('aa', 'Weekly', datetime.date(2011, 1, 3), er)
+    ed2 = events.EventDefinition('ab', 'Other', datetime.date(2011, 1, 3), er)
+    eo1 = events.EventOccurrence(ed1, datetime.date(2011, 1, 3))
+    eo2 = events.EventOccurrence(ed1, datetime.date(2011, 1, 10), True)
+    eo3 = events.EventOccurrence(ed1, datetime.date(2011, 1, 24), True)
+    eo4 = events.EventOccurrence(ed2, datetime.date(2011, 1, 3))
+    occurrences = [eo1, eo2, eo3, eo4]
+    index = events.ClearanceIndex(occurrences)
+    removed = events.clear_through(ed1, datetime.date(2011, 1, 17),
+                                   occurrences, index)
+    self.assertEqual(removed, [eo1, eo2])
+    self.assertEqual(occurrences, [eo3, eo4])
+    self.assertEqual(ed1.get_cleared_through(), datetime.date(2011, 1, 17))
+    self.assertEqual(index.cleared_counts,
+                     {('aa', datetime.date(2011, 1, 24)) : 1})
+    for day, cleared in ((10, True), (17, True), (24, True), (31, False)):
+      self.assertEqual(index.is_cleared(ed1, datetime.date(2011, 1, day)),
+                       cleared)
+    self.assertFalse(index.is_cleared(ed2, datetime.date(2011, 1, 17)))
+
+    # The cleared-through date never moves back.
+    events.clear_through([ed1, ed2], datetime.date(2011, 1, 10))
+    self.assertEqual(ed1.get_cleared_through(), datetime.date(2011, 1, 17))
+    self.assertEqual(ed2.get_cleared_through(), datetime.date(2011, 1, 10))
+
+    # Queries honor the cleared-through date, stored records or not.
+    now = datetime.date(2011, 1, 12)
+    occurrences.append(events.EventOccurrence(ed1, datetime.date(2011, 1, 3)))
+    self.assertEqual(events._get_past_occurrences([ed1, ed2], occurrences,
+                                                  now), [])
+    self.assertEqual([(o.get_definition(), o.get_date()) for o in
+                      events._get_future_occurrences([ed1, ed2], [], now, 14)],
+                     [(ed1, datetime.date(2011, 1, 24)),
+                      (ed2, datetime.date(2011, 1, 17)),
+                      (ed2, datetime.date(2011, 1, 24))])
+
+  def test_hash_consistent_with_eq(self):
+    er = events.EventRecurrence(events.EVENT_PERIOD_MONTHLY)
+    ed = events.EventDefinition('aa', 'Monthly', datetime.date(2011, 1, 1),
+                                er)
+    ed2 = events.EventDefinition('aa', 'Monthly', datetime.date(2011, 1, 1),
+                                 events.EventRecurrence(er.get_period()))
+    self.assertEqual(ed, ed2)
+    self.assertFalse(ed != ed2)
+    self.assertEqual(hash(ed), hash(ed2))
+    self.assertEqual(hash(ed.get_first_occurrence()),
+                     hash(ed2.get_first_occurrence()))
+
+  def test_iter_future_occurrences(self):
+    weekly = events.EventRecurrence(events.EVENT_PERIOD_WEEKLY)
+    monthly = events.EventRecurrence(events.EVENT_PERIOD_MONTHLY)
+    definitions = [
+      events.EventDefinition('aa', 'Weekly', datetime.date(2001, 1, 1),
+                             weekly),
+      events.EventDefinition('ab', 'Monthly', datetime.date(2001, 1, 10),
+                             monthly),
+      events.EventDefinition('ac', 'Also monthly', datetime.date(2001, 1, 10),
+                             monthly),
+      events.EventDefinition('ad', 'Once', datetime.date(2011, 1, 20)),
+      ]
+    occurrences = [
+      events.EventOccurrence(definitions[0], datetime.date(2011, 1, 17), True),
+      ]
+    now = datetime.date(2011, 1, 5)
+    end = now + datetime.timedelta(60)
+    expected = events._get_future_occurrences(definitions, occurrences,
+                                              now, 60)
+    expected.sort(key=events.occurrence_sort_key)
+    occs = list(events.iter_future_occurrences(definitions, occurrences,
+                                               now, end))
+    self.assertEqual(occs, expected)
+    occs = list(events.iter_future_occurrences(definitions, occurrences,
+                                               now, max_count=4))
+    self.assertEqual(occs, expected[:4])
+    self.assertEqual(map(events.occurrence_sort_key, occs),
+                     [(datetime.date(2011, 1, 10), 'Also monthly'),
+                      (datetime.date(2011, 1, 10), 'Monthly'),
+                      (datetime.date(2011, 1, 10), 'Weekly'),
+                      (datetime.date(2011, 1, 20), 'Once')])
+
+  def test_iter_dates(self):
+    er = events.EventRecurrence(events.EVENT_PERIOD_MONTHLY,
+                                datetime.date(2011, 4, 10))
+    ed = events.EventDefinition('aa', 'Monthly', datetime.date(2010, 11, 10),
+                                er)
+    self.assertEqual(list(ed.iter_dates(datetime.date(2011, 1, 1))),
+                     [datetime.date(2011, 1, 10),
+                      datetime.date(2011, 2, 10),
+                      datetime.date(2011, 3, 10),
+                      datetime.date(2011, 4, 10)])
+    self.assertEqual(list(ed.iter_dates(datetime.date(2010, 12, 10),
+                                        datetime.date(2011, 1, 9))),
+                     [datetime.date(2010, 12, 10)])
+    stepped = []
+    occ = ed.get_first_occurrence()
+    while occ is not None:
+      stepped.append(occ)
+      occ = occ.next()
+    self.assertEqual(list(ed.iter_occurrences()), stepped)
+
+
+
+def _make_definitions():
+  # Return a reproducible assortment of 300 event definitions, starting
+  # between 2000 and 2010, with and without recurrences and until dates.
+  rand = random.Random(1)
+  periods = (None, events.EVENT_PERIOD_WEEKLY, events.EVENT_PERIOD_MONTHLY,
+             events.EVENT_PERIOD_YEARLY)
+  definitions = []
+  for i in range(300):
+    start = datetime.date(2000, 1, 1 + rand.randint(0, 27)) \
+            + datetime.timedelta(rand.randint(0, 120) * 30)
+    start = start.replace(day=min(start.day, 28))
+    er = None
+    period = rand.choice(periods)
+    if period:
+      until_date = None
+      if rand.randint(0, 1):
+        until_date = start + datetime.timedelta(rand.randint(-30, 4000))
+      er = events.EventRecurrence(period, until_date)
+    definitions.append(events.EventDefinition('def%d' % (i), 'Event',
+                                              start, er))
+  return definitions
+
+
+class TestRecurrenceBatch(unittest.TestCase):
+
+  def test_expand_definitions(self):
+    definitions = _make_definitions()
+    start = datetime.date(2005, 1, 1)
+    end = datetime.date(2006, 6, 30)
+    expected = []
+    for i in range(len(definitions)):
+      for date in definitions[i].iter_dates(start, end):
+        expected.append((date.toordinal(), i))
+    expected.sort()
+    indices, ordinals = batch.expand_definitions(definitions, start, end,
+                                                 use_numpy=False)
+    self.assertEqual(zip(ordinals, indices), expected)
+    if batch.numpy is not None:
+      indices, ordinals = batch.expand_definitions(definitions, start, end,
+                                                   use_numpy=True)
+      self.assertEqual(zip(map(int, ordinals), map(int, indices)), expected)
+
+  def test_get_future_occurrences(self):
+    definitions = _make_definitions()
+    now = datetime.date(2005, 3, 1)
+    occurrences = events._get_future_occurrences(definitions, [], now, 60)
+    for occurrence in occurrences[::3]:
+      occurrence.set_cleared(True)
+    expected = events._get_future_occurrences(definitions, occurrences,
+                                              now, 60)
+    key = lambda x: (x.get_date(), x.get_definition().get_uuid())
+    expected.sort(key=key)
+    future_occurrences = batch.get_future_occurrences(definitions,
+                                                      occurrences, now, 60)
+    future_occurrences.sort(key=key)
+    self.assertEqual(future_occurrences, expected)
+
+  def test_parallel_expand_definitions(self):
+    definitions = _make_definitions()
+    start = datetime.date(2005, 1, 1)
+    end = datetime.date(2006, 6, 30)
+    expected = batch.expand_definitions(definitions, start, end,
+                                        use_numpy=False)
+    self.assertEqual(parallel.expand_definitions(definitions, start, end,
+                                                 processes=3, threshold=0),
+                     expected)
+    now = datetime.date(2005, 3, 1)
+    self.assertEqual(parallel.get_future_occurrences(definitions, [], now, 60,
+                                                     processes=2,
+                                                     threshold=0),
+                     batch.get_future_occurrences(definitions, [], now, 60))
+
+
+class TestRecurrenceWatch(unittest.TestCase):
+
+  def setUp(self):
+    os.mkdir(test_temp_dir)
+
+  def tearDown(self):
+    shutil.rmtree(test_temp_dir)
+
+  def test_refresh_controller(self):
+    filepath = os.path.join(test_temp_dir, 'watched')
+    storage.write_data_file(filepath, [], [])
+    today = [datetime.date(2008, 6, 1)]
+    refresher = watch.RefreshController([filepath], lambda: today[0])
+    self.assertEqual(refresher.check(), ([], False))
+    er = events.EventRecurrence(events.EVENT_PERIOD_WEEKLY)
+    ed = events.EventDefinition('1', 'Event', datetime.date(2008, 6, 1), er)
+    storage.write_data_file(filepath, [ed], [])
+    self.assertEqual(refresher.check(), ([filepath], False))
+    self.assertEqual(refresher.check(), ([], False))
+    today[0] = datetime.date(2008, 6, 2)
+    self.assertEqual(refresher.check(), ([], True))
+    self.assertEqual(refresher.get_today(), today[0])
+    os.remove(filepath)
+    self.assertEqual(refresher.check(), ([filepath], False))
+
+
+class TestRecurrenceListModel(unittest.TestCase):
+
+  def _apply_changes(self, rows, changes):
+    rows = rows[:]
+    for op, index, row in changes:
+      if op == listmodel.CHANGE_DELETE:
+        self.assertEqual(rows[index], row)
+        del rows[index]
+      elif op == listmodel.CHANGE_INSERT:
+        rows.insert(index, row)
+      else:
+        self.assertEqual(rows[index][0], row[0])
+        rows[index] = row
+    return rows
+
+  def test_set_occurrences(self):
+    er = events.EventRecurrence(events.EVENT_PERIOD_WEEKLY)
+    definitions = []
+    for i in range(5):
+      definitions.append(events.EventDefinition(str(i), 'Event %d' % (i),
+                                                datetime.date(2008, 1, 1 + i),
+                                                er))
+    model = listmodel.EventListModel()
+    now = datetime.date(2008, 2, 1)
+    past = [events.EventOccurrence(definitions[0], datetime.date(2008, 1, 1))]
+    future = events._get_future_occurrences(definitions, past, now, 30)
+    changes = model.set_occurrences(past, future)
+    self.assertEqual(len(changes), len(model))
+    self.assertEqual(model.get_counts(), (1, len(future)))
+    self.assertEqual(model.get_item_text(0, 0), '2008-01-01')
+    self.assertEqual(model.is_past(0), True)
+    self.assertEqual(model.is_past(1), False)
+    self.assertEqual(model.set_occurrences(past, future), [])
+
+    # Make the past occurrence's definition non-recurring, and drop
+    # another definition:  only the affected rows should change.
+    rows = model.rows
+    definitions[0].set_recurrence(None)
+    del definitions[4]
+    future = events._get_future_occurrences(definitions, past, now, 30)
+    changes = model.set_occurrences(past, future)
+    self.assertEqual(self._apply_changes(rows, changes), model.rows)
+    ops = [change[0] for change in changes]
+    self.assertEqual(ops.count(listmodel.CHANGE_INSERT), 0)
+    self.assertEqual(ops.count(listmodel.CHANGE_UPDATE), 1)
+    self.assertEqual(ops.count(listmodel.CHANGE_DELETE), 4 + 5)
+    self.assertEqual(model.get_item_text(0, 2), 'once')
+
+    # Clear the past occurrence.
+    rows = model.rows
+    changes = model.set_occurrences([], future)
+    self.assertEqual(self._apply_changes(rows, changes), model.rows)
+    self.assertEqual(changes, [(listmodel.CHANGE_DELETE, 0, rows[0])])
+    self.assertEqual(model.get_counts(), (0, len(future)))
+
+
+class TestRecurrenceStore(unittest.TestCase):
+
+  def test_memoized_queries(self):
+    self._check_memoized_queries(lambda definitions, occurrences:
+                                 occurrences)
+
+  def test_memoized_table_queries(self):
+    self._check_memoized_queries(table.OccurrenceTable)
+
+  def _check_memoized_queries(self, make_occurrences):
+    # MAKE_OCCURRENCES makes the store's occurrence container from its
+    # definitions and occurrences.
+    er = events.EventRecurrence(events.EVENT_PERIOD_WEEKLY)
+    ed1 = events.EventDefinition('1', 'Event 1', datetime.date(2008, 1, 1), er)
+    ed2 = events.EventDefinition('2', 'Event 2', datetime.date(2008, 6, 1))
+    eo = events.EventOccurrence(ed1, datetime.date(2008, 1, 8))
+    es = store.EventStore([ed1], make_occurrences([ed1], [eo]), cache_size=2)
+    now = datetime.date(2008, 2, 1)
+    past = es.get_past_occurrences(now)
+    future = es.get_future_occurrences(now, 30)
+    self.assertEqual(past, [eo])
+    self.assertEqual(len(future), 4)
+    self.assertEqual((es.hits, es.misses), (0, 2))
+
+    # Repeated queries hit the cache, and return copies.
+    past.pop()
+    self.assertEqual(es.get_past_occurrences(now), [eo])
+    self.assertEqual(es.get_future_occurrences(now, 30), future)
+    self.assertEqual((es.hits, es.misses), (2, 2))
+
+    # A definition outside the future window leaves it cached.
+    es.add_definition(ed2)
+    es.get_future_occurrences(now, 30)
+    self.assertEqual((es.hits, es.misses), (3, 2))
+
+    # Clearing a future occurrence invalidates the future window only.
+    es.add_occurrence(events.EventOccurrence(ed1, future[0].get_date(),
+                                             True))
+    self.assertEqual(es.get_future_occurrences(now, 30), future[1:])
+    self.assertEqual(es.get_past_occurrences(now), [eo])
+    self.assertEqual((es.hits, es.misses), (4, 3))
+
+    # Clearing the past occurrence invalidates the past window only.
+    es.set_cleared(eo)
+    self.assertEqual(es.get_past_occurrences(now), [])
+    self.assertEqual(es.get_future_occurrences(now, 30), future[1:])
+    self.assertEqual((es.hits, es.misses), (5, 4))
+
+    # The least recently used result is evicted.
+    es.get_future_occurrences(now, 60)
+    es.get_past_occurrences(now)
+    self.assertEqual((es.hits, es.misses), (5, 6))
+
+    # Clearing through a date drops the records it makes redundant.
+    es.add_occurrence(events.EventOccurrence(ed1, datetime.date(2008, 1, 15)))
+    self.assertEqual(len(es.get_past_occurrences(now)), 1)
+    es.clear_through(ed1, future[1].get_date())
+    self.assertEqual(es.get_occurrences(), [])
+    self.assertEqual(es.get_past_occurrences(now), [])
+    self.assertEqual(es.get_future_occurrences(now, 30), future[2:])
+
+    # Removing a definition removes its occurrences.
+    es.remove_definition(ed1)
+    self.assertEqual(es.get_occurrences(), [])
+    self.assertEqual(es.get_future_occurrences(now, 30), [])
+
+
+class TestRecurrenceWindow(unittest.TestCase):
+
+  def test_advance(self):
+    definitions = _make_definitions()
+    now = datetime.date(2005, 3, 1)
+    stored = events.EventOccurrence(definitions[0], now + \
+                                    datetime.timedelta(3))
+    occurrences = [stored]
+    clearance_index = events.ClearanceIndex(occurrences)
+    sw = window.SlidingWindow(definitions, occurrences, now, 30,
+                              clearance_index)
+    expected_past = []
+    for i in range(60):
+      expected = list(events.iter_future_occurrences(
+        definitions, occurrences, now, now + datetime.timedelta(30),
+        clearance_index=clearance_index))
+      self.assertEqual(sw.get_future_occurrences(), expected)
+      if i % 7 == 0 and expected:
+        clearance_index.set_cleared(expected[0], True)
+        occurrences.append(expected[0])
+      now = now + datetime.timedelta(1)
+      left, overdue, entered = sw.advance(now)
+      for occurrence in left:
+        self.assertEqual(occurrence.get_date(), now - datetime.timedelta(1))
+      for occurrence in entered:
+        self.assertEqual(occurrence.get_date(), now + datetime.timedelta(30))
+      expected_past.extend(overdue)
+    self.assertEqual(sw.get_now_date(), now)
+    self.assertEqual(stored in sw.get_past_occurrences(), True)
+    expected_past.append(stored)
+    key = lambda x: (x.get_date(), x.get_definition().get_uuid())
+    expected_past.sort(key=key)
+    self.assertEqual(sorted(sw.get_past_occurrences(), key=key),
+                     expected_past)
+    self.assertRaises(ValueError, sw.advance, now - datetime.timedelta(1))
+
+  def test_advance_by_several_days(self):
+    definitions = _make_definitions()
+    start = datetime.date(2005, 3, 1)
+    now = start
+    stored = events.EventOccurrence(definitions[0], now + \
+                                    datetime.timedelta(3))
+    occurrences = [stored]
+    clearance_index = events.ClearanceIndex(occurrences)
+    sw = window.SlidingWindow(definitions, occurrences, now, 30,
+                              clearance_index)
+    key = lambda x: (x.get_date(), x.get_definition().get_uuid())
+    for step in (1, 3, 10, 29, 30, 31, 45, 90, 365):
+      first = sw.get_future_occurrences()[0]
+      clearance_index.set_cleared(first, True)
+      occurrences.append(first)
+      now = now + datetime.timedelta(step)
+      left, overdue, entered = sw.advance(now)
+      self.assertEqual(sw.get_future_occurrences(),
+                       list(events.iter_future_occurrences(
+                         definitions, occurrences, now,
+                         now + datetime.timedelta(30),
+                         clearance_index=clearance_index)))
+      expected_past = list(events.iter_future_occurrences(
+        definitions, occurrences, start, now - datetime.timedelta(1),
+        clearance_index=clearance_index))
+      if stored.get_date() < now:
+        expected_past.append(stored)
+      self.assertEqual(sorted(sw.get_past_occurrences(), key=key),
+                       sorted(expected_past, key=key))
+
+  def test_advance_past_window(self):
+    er = events.EventRecurrence(events.EVENT_PERIOD_WEEKLY)
+    ed = events.EventDefinition('aa', 'Weekly', datetime.date(2011, 1, 3), er)
+    sw = window.SlidingWindow([ed], [], datetime.date(2011, 1, 1), 2)
+    self.assertEqual([occurrence.get_date()
+                      for occurrence in sw.get_future_occurrences()],
+                     [datetime.date(2011, 1, 3)])
+    left, overdue, entered = sw.advance(datetime.date(2011, 1, 20))
+    self.assertEqual(sw.get_future_occurrences(), [])
+    self.assertEqual(entered, [])
+    self.assertEqual([occurrence.get_date() for occurrence in left],
+                     [datetime.date(2011, 1, 3)])
+    expected = [datetime.date(2011, 1, 3), datetime.date(2011, 1, 10),
+                datetime.date(2011, 1, 17)]
+    self.assertEqual([occurrence.get_date() for occurrence in overdue],
+                     expected)
+    self.assertEqual([occurrence.get_date()
+                      for occurrence in sw.get_past_occurrences()],
+                     expected)
+    sw.advance(datetime.date(2011, 1, 23))
+    self.assertEqual([occurrence.get_date()
+                      for occurrence in sw.get_future_occurrences()],
+                     [datetime.date(2011, 1, 24)])
+
+
+class TestRecurrenceScheduler(unittest.TestCase):
+
+  def test_run_pending(self):
+    er = events.EventRecurrence(events.EVENT_PERIOD_WEEKLY)
+    ed1 = events.EventDefinition('1', 'Event 1', datetime.date(2008, 1, 1), er)
+    ed2 = events.EventDefinition('2', 'Event 2', datetime.date(2008, 1, 10))
+    occurrences = [events.EventOccurrence(ed1, datetime.date(2008, 1, 15),
+                                          True)]
+    reminded = []
+    today = datetime.date(2008, 1, 2)
+    rs = scheduler.ReminderScheduler([ed1, ed2], occurrences,
+                                     [reminded.append], today=today)
+    self.assertEqual(rs.run_pending(today), [])
+    self.assertEqual(rs.get_next_due_date(), datetime.date(2008, 1, 8))
+    now_time = time.mktime(datetime.datetime(2008, 1, 2, 18).timetuple())
+    self.assertEqual(rs.get_wakeup_delay(now_time), (5 * 24 + 6) * 3600)
+
+    # Reminders fire once, in date order, skipping cleared occurrences.
+    rs.run_pending(datetime.date(2008, 1, 15))
+    self.assertEqual([(o.get_definition(), o.get_date()) for o in reminded],
+                     [(ed1, datetime.date(2008, 1, 8)),
+                      (ed2, datetime.date(2008, 1, 10))])
+    self.assertEqual(rs.run_pending(datetime.date(2008, 1, 15)), [])
+    now_time = time.mktime(datetime.datetime(2008, 1, 16, 12).timetuple())
+    self.assertEqual(rs.get_wakeup_delay(now_time), (5 * 24 + 12) * 3600)
+
+    # Reloading doesn't repeat reminders already fired.
+    rs.load([ed1, ed2], occurrences, today=datetime.date(2008, 1, 2))
+    self.assertEqual(rs.get_next_due_date(), datetime.date(2008, 1, 22))
+
+  def test_stream_callback(self):
+    stream = StringIO.StringIO()
+    ed = events.EventDefinition('1', 'Event', datetime.date(2008, 1, 1))
+    scheduler.stream_callback(stream)(events.EventOccurrence(ed, \
+                                        datetime.date(2008, 1, 1)))
+    self.assertEqual(stream.getvalue(), '2008-01-01 | Event\n')
+
+
+class TestRecurrenceMultiFile(unittest.TestCase):
+
+  def setUp(self):
+    os.mkdir(test_temp_dir)
+    self.cache_dir = os.path.join(test_temp_dir, 'cache')
+
+  def tearDown(self):
+    shutil.rmtree(test_temp_dir)
+
+  def test_merged_queries(self):
+    er = events.EventRecurrence(events.EVENT_PERIOD_WEEKLY)
+    # Both files use the same uuid, for different events.
+    ed1 = events.EventDefinition('aa', 'Rent', datetime.date(2011, 1, 3), er)
+    ed2 = events.EventDefinition('aa', 'Gym', datetime.date(2011, 1, 3), er)
+    eo1 = events.EventOccurrence(ed1, datetime.date(2011, 1, 10), True)
+    eo2 = events.EventOccurrence(ed2, datetime.date(2011, 1, 3))
+    filepath1 = os.path.join(test_temp_dir, 'home')
+    filepath2 = os.path.join(test_temp_dir, 'work')
+    storage.write_data_file(filepath1, [ed1], [eo1])
+    storage.write_data_file(filepath2, [ed2], [eo2], storage.BINARY_VERSION)
+    missing_filepath = os.path.join(test_temp_dir, 'missing')
+    now = datetime.date(2011, 1, 7)
+    for processes in (1, 2):
+      stores = multifile.MultiFileStore([filepath1, filepath2], processes,
+                                        cache_dir=self.cache_dir)
+      self.assertEqual(stores.load(), {})
+      self.assertEqual(stores.get_definitions(),
+                       [(filepath1, ed1), (filepath2, ed2)])
+      self.assertEqual([(filepath, occurrence.get_date()) for
+                        filepath, occurrence in
+                        stores.get_future_occurrences(now, 10)],
+                       [(filepath2, datetime.date(2011, 1, 10)),
+                        (filepath2, datetime.date(2011, 1, 17)),
+                        (filepath1, datetime.date(2011, 1, 17))])
+      self.assertEqual(stores.get_past_occurrences(now), [(filepath2, eo2)])
+
+      # Only the files asked for are reloaded; unreadable ones keep their
+      # data.
+      store1 = stores.get_store(filepath1)
+      errors = stores.load([filepath2, missing_filepath])
+      self.assertEqual(errors.keys(), [missing_filepath])
+      self.assertTrue(stores.get_store(filepath1) is store1)
+      self.assertEqual(stores.get_store(missing_filepath), None)
+      self.assertEqual(len(stores.get_future_occurrences(now, 10)), 3)
+      stores.remove_file(filepath2)
+      self.assertEqual(len(stores.get_future_occurrences(now, 10)), 1)
+
+  def test_list_model_sources(self):
+    ed = events.EventDefinition('aa', 'Once', datetime.date(2011, 1, 3))
+    eo = events.EventOccurrence(ed, datetime.date(2011, 1, 3))
+    model = listmodel.EventListModel()
+    model.set_occurrences([('home', eo), ('work', eo)], [])
+    self.assertEqual(model.get_counts(), (2, 0))
+    self.assertEqual(model.get_row(0)[0][3], 'home')
+
+
+class TestRecurrenceTable(unittest.TestCase):
+
+  def setUp(self):
+    os.mkdir(test_temp_dir)
+
+  def tearDown(self):
+    shutil.rmtree(test_temp_dir)
+
+  def test_occurrence_table(self):
+    er = events.EventRecurrence(events.EVENT_PERIOD_WEEKLY)
+    ed1 = events.EventDefinition('aa', 'Weekly', datetime.date(2011, 1, 3), er,
+                                 datetime.date(2011, 1, 3))
+    ed2 = events.EventDefinition('ab', 'Once', datetime.date(2011, 1, 10))
+    occurrences = [events.EventOccurrence(ed1, datetime.date(2011, 1, 17)),
+                   events.EventOccurrence(ed2, datetime.date(2011, 1, 10)),
+                   events.EventOccurrence(ed1, datetime.date(2011, 1, 3)),
+                   events.EventOccurrence(ed1, datetime.date(2011, 1, 10),
+                                          True)]
+    ot = table.OccurrenceTable([ed1, ed2], occurrences)
+    self.assertEqual(len(ot), 4)
+    by_date = [occurrences[2], occurrences[1], occurrences[3], occurrences[0]]
+    self.assertEqual(list(ot), by_date)
+    self.assertEqual(ot[-1], occurrences[0])
+    self.assertEqual(ot[1:3], by_date[1:3])
+    self.assertRaises(IndexError, ot.__getitem__, 4)
+
+    # Queries match the list-based ones (the cleared-through date
+    # included), and the table is a view for the list-based API.
+    now = datetime.date(2011, 1, 17)
+    self.assertEqual(ot.get_past_occurrences(now), [occurrences[1]])
+    self.assertEqual(events._get_past_occurrences([ed1, ed2], ot, now),
+                     events._get_past_occurrences([ed1, ed2], occurrences,
+                                                  now))
+    self.assertEqual(ot.get_occurrences_between(datetime.date(2011, 1, 10),
+                                                now), by_date[1:])
+    self.assertEqual(ot.get_clearance_index().cleared_counts,
+                     events.ClearanceIndex(occurrences).cleared_counts)
+    es = store.EventStore([ed1, ed2], ot)
+    self.assertEqual(es.get_past_occurrences(now), [occurrences[1]])
+
+    # Changes keep the rows in date order.
+    eo = events.EventOccurrence(ed2, datetime.date(2011, 1, 10), True)
+    self.assertEqual(ot.add_occurrence(eo), 3)
+    self.assertEqual(ot.set_cleared(ed2, datetime.date(2011, 1, 10)), 2)
+    self.assertEqual(ot.get_past_occurrences(now), [])
+    ot.remove_row(3)
+    self.assertEqual(ot.find_rows(ed2, datetime.date(2011, 1, 10)), [1])
+    self.assertEqual(ot.find_row(events.EventOccurrence(
+      ed2, datetime.date(2011, 1, 10), True)), 1)
+    self.assertRaises(ValueError, ot.remove, events.EventOccurrence(
+      ed2, datetime.date(2011, 1, 10)))
+    self.assertRaises(Exception, ot.add_occurrence,
+                      events.EventOccurrence(events.EventDefinition(
+                        'ac', 'Unknown', datetime.date(2011, 1, 1)),
+                                             datetime.date(2011, 1, 1)))
+
+  def test_read_data_file(self):
+    read_filepath = os.path.join(test_data_dir, 'basic_read')
+    definitions, occurrences = storage.read_data_file(read_filepath)
+    occurrences.sort(key=lambda occurrence: occurrence.get_date())
+    binary_filepath = os.path.join(test_temp_dir, 'binary')
+    storage.convert_data_file(read_filepath, binary_filepath,
+                              storage.BINARY_VERSION)
+    for filepath in (read_filepath, binary_filepath):
+      definitions2, ot = table.read_data_file(filepath)
+      self.assertEqual(definitions2, definitions)
+      self.assertEqual(list(ot), occurrences)
+
+
+class TestRecurrenceStats(unittest.TestCase):
+
+  def setUp(self):
+    os.mkdir(test_temp_dir)
+    self.was_enabled = stats.enabled
+    stats.reset()
+
+  def tearDown(self):
+    shutil.rmtree(test_temp_dir)
+    stats.enable(self.was_enabled)
+    stats.set_timing_hook(None)
+    stats.reset()
+
+  def test_counters(self):
+    er = events.EventRecurrence(events.EVENT_PERIOD_WEEKLY)
+    ed = events.EventDefinition('1', 'Event', datetime.date(2008, 1, 1), er)
+    eo = events.EventOccurrence(ed, datetime.date(2008, 1, 8), True)
+    filepath = os.path.join(test_temp_dir, 'stats')
+
+    # Nothing is gathered while disabled.
+    stats.enable(False)
+    storage.write_data_file(filepath, [ed], [eo])
+    self.assertEqual(stats.snapshot(), {'counters': {}, 'timings': {}})
+
+    stats.enable()
+    calls = []
+    stats.set_timing_hook(lambda phase, seconds: calls.append(phase))
+    storage.write_data_file(filepath, [ed], [eo])
+    definitions, occurrences = storage.read_data_file(filepath)
+    events._get_future_occurrences(definitions, occurrences,
+                                   datetime.date(2008, 1, 1), 14)
+    eo.next()
+    snapshot = stats.snapshot()
+    self.assertEqual(snapshot['counters'],
+                     {'bytes_read': os.path.getsize(filepath),
+                      'bytes_written': os.path.getsize(filepath),
+                      'records_parsed': 2,
+                      'records_written': 2,
+                      'clearance_checks': 3,
+                      'occurrences_generated': 3})
+    self.assertEqual(sorted(snapshot['timings']),
+                     ['future_query', 'read_data_file', 'write_data_file'])
+    self.assertEqual(snapshot['timings']['read_data_file']['calls'], 1)
+    self.assertEqual(calls, ['write_data_file', 'read_data_file',
+                             'future_query'])
+    stats.reset()
+    self.assertEqual(stats.snapshot(), {'counters': {}, 'timings': {}})
+
+
+class TestRecurrenceQuery(unittest.TestCase):
+
+  def setUp(self):
+    os.mkdir(test_temp_dir)
+
+  def tearDown(self):
+    shutil.rmtree(test_temp_dir)
+
+  def _query(self, *args):
+    script = os.path.abspath(os.path.join(sys.argv[0],
+                                          "../../bin/recurrence-query"))
+    proc = subprocess.Popen([sys.executable, script] + list(args),
+                            stdout=subprocess.PIPE)
+    output = proc.communicate()[0]
+    self.assertEqual(proc.returncode, 0)
+    return output
+
+  def test_past_honors_cleared_through(self):
+    er = events.EventRecurrence(events.EVENT_PERIOD_WEEKLY)
+    ed = events.EventDefinition('aa', 'Weekly', datetime.date(2011, 1, 1),
+                                er, datetime.date(2011, 1, 15))
+    occurrences = [events.EventOccurrence(ed, datetime.date(2011, 1, 8)),
+                   events.EventOccurrence(ed, datetime.date(2011, 1, 22))]
+    filepath = os.path.join(test_temp_dir, 'query')
+    for version in (1, storage.JOURNAL_VERSION, storage.BINARY_VERSION):
+      storage.write_data_file(filepath, [ed], occurrences, version)
+      self.assertEqual(self._query('--past', '--as-of', '2011-02-01',
+                                   filepath),
+                       '2011-01-22 | past | Weekly\n')
+
+
 if __name__ == '__main__':
   unittest.main()